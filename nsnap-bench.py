@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+#
+# version 1.0
+# https://github.com/ethbian/nsnap
+#
+# Synthetic benchmark: generates nmap XML results of a given size, runs every
+# nsnap.py phase against a scratch DB (with a stub nmap binary, no network
+# access needed) and load-tests nsnap-web.py. Results are printed as JSON.
+#
+
+import os
+import re
+import sys
+import json
+import asyncio
+import math
+import time
+import random
+import logging
+import argparse
+import platform
+import datetime
+import tempfile
+import statistics
+import importlib.util
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+WEB_ROUTES = ['/', '/services', '/diffs', '/host?hostid=1']
+SERVICES = ['ssh', 'http', 'https', 'smtp', 'domain', 'mysql', 'postgresql', 'redis', 'ms-wbt-server', 'unknown']
+STUB_NMAP = '''#!/usr/bin/env python3
+import os, sys, shutil
+shutil.copyfile(os.environ['NSNAP_BENCH_XML'], sys.argv[sys.argv.index('-oX') + 1])
+'''
+HOSTS_SQL = re.compile(r'\b(FROM|INTO|UPDATE)\s+hosts\b')
+
+
+def load_module(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(BASEDIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# ---------------------------------------------------- nmap xml generator
+class Estate:
+    '''a fake network: every host has a set of ports, churn() changes a fraction of them'''
+    def __init__(self, hosts, ports, seed):
+        self.random = random.Random(seed)
+        self.hosts = []
+        for idx in range(hosts):
+            ip = '10.{}.{}.{}'.format(idx // 65536 % 256, idx // 256 % 256, idx % 256)
+            name = 'host{}.example.org'.format(idx) if idx % 2 else '-'
+            self.hosts.append((ip, name, {self.random_port(): self.random_service() for _ in range(ports)}))
+
+    def random_port(self):
+        return (self.random.choice(['tcp', 'tcp', 'tcp', 'udp']), self.random.randint(1, 65535))
+
+    def random_service(self):
+        return (self.random.choice(['open', 'open', 'open', 'filtered', 'closed']), self.random.choice(SERVICES))
+
+    def churn(self, rate):
+        '''changes (state/service, new port or closed port) about rate * all ports'''
+        for _, _, ports in self.hosts:
+            for key in list(ports):
+                if self.random.random() >= rate:
+                    continue
+                change = self.random.random()
+                if change < 0.4:
+                    ports[key] = self.random_service()
+                elif change < 0.7:
+                    del ports[key]
+                else:
+                    ports[self.random_port()] = self.random_service()
+
+    def write_xml(self, xml_file):
+        with open(xml_file, 'w') as xml:
+            xml.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            xml.write('<nmaprun scanner="nmap" args="nmap -oX bench" start="{}" version="7.80">\n'.format(int(time.time())))
+            for ip, name, ports in self.hosts:
+                xml.write('<host><status state="up" reason="user-set"/>')
+                xml.write('<address addr="{}" addrtype="ipv4"/>'.format(ip))
+                if name != '-':
+                    xml.write('<hostnames><hostname name="{}" type="PTR"/></hostnames>'.format(name))
+                else:
+                    xml.write('<hostnames/>')
+                xml.write('<ports>')
+                for (proto, port), (state, service) in sorted(ports.items()):
+                    xml.write('<port protocol="{}" portid="{}"><state state="{}" reason="syn-ack"/>'
+                              '<service name="{}" method="table" conf="3"/></port>'.format(proto, port, state, service))
+                xml.write('</ports></host>\n')
+            xml.write('<runstats><finished time="{}"/></runstats></nmaprun>\n'.format(int(time.time())))
+
+
+# ---------------------------------------------------- nsnap.py phases
+def timed(timings, phase, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    timings[phase] = round(time.perf_counter() - start, 4)
+    return result
+
+
+class HostsCursor:
+    '''wraps the cursor of nsnap.py's DB and adds up the time spent in statements on the hosts table
+       (the map load and the hosts upsert of ingest_hosts()), nsnap.py itself is not instrumented'''
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.hosts = False
+        self.seconds = 0
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def timed(self, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            if self.hosts:
+                self.seconds += time.perf_counter() - start
+
+    def execute(self, sql, *args):
+        self.hosts = HOSTS_SQL.search(sql) is not None
+        return self.timed(self.cursor.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        self.hosts = HOSTS_SQL.search(sql) is not None
+        return self.timed(self.cursor.executemany, sql, *args)
+
+    def fetchone(self):
+        return self.timed(self.cursor.fetchone)
+
+    def fetchall(self):
+        return self.timed(self.cursor.fetchall)
+
+
+def nmap_scan(nsnap, xml_file):
+    async def scan():
+        return await nsnap.nmap_scan(xml_file, nsnap.SCAN_PROFILES['default'], asyncio.Semaphore(nsnap.NMAP_WORKERS))
+    return asyncio.run(scan())
+
+
+def bench_scans(nsnap, estate, args, workdir):
+    nsnap.DBDIR = workdir
+    nsnap.DBPATH = os.path.join(workdir, 'nsnap.sqlite3')
+    nsnap.NMAP_DIR = workdir
+    nsnap.NMAP_PATH = os.path.join(workdir, 'nmap')
+    nsnap.SCAN_PROFILES = {'default': {'target': '10.0.0.0/8', 'options': nsnap.NMAP_OPTS}}
+    with open(nsnap.NMAP_PATH, 'w') as stub:
+        stub.write(STUB_NMAP)
+    os.chmod(nsnap.NMAP_PATH, 0o755)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    db = nsnap.open_db()
+    db.dbcursor = cursor = HostsCursor(db.dbcursor)
+    results = []
+    first_scan = int(time.time()) - args.runs * 86400
+    for run in range(args.runs):
+        if run > 0:
+            estate.churn(args.churn)
+        source_file = os.path.join(workdir, 'source.xml')
+        estate.write_xml(source_file)
+        os.environ['NSNAP_BENCH_XML'] = source_file
+        now = first_scan + run * 86400
+        xml_file = 'scan_{}.xml'.format(now)
+
+        timings = {}
+        run_id, now = db.start_run(now, '10.0.0.0/8', ' '.join(nsnap.NMAP_OPTS))
+        timed(timings, 'nmap', nmap_scan, nsnap, xml_file)
+        hosts = timed(timings, 'parse', lambda: list(nsnap.parse_nmap_hosts(xml_file)))
+        cursor.seconds = 0
+        total_hosts, total_ports = timed(timings, 'ingest_scan', db.ingest_hosts, hosts, now)
+        # ingest_hosts() interleaves the hosts upsert with the current_scan inserts, the cursor times the former
+        timings['ingest_hosts'] = round(cursor.seconds, 4)
+        timings['ingest_scan'] = round(timings['ingest_scan'] - cursor.seconds, 4)
+        changed = timed(timings, 'diff', db.update_observations, now)
+        timed(timings, 'commit', db.finish_run, run_id, 'ok', sum(timings.values()), total_hosts, total_ports, changed)
+        ingest_time = sum(timings[phase] for phase in ('parse', 'ingest_hosts', 'ingest_scan', 'diff', 'commit'))
+        results.append({'run': run, 'xml_bytes': os.path.getsize(xml_file), 'hosts': total_hosts,
+                        'ports': total_ports, 'changed_hosts': changed, 'seconds': timings,
+                        'ports_per_second': round(total_ports / ingest_time) if ingest_time else None})
+        os.remove(xml_file)
+        logging.warning('run {}: {}'.format(run, timings))
+    db.dbclose()
+    os.chdir(cwd)
+    return results
+
+
+# ---------------------------------------------------- nsnap-web.py load test
+def latency_stats(latencies):
+    latencies = sorted(latencies)
+    return {'requests': len(latencies),
+            'p50_ms': round(statistics.median(latencies) * 1000, 2),
+            'p95_ms': round(latencies[math.ceil(len(latencies) * 0.95) - 1] * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2),
+            'requests_per_second': round(len(latencies) / sum(latencies), 1)}
+
+
+def bench_web(web, dbpath, requests):
+    web.DBPATH = dbpath
+    web.app.template_folder = os.path.join(BASEDIR, 'templates')
+    client = web.app.test_client()
+    results = {}
+    for cached in (False, True):
+        web.page_cache.max_size = web.CACHE_MAX_BYTES if cached else 0
+        web.query_cache.max_size = web.CACHE_MAX_QUERIES if cached else 0
+        for route in WEB_ROUTES:
+            latencies = []
+            for _ in range(requests):
+                start = time.perf_counter()
+                response = client.get(route)
+                response.get_data()
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    raise SystemExit('{} returned {}'.format(route, response.status_code))
+            stats = latency_stats(latencies)
+            stats['bytes'] = len(response.get_data())
+            results['{} ({})'.format(route, 'cached' if cached else 'uncached')] = stats
+    return results
+
+
+# ----------------------------------------------------- main
+def run_bench(args, workdir):
+    nsnap = load_module('nsnap', 'nsnap.py')
+    estate = Estate(args.hosts, args.ports, args.seed)
+    results = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'params': {name: value for name, value in vars(args).items() if name not in ('output', 'workdir')},
+               'python': platform.python_version(),
+               'sqlite': nsnap.sqlite3.sqlite_version,
+               'scans': bench_scans(nsnap, estate, args, workdir)}
+    if not args.no_web:
+        results['web'] = bench_web(load_module('nsnap_web', 'nsnap-web.py'), nsnap.DBPATH, args.requests)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='nsnap synthetic benchmark')
+    parser.add_argument('--hosts', type=int, default=1000, help='hosts in the generated scans')
+    parser.add_argument('--ports', type=int, default=20, help='ports per host')
+    parser.add_argument('--churn', type=float, default=0.01, help='fraction of ports changed between runs')
+    parser.add_argument('--runs', type=int, default=3, help='number of scans to ingest')
+    parser.add_argument('--requests', type=int, default=20, help='requests per web route')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-web', action='store_true', help='skip the nsnap-web.py load test')
+    parser.add_argument('--workdir', help='keep the generated files and DB in this directory')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run_bench(args, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory(prefix='nsnap-bench-') as workdir:
+            results = run_bench(args, workdir)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
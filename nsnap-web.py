@@ -6,47 +6,616 @@
 #
 
 import os
+import re
+import hmac
+import shutil
 import sqlite3
 import datetime
 import html
+import threading
+import pathlib
+import time
+import hashlib
+import functools
+import ipaddress
+import csv
+import io
+import json
+import bisect
+import asyncio
+import heapq
+import itertools
+import urllib.parse
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask
+from flask import Response
+from flask import g
+from flask import jsonify
 from flask import request
+from flask import make_response
 from flask import render_template
+from flask import url_for
+from flask import stream_with_context
 from flask_bootstrap import Bootstrap
 
 DBPATH = '/var/lib/nsnap/nsnap.sqlite3'
 HOST = '0.0.0.0'
 PORT = 5000
+DB_TIMEOUT = 10
+DB_CACHED_STATEMENTS = 256
+PAGE_SIZE = 100
+PAGE_SIZE_MAX = 1000
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_MAX_QUERIES = 256
+SNAPSHOT_CACHE_MAX = 8
+TOP_HOSTS = 10
+STREAM_BUFFER = 100
+EXPORT_CHUNK = 64 * 1024
+# scanner agents (nsnap.py --agent) POST their results to /api/ingest: {agent name: token},
+# accepted uploads are written to INBOX_DIR, nsnap.py on this host stores them in the DB
+AGENT_TOKENS = {}
+INBOX_DIR = '/var/lib/nsnap/inbox'
+INGEST_MAX_BYTES = 512 * 1024 * 1024
+# live updates: Server-Sent Events on http://HOST:EVENTS_PORT/events (None: disabled, eg. 5001), one event
+# per finished run or edited comment, the DB is checked every EVENTS_POLL seconds for all clients.
+# EVENTS_URL is the address the Diffs page connects to when the events are proxied (default: EVENTS_PORT),
+# only pages from PORT on the same host or from the origin of EVENTS_URL may read the events (CORS)
+EVENTS_PORT = None
+EVENTS_URL = ''
+EVENTS_POLL = 2
+EVENTS_KEEPALIVE = 30
+EVENTS_MAX_CLIENTS = 1000
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+UPDATE_META_GENERATION = '''UPDATE meta SET value=CASE key WHEN 'generation' THEN value + 1
+    ELSE strftime('%s', 'now') END WHERE key IN ('generation', 'modified');'''
+
+HOST_FILTER = 'id IN (SELECT id FROM hosts WHERE ip=:host OR name=:host)'
+SERVICE_FILTERS = {'host': HOST_FILTER, 'port': 'port=:port', 'protocol': 'protocol=:protocol',
+                   'service': 'service=:service', 'state': 'state=:state', 'profile': 'profile=:profile'}
+DIFF_FILTERS = {'host': HOST_FILTER, 'since': 'updated>=:since', 'until': 'updated<=:until',
+                'profile': 'updated IN (SELECT updated FROM runs WHERE profile=:profile)'}
+UPLOAD_NAME = re.compile(r'[A-Za-z0-9_-][A-Za-z0-9_.-]*')
+# agent and upload names cannot contain it, inbox file names stay unique
+INBOX_SEPARATOR = '+'
+EXPORT_COLUMNS = {'services': ('host_id', 'ip', 'name', 'updated', 'port', 'protocol', 'state', 'service'),
+                  'diffs': ('host_id', 'ip', 'name', 'updated', 'port', 'protocol', 'old_state', 'old_service',
+                            'new_state', 'new_service')}
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+DIFFPORT_FILTERS = {'port': 'port=:port', 'protocol': 'protocol=:protocol',
+                    'service': ':service IN (old_service, new_service)', 'state': ':state IN (old_state, new_state)'}
+
+# /search terms, "name:value" (anything else is free text matched against host names/addresses and,
+# for changes, diff texts and comments), "{0}" is the name of the query parameter
+SEARCH_FIELDS = ('service', 'state', 'port', 'proto', 'net', 'host', 'profile', 'since', 'until')
+SEARCH_CONDITIONS = {
+    'services': {'service': 'service=:{0}', 'state': 'state=:{0}', 'port': 'port=:{0}', 'proto': 'protocol=:{0}',
+                 'profile': 'profile=:{0}'},
+    'diffs': {'service': ':{0} IN (old_service, new_service)', 'state': ':{0} IN (old_state, new_state)',
+              'port': 'port=:{0}', 'proto': 'protocol=:{0}', 'since': 'diffports.updated>=:{0}',
+              'until': 'diffports.updated<=:{0}',
+              'profile': 'diffports.updated IN (SELECT updated FROM runs WHERE profile=:{0})'},
+}
+SEARCH_NET = 'ipkey BETWEEN :{0}_first AND :{0}_last'
+SEARCH_HOST = {True: 'hosts.id IN (SELECT rowid FROM search_hosts WHERE search_hosts MATCH :{0})',
+               False: '(ip LIKE :{0} OR name LIKE :{0})'}
+SEARCH_DIFF_TEXT = {True: '(diffports.id, diffports.updated) IN (SELECT id, updated FROM search_diffs '
+                          'WHERE search_diffs MATCH :{0})',
+                    False: 'EXISTS (SELECT 1 FROM diffscan WHERE diffscan.id=diffports.id '
+                           'AND diffscan.updated=diffports.updated AND (diff LIKE :{0} OR comment LIKE :{0}))'}
+
+connections = threading.local()
+
+
+def get_connection(readonly=True):
+    '''every server thread keeps its own read-only (and, when needed, read-write) connection
+       open for its lifetime. nsnap.py switches the DB to WAL mode, so readers are not blocked
+       while a scan is being written. Autocommit mode: read transactions are handled by DB.'''
+    name = 'reader' if readonly else 'writer'
+    dbconn = getattr(connections, name, None)
+    if dbconn is None:
+        if readonly:
+            dbconn = sqlite3.connect('{}?mode=ro'.format(pathlib.Path(DBPATH).as_uri()), uri=True, timeout=DB_TIMEOUT,
+                                     isolation_level=None, cached_statements=DB_CACHED_STATEMENTS)
+        else:
+            dbconn = sqlite3.connect(DBPATH, timeout=DB_TIMEOUT, isolation_level=None)
+        setattr(connections, name, dbconn)
+    return dbconn
+
+
+def get_archive_connection(archive):
+    '''read-only connection to an archive DB (nsnap.py moves old runs into them), opened the first
+       time one of its runs is read and kept by the server thread. The live DB is attached to it,
+       so the same queries find hosts and runs there.'''
+    archives = getattr(connections, 'archives', None)
+    if archives is None:
+        archives = connections.archives = {}
+    dbconn = archives.get(archive)
+    if dbconn is None:
+        archive_path = pathlib.Path(DBPATH).with_name(archive)
+        if not archive_path.exists():
+            raise sqlite3.OperationalError('archive {} does not exist'.format(archive_path))
+        dbconn = sqlite3.connect('{}?mode=ro'.format(archive_path.as_uri()), uri=True, timeout=DB_TIMEOUT,
+                                 isolation_level=None, cached_statements=DB_CACHED_STATEMENTS)
+        dbconn.execute('ATTACH DATABASE ? AS live;', ('{}?mode=ro'.format(pathlib.Path(DBPATH).as_uri()),))
+        archives[archive] = dbconn
+    return dbconn
+
+
+def get_generation():
+    '''(generation, modified) from the meta table, generation changes every time nsnap.py
+       stores a run or a comment is edited. (None, None) for DBs without the meta table.'''
+    try:
+        meta = dict(get_connection().execute("SELECT key, value FROM meta WHERE key IN ('generation', 'modified')"))
+    except Exception:
+        return None, None
+    return meta.get('generation'), meta.get('modified')
+
+
+def release_connections():
+    connections.users = 0
+    dbconns = [getattr(connections, 'reader', None)] + list(getattr(connections, 'archives', {}).values())
+    for dbconn in dbconns:
+        if dbconn is not None and dbconn.in_transaction:
+            dbconn.rollback()
+
+
+class LRUCache:
+    '''thread safe LRU cache bounded by the total size of its values, entries from
+       an older DB generation are dropped as soon as a newer generation is seen'''
+    def __init__(self, max_size, sizeof=len):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.generation = None
+
+    def get(self, key, generation):
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.size = 0
+                self.generation = generation
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, generation, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if generation != self.generation or size > self.max_size:
+                return
+            if key in self.entries:
+                self.size -= self.sizeof(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+
+page_cache = LRUCache(CACHE_MAX_BYTES, sizeof=lambda page: len(page[0]))
+query_cache = LRUCache(CACHE_MAX_QUERIES, sizeof=lambda result: 1)
+
+
+def cached_query(method):
+    '''caches DB query results for the DB generation of the current request'''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        generation = g.get('generation')
+        if generation is None:
+            return method(self, *args, **kwargs)
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        result = query_cache.get(key, generation)
+        if result is not None:
+            self.clear_errors()
+            return result
+        result = method(self, *args, **kwargs)
+        if not self.error:
+            query_cache.put(key, generation, result)
+        return result
+    return wrapper
+
+
+def page_validators():
+    '''page cache key, ETag and Last-Modified of a GET request for the DB generation of the request,
+       the response is 304 (not modified) when the client already has them'''
+    key = (request.path, request.query_string)
+    etag = hashlib.sha1(repr(key + (g.generation,)).encode()).hexdigest()
+    last_modified = datetime.datetime.fromtimestamp(g.modified, tz=datetime.timezone.utc)
+    not_modified = etag in request.if_none_match or \
+        (not request.if_none_match and request.if_modified_since is not None
+         and request.if_modified_since >= last_modified.replace(microsecond=0))
+    return key, etag, last_modified, not_modified
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
+def cached_page(view):
+    '''serves GET requests from the page cache and answers conditional requests
+       (ETag/Last-Modified) without rendering anything when the DB has not changed'''
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        generation = g.get('generation')
+        if request.method != 'GET' or generation is None:
+            return view(*args, **kwargs)
+        key, etag, last_modified, not_modified = page_validators()
+        if not_modified:
+            response = make_response('', 304)
+        else:
+            page = page_cache.get(key, generation)
+            if page is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or g.get('nocache'):
+                    return response
+                if response.is_streamed:
+                    response.response = cache_chunks(response.response, key, generation, response.mimetype)
+                else:
+                    page_cache.put(key, generation, (response.get_data(), response.mimetype))
+            else:
+                response = make_response(page[0])
+                response.mimetype = page[1]
+        return set_validators(response, etag, last_modified)
+    return wrapper
+
+
+def conditional_page(view):
+    '''answers conditional GET requests (ETag/Last-Modified) like cached_page, without caching
+       the response: for streams too big for the page cache'''
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or g.get('generation') is None:
+            return view(*args, **kwargs)
+        _, etag, last_modified, not_modified = page_validators()
+        if not_modified:
+            return set_validators(make_response('', 304), etag, last_modified)
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200:
+            return response
+        return set_validators(response, etag, last_modified)
+    return wrapper
+
+
+def cache_chunks(chunks, key, generation, mimetype):
+    '''passes a streamed page through and caches it once it has been sent completely,
+       stops collecting it as soon as it grows bigger than the whole page cache'''
+    body = []
+    size = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            yield chunk
+            if body is not None:
+                body.append(chunk)
+                size += len(chunk)
+                if size > page_cache.max_size:
+                    body = None
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    if body is not None:
+        page_cache.put(key, generation, (b''.join(body), mimetype))
+
+
+def stream_response(chunks, **kwargs):
+    '''sends chunks as they are generated, the request context and the DB read transaction
+       (teardown_db leaves it open) are kept until the last one is sent'''
+    g.streaming = True
+
+    def generate():
+        try:
+            yield from chunks
+        finally:
+            release_connections()
+    return Response(stream_with_context(generate()), **kwargs)
+
+
+def stream_template(template_name, **context):
+    '''renders a template while it is being sent'''
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
+    return stream_response(stream)
+
+
+class LatencyHistograms:
+    '''request latency histograms per route, in the Prometheus text format'''
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.routes = {}
+
+    def observe(self, route, seconds):
+        with self.lock:
+            counts, total = self.routes.get(route, ([0] * (len(self.buckets) + 1), 0.0))
+            for idx, bucket in enumerate(self.buckets + (float('inf'),)):
+                if seconds <= bucket:
+                    counts[idx] += 1
+            self.routes[route] = (counts, total + seconds)
+
+    def render(self, name):
+        lines = ['# HELP {} Request latency by route.'.format(name), '# TYPE {} histogram'.format(name)]
+        with self.lock:
+            for route, (counts, total) in sorted(self.routes.items()):
+                for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                    lines.append('{}_bucket{{route="{}",le="{}"}} {}'.format(name, route, bucket, count))
+                lines.append('{}_sum{{route="{}"}} {}'.format(name, route, total))
+                lines.append('{}_count{{route="{}"}} {}'.format(name, route, counts[-1]))
+        return lines
+
+
+request_latency = LatencyHistograms(LATENCY_BUCKETS)
+
+
+# ---------------------------------------------------- live updates
+EVENTS_HEADERS = 'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nVary: Origin\r\n' \
+                 '{}Connection: close\r\n\r\nretry: 5000\n\n'
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+EVENTS_ERROR = 'HTTP/1.1 {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+
+def get_finished_runs(generation):
+    '''(generation, updated, profile, changed) of the runs finished after the given generation'''
+    return get_connection().execute('SELECT generation, updated, profile, changed FROM runs WHERE generation>? '
+                                    'ORDER BY generation', (generation,)).fetchall()
+
+
+def events_origin(origin, host):
+    '''the Origin header of an /events request (Host header "host") when the request comes from the
+       web app: PORT on the same host or the origin of EVENTS_URL (behind a proxy), None otherwise'''
+    try:
+        url = urllib.parse.urlsplit(origin)
+        events_url = urllib.parse.urlsplit(EVENTS_URL)
+        app_port = url.port or DEFAULT_PORTS.get(url.scheme)
+        events_host = urllib.parse.urlsplit('//' + host).hostname
+    except ValueError:
+        return None
+    if events_url.netloc and (url.scheme, url.netloc) == (events_url.scheme, events_url.netloc):
+        return origin
+    if url.hostname is not None and url.hostname == events_host and app_port == PORT:
+        return origin
+    return None
+
+
+class EventServer:
+    '''Server-Sent Events: every client is a coroutine of one asyncio loop (in its own thread, next to
+       the WSGI server), so idle clients only cost their sockets. A single poller reads the DB generation
+       for all of them, when it moves every client gets the latest "change" event (slow clients skip
+       the ones they missed, the event says which generation they are at).'''
+    def __init__(self):
+        self.clients = 0
+        self.generation = None
+        self.event = None
+        self.changed = None
+
+    def start(self):
+        threading.Thread(target=asyncio.run, args=(self.serve(),), name='events', daemon=True).start()
+
+    async def serve(self):
+        self.changed = asyncio.Condition()
+        server = await asyncio.start_server(self.handle, HOST, EVENTS_PORT)
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.poll())
+
+    async def poll(self):
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=1) as dbthread:
+            while True:
+                generation, modified = await loop.run_in_executor(dbthread, get_generation)
+                if generation is not None and generation != self.generation:
+                    try:
+                        since = generation if self.generation is None else self.generation
+                        runs = await loop.run_in_executor(dbthread, get_finished_runs, since)
+                    except sqlite3.Error:
+                        runs = []
+                    await self.publish(generation, modified, runs)
+                await asyncio.sleep(EVENTS_POLL)
+
+    async def publish(self, generation, modified, runs):
+        data = json.dumps({'generation': generation, 'modified': modified,
+                           'runs': [dict(zip(('generation', 'updated', 'profile', 'changed'), run)) for run in runs]})
+        self.generation = generation
+        self.event = 'id: {}\nevent: change\ndata: {}\n\n'.format(generation, data).encode()
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), EVENTS_KEEPALIVE)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), EVENTS_KEEPALIVE)
+                if line.strip() == b'':
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            method, path = (request_line.decode('latin-1').split() + ['', ''])[:2]
+            if method != 'GET' or path.partition('?')[0] != '/events':
+                writer.write(EVENTS_ERROR.format('404 Not Found').encode())
+            elif self.clients >= EVENTS_MAX_CLIENTS:
+                writer.write(EVENTS_ERROR.format('503 Service Unavailable').encode())
+            else:
+                self.clients += 1
+                try:
+                    origin = events_origin(headers.get('origin', ''), headers.get('host', ''))
+                    await self.stream(writer, headers.get('last-event-id'), origin)
+                finally:
+                    self.clients -= 1
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def stream(self, writer, last_event_id, origin):
+        '''sends the latest event whenever the generation differs from the last one the client got
+           (also right away to new clients) and a comment line every EVENTS_KEEPALIVE seconds,
+           browsers only let pages from "origin" read them'''
+        cors = '' if origin is None else 'Access-Control-Allow-Origin: {}\r\n'.format(origin)
+        writer.write(EVENTS_HEADERS.format(cors).encode('latin-1'))
+        sent = last_event_id
+        while True:
+            if self.event is not None and sent != str(self.generation):
+                writer.write(self.event)
+                sent = str(self.generation)
+            await writer.drain()
+            async with self.changed:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    writer.write(b': keepalive\n\n')
+
+
+# ---------------------------------------------------- snapshot index
+class StringTable:
+    '''interns strings as small integers, shared by all snapshots for the lifetime of the server'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = {}
+        self.values = []
+
+    def intern(self, value):
+        index = self.index.get(value)
+        if index is None:
+            with self.lock:
+                index = self.index.setdefault(value, len(self.values))
+                if index == len(self.values):
+                    self.values.append(value)
+        return index
+
+
+protocols = StringTable()
+labels = StringTable()
+
+
+class Snapshot:
+    '''the services of one scan as two parallel sorted arrays: keys (host id, port, protocol)
+       and values (state, service), both packed into 64 bit integers. 100k ports take ~1.6 MB
+       and two snapshots are compared with a single merge pass.'''
+    def __init__(self, services):
+        rows = sorted((id << 24 | port << 8 | protocols.intern(protocol),
+                       labels.intern(state) << 32 | labels.intern(service))
+                      for id, _, port, protocol, state, service in services)
+        self.keys = array('q', (key for key, _ in rows))
+        self.values = array('q', (value for _, value in rows))
+
+    def host_range(self, id):
+        if id == 0:
+            return 0, len(self.keys)
+        return bisect.bisect_left(self.keys, id << 24), bisect.bisect_left(self.keys, (id + 1) << 24)
+
+    def compare(self, newer, id=0):
+        '''(host id, port, protocol, old state, old service, new state, new service) of every
+           port that differs, None for the side where the port is missing'''
+        changes = []
+        old_idx, old_end = self.host_range(id)
+        new_idx, new_end = newer.host_range(id)
+        while old_idx < old_end or new_idx < new_end:
+            old_key = self.keys[old_idx] if old_idx < old_end else None
+            new_key = newer.keys[new_idx] if new_idx < new_end else None
+            if new_key is None or (old_key is not None and old_key < new_key):
+                changes.append((old_key, self.values[old_idx], None))
+                old_idx += 1
+            elif old_key is None or new_key < old_key:
+                changes.append((new_key, None, newer.values[new_idx]))
+                new_idx += 1
+            else:
+                if self.values[old_idx] != newer.values[new_idx]:
+                    changes.append((old_key, self.values[old_idx], newer.values[new_idx]))
+                old_idx += 1
+                new_idx += 1
+        return [(key >> 24, key >> 8 & 0xffff, protocols.values[key & 0xff])
+                + unpack_labels(old_value) + unpack_labels(new_value) for key, old_value, new_value in changes]
+
+
+def unpack_labels(value):
+    if value is None:
+        return (None, None)
+    return (labels.values[value >> 32], labels.values[value & 0xffffffff])
+
+
+snapshot_cache = LRUCache(SNAPSHOT_CACHE_MAX, sizeof=lambda snapshot: 1)
+
+
+def get_snapshot(db, timestamp):
+    '''Snapshot of a scan (0: the current state), built from db.get_services on a cache miss,
+       None on DB errors'''
+    generation = g.get('generation')
+    snapshot = snapshot_cache.get(timestamp, generation) if generation is not None else None
+    if snapshot is None:
+        services = db.get_services(updated=timestamp)
+        if db.error:
+            return None
+        snapshot = Snapshot(services)
+        if generation is not None:
+            snapshot_cache.put(timestamp, generation, snapshot)
+    return snapshot
 
 
 class DB:
+    '''all reads done through the DB objects of a request share a single read transaction,
+       so a page sees one consistent snapshot even while nsnap.py is committing. It ends when
+       the last of them is closed (dbclose) or with the request.'''
     def __init__(self):
         self.clear_errors()
         try:
-            self.dbconn = sqlite3.connect(DBPATH)
+            self.dbconn = get_connection()
+            if not self.dbconn.in_transaction:
+                self.dbconn.execute('BEGIN;')
             self.dbcursor = self.dbconn.cursor()
         except Exception as ex:
             self.error = True
             self.error_msg = ex
+        else:
+            connections.users = getattr(connections, 'users', 0) + 1
 
     def clear_errors(self):
         self.error = False
         self.error_msg = ''
 
-    def dbcommit(self):
-        self.dbconn.commit()
-
     def dbclose(self):
-        self.dbconn.close()
+        connections.users = getattr(connections, 'users', 0) - 1
+        if connections.users <= 0:
+            release_connections()
+
+    def get_archive(self, updated):
+        '''connection to the archive DB holding the history of the run stored under "updated"
+           (inside a read transaction), None for runs in the live DB'''
+        row = self.dbconn.execute('SELECT archive FROM runs WHERE updated=?', (updated,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return self.open_archive(row[0])
 
+    def get_archives(self):
+        '''connections to all the archive DBs (inside read transactions), oldest first'''
+        rows = self.dbconn.execute('SELECT DISTINCT archive FROM runs WHERE archive IS NOT NULL ORDER BY archive')
+        return [self.open_archive(row[0]) for row in rows.fetchall()]
+
+    def open_archive(self, archive):
+        dbconn = get_archive_connection(archive)
+        if not dbconn.in_transaction:
+            dbconn.execute('BEGIN;')
+        return dbconn
+
+    @cached_query
     def get_hosts(self, id=0):
         self.clear_errors()
         all_hosts = []
-        sql = 'SELECT * FROM hosts'
-        if id != 0:
-            sql += ' WHERE id={}'.format(id)
         try:
-            self.dbcursor.execute(sql)
+            if id != 0:
+                self.dbcursor.execute('SELECT * FROM hosts WHERE id=?', (id,))
+            else:
+                self.dbcursor.execute('SELECT * FROM hosts')
         except Exception as ex:
             self.error = True
             self.error_msg = ex
@@ -54,96 +623,212 @@ class DB:
             all_hosts = self.dbcursor.fetchall()
         return all_hosts
 
+    @cached_query
     def get_fullscan_dates(self, id=0):
         self.clear_errors()
         scan_timestamps = []
         scan_dates = {}
         id = int(id)
-        sql = 'SELECT DISTINCT updated FROM fullscan'
+        sql = "SELECT updated, profile FROM runs WHERE status='ok'"
         if id != 0:
-            sql += ' WHERE id={}'.format(id)
+            sql += ' AND EXISTS (SELECT 1 FROM observations WHERE id=:id AND profile=runs.profile'
+            sql += ' AND first_seen<=updated AND (last_seen IS NULL OR last_seen>=updated))'
         sql += ' ORDER BY updated DESC'
         try:
-            result = self.dbcursor.execute(sql)
+            result = self.dbcursor.execute(sql, {'id': id})
         except Exception as ex:
             self.error = True
             self.error_msg = ex
         else:
             scan_timestamps = result.fetchall()
-            for timestamp in scan_timestamps:
-                scan_dates[timestamp[0]] = datetime.datetime.fromtimestamp(timestamp[0])
+            for timestamp, profile in scan_timestamps:
+                scan_dates[timestamp] = scan_label(timestamp, profile)
         return scan_dates
 
+    @cached_query
     def get_diffscan_dates(self, id=0):
         self.clear_errors()
         scan_timestamps = []
         scan_dates = {}
         id = int(id)
-        sql = 'SELECT DISTINCT updated FROM diffscan'
         if id != 0:
-            sql += ' WHERE id={}'.format(id)
+            sql = 'SELECT updated, profile FROM runs WHERE updated IN (SELECT updated FROM diffscan WHERE id=:id)'
+        else:
+            sql = "SELECT updated, profile FROM runs WHERE status='ok' AND changed>0"
         sql += ' ORDER BY updated DESC'
         try:
-            result = self.dbcursor.execute(sql)
+            result = self.dbcursor.execute(sql, {'id': id})
         except Exception as ex:
             self.error = True
             self.error_msg = ex
         else:
             scan_timestamps = result.fetchall()
-            for timestamp in scan_timestamps:
-                scan_dates[timestamp[0]] = datetime.datetime.fromtimestamp(timestamp[0])
+            for timestamp, profile in scan_timestamps:
+                scan_dates[timestamp] = scan_label(timestamp, profile)
         return scan_dates
 
-    def get_services(self, id=0, updated=0):
+    def get_services(self, id=0, updated=0, filters=None, after=None, limit=0):
+        '''rebuilds the snapshot of a single scan from the observation intervals of its profile,
+           by default the current state: open observations of all profiles, where profiles disagree
+           the most recently changed one wins. Rows are shaped like (id, updated, port, protocol,
+           state, service). Pages are ordered by (id, port, protocol), "after" is the last key of the
+           previous page.'''
+        return list(self.iter_services(id, updated, filters, after, limit))
+
+    def iter_services(self, id=0, updated=0, filters=None, after=None, limit=0):
+        '''get_services rows read one by one from their own cursor'''
         self.clear_errors()
-        all_services = []
+        filters = filters or {}
         id = int(id)
         updated = int(updated)
-        sql = 'SELECT * FROM fullscan WHERE '
         if updated == 0:
-            sql += 'updated=(SELECT DISTINCT updated FROM fullscan ORDER BY updated DESC LIMIT 1)'
+            sql = "SELECT id, (SELECT MAX(updated) FROM runs WHERE status='ok'), port, protocol, state, service, "
+            sql += 'MAX(first_seen) FROM observations WHERE last_seen IS NULL'
         else:
-            sql += 'updated={}'.format(updated)
+            sql = 'SELECT id, :updated, port, protocol, state, service FROM observations'
+            sql += ' WHERE (last_seen IS NULL OR last_seen>=:updated) AND first_seen<=:updated'
+            sql += ' AND profile=(SELECT profile FROM runs WHERE updated=:updated)'
         if id != 0:
-            sql += ' AND id={}'.format(id)
+            sql += ' AND id=:id'
+        sql += ''.join(' AND ' + SERVICE_FILTERS[name] for name in filters if name in SERVICE_FILTERS)
+        if after is not None:
+            sql += ' AND (id, port, protocol)>(:after_id, :after_port, :after_protocol)'
+        if updated == 0:
+            sql += ' GROUP BY id, port, protocol'
+        sql += ' ORDER BY id, port, protocol'
+        if limit:
+            sql += ' LIMIT :limit'
+        params = dict(filters, id=id, updated=updated, limit=limit)
+        if after is not None:
+            params.update(after_id=after[0], after_port=after[1], after_protocol=after[2])
         try:
-            result = self.dbcursor.execute(sql)
+            result = self.dbconn.execute(sql, params)
+            archive = self.get_archive(updated) if updated != 0 else None
+            if archive is not None:
+                # observations closed before the archive horizon are in the archive, the others still here
+                result = heapq.merge(result, archive.execute(sql, params), key=lambda row: (row[0], row[2], row[3]))
+                if limit:
+                    result = itertools.islice(result, limit)
         except Exception as ex:
             self.error = True
             self.error_msg = ex
-        else:
-            all_services = result.fetchall()
-        return(all_services)
+            return iter(())
+        return (row[:6] for row in result)
+
+    def get_diffs(self, updated=0, filters=None, before=None, limit=0):
+        '''diffs ordered by (updated, id), newest first, "before" is the last key of the previous page'''
+        return list(self.iter_diffs(updated, filters, before, limit))
 
-    def get_diffs(self, updated=0):
+    def iter_diffs(self, updated=0, filters=None, before=None, limit=0):
+        '''get_diffs rows read one by one from their own cursor'''
         self.clear_errors()
-        all_diffs = []
+        filters = filters or {}
         updated = int(updated)
-        sql = 'SELECT * FROM diffscan'
+        sql = 'SELECT * FROM diffscan WHERE 1'
         if updated != 0:
-            sql += ' WHERE updated={}'.format(updated)
-        sql += ' ORDER BY updated DESC'
+            sql += ' AND updated=:updated'
+        sql += ''.join(' AND ' + DIFF_FILTERS[name] for name in filters if name in DIFF_FILTERS)
+        diffport_filters = [DIFFPORT_FILTERS[name] for name in filters if name in DIFFPORT_FILTERS]
+        if diffport_filters:
+            sql += ' AND EXISTS (SELECT 1 FROM diffports WHERE diffports.id=diffscan.id'
+            sql += ' AND diffports.updated=diffscan.updated AND ' + ' AND '.join(diffport_filters) + ')'
+        if before is not None:
+            sql += ' AND (updated, id)<(:before_updated, :before_id)'
+        sql += ' ORDER BY updated DESC, id DESC'
+        if limit:
+            sql += ' LIMIT :limit'
+        params = dict(filters, updated=updated, limit=limit)
+        if before is not None:
+            params.update(before_updated=before[0], before_id=before[1])
+        try:
+            # the diffs of an archived run are all in its archive
+            archive = self.get_archive(updated) if updated != 0 else None
+            result = (archive or self.dbconn).execute(sql, params)
+        except Exception as ex:
+            self.error = True
+            self.error_msg = ex
+            return iter(())
+        return result
+
+    def iter_diffports(self, filters=None):
+        '''changed ports (id, updated, port, protocol, old state, old service, new state, new service),
+           newest first, read one by one from their own cursor'''
+        self.clear_errors()
+        filters = filters or {}
+        sql = 'SELECT id, updated, port, protocol, old_state, old_service, new_state, new_service FROM diffports'
+        sql += ' WHERE 1' + ''.join(' AND ' + DIFF_FILTERS[name] for name in filters if name in DIFF_FILTERS)
+        sql += ''.join(' AND ' + DIFFPORT_FILTERS[name] for name in filters if name in DIFFPORT_FILTERS)
+        sql += ' ORDER BY updated DESC, id, port, protocol'
+        try:
+            result = self.dbconn.execute(sql, filters)
+        except Exception as ex:
+            self.error = True
+            self.error_msg = ex
+            return iter(())
+        return result
+
+    def get_host_timeline(self, id=0):
+        '''all observation intervals of a host, one indexed lookup on its id: (port, protocol, profile,
+           state, service, first seen, last seen, first scan it was missing from or None), ordered by
+           port and time. Intervals still open were last seen in the host's last scan. Intervals of
+           archived runs are read from every archive DB (an interval spanning several periods is in
+           each of them, it is listed once).'''
+        self.clear_errors()
+        timeline = []
+        id = int(id)
+        sql = 'SELECT port, protocol, observations.profile, state, service, first_seen, COALESCE(last_seen, scanned,'
+        sql += " (SELECT MAX(updated) FROM runs WHERE runs.profile=observations.profile AND status='ok')),"
+        sql += " (SELECT MIN(updated) FROM runs WHERE runs.profile=observations.profile AND status='ok'"
+        sql += ' AND updated>last_seen) FROM observations LEFT JOIN host_scans ON host_scans.id=observations.id'
+        sql += ' AND host_scans.profile=observations.profile WHERE observations.id=?'
+        sql += ' ORDER BY port, protocol, observations.profile, first_seen'
         try:
-            result = self.dbcursor.execute(sql)
+            # the archives resolve runs and host_scans from the attached live DB
+            intervals = {row[:3] + row[5:6]: row for dbconn in self.get_archives()
+                         for row in dbconn.execute(sql, (id,))}
+            intervals.update((row[:3] + row[5:6], row) for row in self.dbcursor.execute(sql, (id,)))
         except Exception as ex:
             self.error = True
             self.error_msg = ex
         else:
-            all_diffs = result.fetchall()
-        return(all_diffs)
+            timeline = sorted(intervals.values(), key=lambda row: row[:3] + row[5:6])
+        return timeline
+
+    def get_new_diffs(self, since, limit):
+        '''(generation, diffs of the runs finished after generation "since" up to it), diffs are
+           (host id, ip, name, updated, diff, comment), newest first'''
+        self.clear_errors()
+        generation = since
+        new_diffs = []
+        sql = 'SELECT diffscan.id, ip, name, diffscan.updated, diff, comment FROM runs'
+        sql += ' JOIN diffscan ON diffscan.updated=runs.updated JOIN hosts ON hosts.id=diffscan.id'
+        sql += ' WHERE runs.generation>:since AND runs.generation<=:generation'
+        sql += ' ORDER BY diffscan.updated DESC, diffscan.id DESC LIMIT :limit'
+        try:
+            self.dbcursor.execute("SELECT value FROM meta WHERE key='generation'")
+            generation = self.dbcursor.fetchone()[0]
+            result = self.dbcursor.execute(sql, {'since': since, 'generation': generation, 'limit': limit})
+        except Exception as ex:
+            self.error = True
+            self.error_msg = ex
+        else:
+            new_diffs = result.fetchall()
+        return generation, new_diffs
 
     def get_diff_history(self, id=0):
+        '''all diffs of a host, the live DB and the archive DBs, newest first'''
         self.clear_errors()
         all_diffs = []
         id = int(id)
-        sql = 'SELECT * FROM diffscan WHERE id={} ORDER BY updated DESC'.format(id)
+        sql = 'SELECT id, updated, diff, comment FROM diffscan WHERE id=?'
         try:
-            result = self.dbcursor.execute(sql)
+            diffs = {row[1]: row for dbconn in self.get_archives() for row in dbconn.execute(sql, (id,))}
+            diffs.update((row[1], row) for row in self.dbcursor.execute(sql, (id,)))
         except Exception as ex:
             self.error = True
             self.error_msg = ex
         else:
-            all_diffs = result.fetchall()
+            all_diffs = sorted(diffs.values(), key=lambda row: row[1], reverse=True)
         return(all_diffs)
 
     def get_single_diff(self, id=0, updated=0):
@@ -151,9 +836,8 @@ class DB:
         id = int(id)
         updated = int(updated)
         comment = []
-        sql = 'SELECT * FROM diffscan WHERE id={} AND updated={}'.format(id, updated)
         try:
-            result = self.dbcursor.execute(sql)
+            result = self.dbcursor.execute('SELECT * FROM diffscan WHERE id=? AND updated=?', (id, updated))
         except Exception as ex:
             self.error = True
             self.error_msg = ex
@@ -161,58 +845,405 @@ class DB:
             comment = result.fetchone()
         return comment
 
+    @cached_query
+    def has_search_index(self):
+        self.clear_errors()
+        try:
+            result = self.dbcursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' "
+                                           "AND name IN ('search_hosts', 'search_diffs')")
+        except Exception as ex:
+            self.error = True
+            self.error_msg = ex
+            return False
+        return result.fetchone()[0] == 2
+
+    def search_services(self, search, limit=0):
+        '''current services (open observations of all profiles) matching a parsed search'''
+        self.clear_errors()
+        found = []
+        fts = self.has_search_index()
+        conditions, params = search_sql('services', search, fts)
+        sql = 'SELECT hosts.id, ip, name, port, protocol, state, service, profile, first_seen FROM observations '
+        sql += 'JOIN hosts ON hosts.id=observations.id WHERE last_seen IS NULL' + conditions
+        sql += ' ORDER BY ipkey, port, protocol, profile LIMIT :limit'
+        try:
+            result = self.dbcursor.execute(sql, dict(params, limit=limit or -1))
+        except Exception as ex:
+            self.error = True
+            self.error_msg = ex
+        else:
+            found = result.fetchall()
+        return found
+
+    def search_diffs(self, search, limit=0):
+        '''changed ports matching a parsed search, newest first'''
+        self.clear_errors()
+        found = []
+        fts = self.has_search_index()
+        conditions, params = search_sql('diffs', search, fts)
+        sql = 'SELECT hosts.id, ip, name, diffports.updated, port, protocol, old_state, old_service, '
+        sql += 'new_state, new_service FROM diffports JOIN hosts ON hosts.id=diffports.id WHERE 1' + conditions
+        sql += ' ORDER BY diffports.updated DESC, ipkey, port, protocol LIMIT :limit'
+        try:
+            result = self.dbcursor.execute(sql, dict(params, limit=limit or -1))
+        except Exception as ex:
+            self.error = True
+            self.error_msg = ex
+        else:
+            found = result.fetchall()
+        return found
+
+    def get_last_runs(self):
+        '''the last finished run of every profile'''
+        self.clear_errors()
+        last_runs = []
+        try:
+            result = self.dbcursor.execute("SELECT profile, id, updated, status, duration FROM runs WHERE updated IN "
+                                           "(SELECT MAX(updated) FROM runs WHERE status!='running' GROUP BY profile) "
+                                           "ORDER BY profile")
+        except Exception as ex:
+            self.error = True
+            self.error_msg = ex
+        else:
+            last_runs = result.fetchall()
+        return last_runs
+
+    @cached_query
+    def get_service_stats(self):
+        '''open ports and hosts per profile and service (service_stats, kept by nsnap.py)'''
+        self.clear_errors()
+        service_stats = []
+        try:
+            result = self.dbcursor.execute('SELECT profile, service, ports, hosts FROM service_stats '
+                                           'ORDER BY profile, ports DESC, service')
+        except Exception as ex:
+            self.error = True
+            self.error_msg = ex
+        else:
+            service_stats = result.fetchall()
+        return service_stats
+
+    @cached_query
+    def get_top_hosts(self, limit):
+        '''the hosts with the most diffs (host_stats, kept by nsnap.py)'''
+        self.clear_errors()
+        top_hosts = []
+        try:
+            result = self.dbcursor.execute('SELECT hosts.id, ip, name, diffs, host_stats.ports, last_changed '
+                                           'FROM host_stats JOIN hosts ON hosts.id=host_stats.id '
+                                           'ORDER BY diffs DESC, last_changed DESC LIMIT ?', (limit,))
+        except Exception as ex:
+            self.error = True
+            self.error_msg = ex
+        else:
+            top_hosts = result.fetchall()
+        return top_hosts
+
+    def get_run_stats(self, profile=None, before=None, limit=0):
+        '''open, new, closed and changed ports of every run (run_stats, kept by nsnap.py), newest first'''
+        self.clear_errors()
+        run_stats = []
+        sql = 'SELECT updated, profile, open_ports, opened, closed, changed, hosts_changed FROM run_stats WHERE 1'
+        if profile:
+            sql += ' AND profile=:profile'
+        if before is not None:
+            sql += ' AND updated<:before'
+        sql += ' ORDER BY updated DESC LIMIT :limit'
+        try:
+            result = self.dbcursor.execute(sql, {'profile': profile, 'before': before, 'limit': limit or -1})
+        except Exception as ex:
+            self.error = True
+            self.error_msg = ex
+        else:
+            run_stats = result.fetchall()
+        return run_stats
+
+    def get_run_counts(self):
+        self.clear_errors()
+        run_counts = []
+        try:
+            result = self.dbcursor.execute("SELECT profile, status, COUNT(*), MAX(updated) FROM runs "
+                                           "GROUP BY profile, status")
+        except Exception as ex:
+            self.error = True
+            self.error_msg = ex
+        else:
+            run_counts = result.fetchall()
+        return run_counts
+
+    def get_run_metrics(self, runid):
+        self.clear_errors()
+        run_metrics = []
+        try:
+            result = self.dbcursor.execute('SELECT name, value FROM run_metrics WHERE run=? ORDER BY name', (runid,))
+        except Exception as ex:
+            self.error = True
+            self.error_msg = ex
+        else:
+            run_metrics = result.fetchall()
+        return run_metrics
+
     def post_diff_comment(self, hostid=0, updated=0, comment=''):
         self.clear_errors()
         hostid = int(hostid)
         updated = int(updated)
+        dbconn = get_connection(readonly=False)
         try:
-            self.dbcursor.execute("UPDATE diffscan SET comment=? WHERE id=? AND updated=?", (comment, hostid, updated))
-            self.dbcommit()
+            dbconn.execute('BEGIN IMMEDIATE;')
+            result = dbconn.execute("UPDATE diffscan SET comment=? WHERE id=? AND updated=?", (comment, hostid, updated))
+            if result.rowcount > 0 and g.get('generation') is not None:
+                dbconn.execute(UPDATE_META_GENERATION)
+            dbconn.execute('COMMIT;')
         except Exception as ex:
+            if dbconn.in_transaction:
+                dbconn.rollback()
             self.error = True
             self.error_msg = ex
         else:
-            if self.dbcursor.rowcount < 1:
+            if result.rowcount < 1:
                 return False
+            g.generation, g.modified = get_generation()
         return True
 
 
 app = Flask(__name__)
 Bootstrap(app)
+app.add_template_filter(datetime.datetime.fromtimestamp, 'fromtimestamp')
 
 
-@app.route('/host')
-def single_host():
-    hostid = request.args.get('hostid', default=0, type=int)
-    host = []
+@app.before_request
+def load_generation():
+    g.request_start = time.perf_counter()
+    # a response that was never sent cannot leave its read transaction to the next request
+    release_connections()
+    g.generation, g.modified = get_generation()
+
+
+@app.after_request
+def observe_latency(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    request_latency.observe(route, time.perf_counter() - g.request_start)
+    return response
+
+
+@app.teardown_request
+def teardown_db(exception):
+    if not g.get('streaming'):
+        release_connections()
+
+
+def error_page(error_msg):
+    g.nocache = True
+    return render_template('error.j2', error_msg=error_msg)
+
+
+def scan_label(timestamp, profile):
+    scan_date = datetime.datetime.fromtimestamp(timestamp)
+    return scan_date if profile == 'default' else '{} ({})'.format(scan_date, profile)
+
+
+def parse_time(value, end_of_day=False):
+    '''unix timestamp or an ISO date/time, date-only values cover the whole day when end_of_day is set'''
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if end_of_day and len(value) == 10:
+        parsed += datetime.timedelta(days=1, seconds=-1)
+    return int(parsed.timestamp())
+
+
+def ip_key(ip):
+    '''the same sortable address form nsnap.py stores in hosts.ipkey'''
+    address = ipaddress.ip_address(ip)
+    return '{}:{}'.format(address.version, address.packed.hex())
+
+
+def parse_search(query):
+    '''"service:ssh state:open net:10.1.0.0/16 web" -> ({name: [values], 'text': [free text]}, errors)'''
+    search = {}
+    errors = []
+    for term in query.split():
+        name, separator, value = term.partition(':')
+        if not separator or name not in SEARCH_FIELDS or not value:
+            name, value = 'text', term
+        elif name == 'port':
+            if not value.isdigit():
+                errors.append('port must be a number: {}'.format(value))
+                continue
+            value = int(value)
+        elif name == 'net':
+            try:
+                network = ipaddress.ip_network(value, strict=False)
+            except ValueError:
+                errors.append('not a network: {}'.format(value))
+                continue
+            value = (ip_key(network[0]), ip_key(network[-1]))
+        elif name in ('since', 'until'):
+            value = parse_time(value, end_of_day=(name == 'until'))
+            if value is None:
+                errors.append('not a date: {}'.format(term))
+                continue
+        search.setdefault(name, []).append(value)
+    return search, errors
+
+
+def search_sql(kind, search, fts):
+    '''(" AND ..." conditions, parameters) of a parsed search for search_services/search_diffs,
+       host and text terms use the FTS5 index (prefix matches) when it exists, LIKE otherwise'''
+    conditions = []
+    params = {}
+    for name, values in search.items():
+        for idx, value in enumerate(values):
+            param = '{}{}'.format(name, idx)
+            if name == 'net':
+                conditions.append(SEARCH_NET.format(param))
+                params[param + '_first'], params[param + '_last'] = value
+                continue
+            if name in ('host', 'text'):
+                condition = SEARCH_HOST[fts].format(param)
+                if name == 'text' and kind == 'diffs':
+                    condition = '({} OR {})'.format(condition, SEARCH_DIFF_TEXT[fts].format(param))
+                value = '"{}"*'.format(value.replace('"', '""')) if fts else '%{}%'.format(value)
+            elif name in SEARCH_CONDITIONS[kind]:
+                condition = SEARCH_CONDITIONS[kind][name].format(param)
+            else:
+                continue
+            conditions.append(condition)
+            params[param] = value
+    return ''.join(' AND ' + condition for condition in conditions), params
+
+
+def get_filters():
+    filters = {}
+    for name in ('host', 'protocol', 'service', 'state', 'profile'):
+        value = request.args.get(name, '').strip()
+        if value:
+            filters[name] = value
+    port = request.args.get('port', type=int)
+    if port is not None:
+        filters['port'] = port
+    for name in ('since', 'until'):
+        value = parse_time(request.args.get(name, ''), end_of_day=(name == 'until'))
+        if value is not None:
+            filters[name] = value
+    return filters
+
+
+def get_cursor(name, types):
+    '''keyset pagination cursor: the key of the last row of the previous page, "a:b:c"'''
+    parts = request.args.get(name, '').split(':', len(types) - 1)
+    try:
+        return tuple(value_type(part) for value_type, part in zip(types, parts)) if len(parts) == len(types) else None
+    except ValueError:
+        return None
+
+
+def get_page_size():
+    return min(max(request.args.get('limit', default=PAGE_SIZE, type=int), 1), PAGE_SIZE_MAX)
+
+
+def next_page_url(name, key):
+    args = request.args.to_dict()
+    args[name] = ':'.join(str(part) for part in key)
+    args.update(request.view_args)
+    return url_for(request.endpoint, **args)
+
+
+def first_page_url(name):
+    '''the current page without its cursor, filters and limit are kept'''
+    args = request.args.to_dict()
+    args.pop(name, None)
+    args.update(request.view_args)
+    return url_for(request.endpoint, **args)
+
+
+app.add_template_global(first_page_url)
+
+
+class Page:
+    '''iterates over at most size rows of a size + 1 row query, next_url is set
+       once the rows are exhausted and a next page exists'''
+    def __init__(self, rows, size, cursor_name, cursor_key):
+        self.rows = rows
+        self.size = size
+        self.cursor_name = cursor_name
+        self.cursor_key = cursor_key
+        self.next_url = ''
+
+    def __iter__(self):
+        last = None
+        for idx, row in enumerate(self.rows):
+            if idx == self.size:
+                self.next_url = next_page_url(self.cursor_name, self.cursor_key(last))
+                break
+            last = row
+            yield row
+
+
+def port_timeline(rows):
+    '''get_host_timeline rows grouped by (port, protocol, profile): the latest state and service,
+       when the port was first and last seen, the first scan it was missing from (None while it
+       is still there) and its intervals, newest first'''
+    timeline = []
+    for (port, protocol, profile), intervals in itertools.groupby(rows, key=lambda row: row[:3]):
+        intervals = [dict(zip(('state', 'service', 'first_seen', 'last_seen', 'missing_since'), row[3:]))
+                     for row in intervals]
+        timeline.append({'port': port, 'protocol': protocol, 'profile': profile, 'state': intervals[-1]['state'],
+                         'service': intervals[-1]['service'], 'first_seen': intervals[0]['first_seen'],
+                         'last_seen': intervals[-1]['last_seen'], 'missing_since': intervals[-1]['missing_since'],
+                         'intervals': intervals[::-1]})
+    return timeline
+
+
+def host_history(hostid):
+    '''(host or None when it does not exist, port timeline, diffs, DB error message or None)'''
     db = DB()
     if not db.error:
-        host = db.get_hosts(hostid)[0]
-    if db.error:
-        return render_template('error.j2', error_msg=db.error_msg)
-    last_scan = []
-    last_scan = db.get_services(hostid)
-    if db.error:
-        return render_template('error.j2', error_msg=db.error_msg)
-    if len(last_scan) > 0:
-        last_scan_date = str(datetime.datetime.fromtimestamp(last_scan[0][1]))
-    else:
-        last_scan_date = ''
-
-    diff_history = db.get_diff_history(hostid)
+        host = db.get_hosts(hostid)
+    if not db.error:
+        timeline = port_timeline(db.get_host_timeline(hostid))
+    if not db.error:
+        diff_history = db.get_diff_history(hostid)
     if db.error:
-        return render_template('error.j2', error_msg=db.error_msg)
+        return None, [], [], db.error_msg
     db.dbclose()
-    diff_history = [list(diff) for diff in diff_history]
-    for idx, diff in enumerate(diff_history):
-        diff_history[idx][2] = diff[2].replace('\n', '<br/>')
-        diff_history[idx].append(datetime.datetime.fromtimestamp(diff_history[idx][1]))
-    return render_template('hosts.j2', host=host, last_scan=last_scan,
-                           diff_history=diff_history, last_scan_date=last_scan_date)
+    return (host[0] if host else None), timeline, diff_history, None
+
+
+@app.route('/host')
+@cached_page
+def single_host():
+    hostid = request.args.get('hostid', default=0, type=int)
+    host, timeline, diff_history, error_msg = host_history(hostid)
+    if error_msg:
+        return error_page(error_msg)
+    if host is None:
+        return error_page('host {} does not exist'.format(hostid))
+    last_seen = max((port['last_seen'] for port in timeline if port['last_seen'] is not None), default=None)
+    return render_template('hosts.j2', host=host, timeline=timeline, diff_history=diff_history, last_seen=last_seen)
+
+
+@app.route('/api/host')
+@cached_page
+def api_host():
+    hostid = request.args.get('hostid', default=0, type=int)
+    host, timeline, diff_history, error_msg = host_history(hostid)
+    if error_msg:
+        g.nocache = True
+        return jsonify({'host_id': hostid, 'errors': [str(error_msg)]}), 500
+    if host is None:
+        return jsonify({'host_id': hostid, 'errors': ['host does not exist']}), 404
+    return jsonify({'host_id': hostid, 'ip': host[1], 'name': host[2], 'ports': timeline,
+                    'diffs': [dict(zip(('updated', 'diff', 'comment'), diff[1:4])) for diff in diff_history]})
 
 
 @app.route('/services')
 @app.route('/services/<timestamp>')
+@cached_page
 def services(timestamp=0):
     all_hosts = []
     db = DB()
@@ -220,27 +1251,30 @@ def services(timestamp=0):
     if not db.error:
         all_hosts = db.get_hosts()
     if db.error:
-        return render_template('error.j2', error_msg=db.error_msg)
+        return error_page(db.error_msg)
     all_hosts_by_id = {}
     for host in all_hosts:
         all_hosts_by_id[host[0]] = host
-    all_services = db.get_services(updated=timestamp)
-    if db.error:
-        return render_template('error.j2', error_msg=db.error_msg)
     scan_dates = db.get_fullscan_dates()
     if db.error:
-        return render_template('error.j2', error_msg=db.error_msg)
-    db.dbclose()
+        return error_page(db.error_msg)
+    filters = get_filters()
+    page_size = get_page_size()
+    all_services = db.iter_services(updated=timestamp, filters=filters,
+                                    after=get_cursor('after', (int, int, str)), limit=page_size + 1)
+    if db.error:
+        return error_page(db.error_msg)
+    all_services = Page(all_services, page_size, 'after', lambda service: (service[0], service[2], service[3]))
     scan_date = '0'
     if timestamp != 0:
         scan_date = str(datetime.datetime.fromtimestamp(timestamp))
-    return render_template('services.j2', all_hosts=all_hosts_by_id,
-                           all_services=all_services, scan_dates=scan_dates,
-                           scan_date=scan_date)
+    return stream_template('services.j2', all_hosts=all_hosts_by_id,
+                           all_services=all_services, scan_dates=scan_dates, scan_date=scan_date)
 
 
 @app.route('/diffs', methods=['GET', 'POST'])
 @app.route('/diffs/<timestamp>')
+@cached_page
 def diffs(timestamp=0):
     updated_result = 0
     if request.method == 'POST':
@@ -252,7 +1286,7 @@ def diffs(timestamp=0):
         if not db.error:
             result = db.post_diff_comment(hostid, timestamp, comment)
         if db.error:
-            return render_template('error.j2', error_msg=db.error_msg)
+            return error_page(db.error_msg)
         if result:
             updated_result = 1
         else:
@@ -265,26 +1299,46 @@ def diffs(timestamp=0):
     if not db.error:
         all_hosts = db.get_hosts()
     if db.error:
-        return render_template('error.j2', error_msg=db.error_msg)
+        return error_page(db.error_msg)
     all_hosts_by_id = {}
     for host in all_hosts:
         all_hosts_by_id[host[0]] = host
-    all_diffs = db.get_diffs(updated=timestamp)
-    if db.error:
-        return render_template('error.j2', error_msg=db.error_msg)
     diff_dates = db.get_diffscan_dates()
     if db.error:
-        return render_template('error.j2', error_msg=db.error_msg)
-    db.dbclose()
-    all_diffs = [list(diff) for diff in all_diffs]
-    for idx, _ in enumerate(all_diffs):
-        all_diffs[idx][2] = all_diffs[idx][2].replace('\n', '<br/>')
-        all_diffs[idx].append(datetime.datetime.fromtimestamp(all_diffs[idx][1]))
+        return error_page(db.error_msg)
+    filters = get_filters()
+    page_size = get_page_size()
+    all_diffs = db.iter_diffs(updated=timestamp, filters=filters,
+                              before=get_cursor('before', (int, int)), limit=page_size + 1)
+    if db.error:
+        return error_page(db.error_msg)
+    all_diffs = Page(all_diffs, page_size, 'before', lambda diff: (diff[1], diff[0]))
     diff_date = '0'
     if timestamp != 0:
         diff_date = str(datetime.datetime.fromtimestamp(timestamp))
-    return render_template('diffs.j2', all_hosts=all_hosts_by_id, all_diffs=all_diffs,
-                           diff_dates=diff_dates, diff_date=diff_date, updated_result=updated_result)
+    # the first page of the latest diffs is updated live (see EventServer)
+    live_updates = EVENTS_PORT is not None and timestamp == 0 and not request.args
+    return stream_template('diffs.j2', all_hosts=all_hosts_by_id, all_diffs=all_diffs,
+                           diff_dates=diff_dates, diff_date=diff_date, updated_result=updated_result,
+                           live_updates=live_updates, events_url=EVENTS_URL, events_port=EVENTS_PORT)
+
+
+@app.route('/api/diffs')
+@cached_page
+def api_diffs():
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'errors': ['since=GENERATION is required']}), 400
+    db = DB()
+    if not db.error:
+        generation, new_diffs = db.get_new_diffs(since, PAGE_SIZE_MAX)
+    if db.error:
+        g.nocache = True
+        return jsonify({'since': since, 'errors': [str(db.error_msg)]}), 500
+    db.dbclose()
+    return jsonify({'since': since, 'generation': generation,
+                    'diffs': [dict(zip(('host_id', 'ip', 'name', 'updated', 'diff', 'comment'), diff))
+                              for diff in new_diffs]})
 
 
 @app.route('/comment/<hostid>/<timestamp>')
@@ -295,10 +1349,10 @@ def do_comment(hostid=0, timestamp=0):
     if not db.error:
         host = db.get_hosts(hostid)[0]
     if db.error:
-        return render_template('error.j2', error_msg=db.error_msg)
+        return error_page(db.error_msg)
     thediff = db.get_single_diff(hostid, timestamp)
     if db.error:
-        return render_template('error.j2', error_msg=db.error_msg)
+        return error_page(db.error_msg)
     db.dbclose()
     thediff = list(thediff)
     thediff[2] = thediff[2].replace('\n', '<br/>')
@@ -306,16 +1360,278 @@ def do_comment(hostid=0, timestamp=0):
     return render_template('comment.j2', host=host, thediff=thediff)
 
 
+def search_results(search, limit):
+    '''(services, diffs, db error message or None) of a parsed /search query'''
+    db = DB()
+    if not db.error:
+        services = db.search_services(search, limit)
+    if not db.error:
+        diffs = db.search_diffs(search, limit)
+    if db.error:
+        return [], [], db.error_msg
+    db.dbclose()
+    return services, diffs, None
+
+
+@app.route('/search')
+@cached_page
+def search():
+    query = request.args.get('q', '').strip()
+    search, errors = parse_search(query)
+    services = diffs = []
+    if errors:
+        g.nocache = True
+    elif search:
+        services, diffs, error_msg = search_results(search, get_page_size())
+        if error_msg:
+            return error_page(error_msg)
+    diffs = [list(diff) + [datetime.datetime.fromtimestamp(diff[3])] for diff in diffs]
+    return render_template('search.j2', query=query, services=services, diffs=diffs, errors=errors,
+                           limit=get_page_size())
+
+
+@app.route('/api/search')
+@cached_page
+def api_search():
+    query = request.args.get('q', '').strip()
+    search, errors = parse_search(query)
+    if errors or not search:
+        g.nocache = True
+        return jsonify({'query': query, 'errors': errors or ['empty query']}), 400
+    services, diffs, error_msg = search_results(search, get_page_size())
+    if error_msg:
+        g.nocache = True
+        return jsonify({'query': query, 'errors': [str(error_msg)]}), 500
+    return jsonify({'query': query,
+                    'services': [dict(zip(('host_id', 'ip', 'name', 'port', 'protocol', 'state', 'service',
+                                           'profile', 'first_seen'), service)) for service in services],
+                    'diffs': [dict(zip(('host_id', 'ip', 'name', 'updated', 'port', 'protocol', 'old_state',
+                                        'old_service', 'new_state', 'new_service'), diff)) for diff in diffs]})
+
+
+def compare_scans(old, new, hostid):
+    '''(changes, scan dates, DB error message or None) between two scan timestamps'''
+    db = DB()
+    if not db.error:
+        scan_dates = db.get_fullscan_dates()
+    if not db.error:
+        old_snapshot = get_snapshot(db, old)
+    if not db.error:
+        new_snapshot = get_snapshot(db, new)
+    if db.error:
+        return [], {}, db.error_msg
+    db.dbclose()
+    return old_snapshot.compare(new_snapshot, hostid), scan_dates, None
+
+
+@app.route('/compare')
+@cached_page
+def compare():
+    old = request.args.get('from', default=0, type=int)
+    new = request.args.get('to', default=0, type=int)
+    hostid = request.args.get('hostid', default=0, type=int)
+    changes, scan_dates, error_msg = compare_scans(old, new, hostid)
+    if error_msg:
+        return error_page(error_msg)
+    all_hosts = {}
+    if changes:
+        db = DB()
+        if not db.error:
+            all_hosts = {host[0]: host for host in db.get_hosts()}
+        if db.error:
+            return error_page(db.error_msg)
+        db.dbclose()
+    return render_template('compare.j2', changes=changes, all_hosts=all_hosts, scan_dates=scan_dates,
+                           old=old, new=new, hostid=hostid)
+
+
+@app.route('/api/compare')
+@cached_page
+def api_compare():
+    old = request.args.get('from', default=0, type=int)
+    new = request.args.get('to', default=0, type=int)
+    hostid = request.args.get('hostid', default=0, type=int)
+    changes, _, error_msg = compare_scans(old, new, hostid)
+    if error_msg:
+        g.nocache = True
+        return jsonify({'from': old, 'to': new, 'errors': [str(error_msg)]}), 500
+    return jsonify({'from': old, 'to': new,
+                    'changes': [dict(zip(('host_id', 'port', 'protocol', 'old_state', 'old_service',
+                                          'new_state', 'new_service'), change)) for change in changes]})
+
+
+def export_chunks(fmt, columns, rows):
+    '''rows as CSV (with a header line) or NDJSON, in chunks of about EXPORT_CHUNK characters.
+       The status is sent before the rows are read: a DB error ends the export early with a last
+       error line ("error,MESSAGE" or {"error": MESSAGE}).'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(columns)
+    try:
+        for row in rows:
+            if fmt == 'csv':
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(columns, row))) + '\n')
+            if buffer.tell() >= EXPORT_CHUNK:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    except Exception as ex:
+        if fmt == 'csv':
+            writer.writerow(['error', ex])
+        else:
+            buffer.write(json.dumps({'error': str(ex)}) + '\n')
+    yield buffer.getvalue()
+
+
+@app.route('/export/<any(services, diffs):kind>.<any(ndjson, csv):fmt>')
+@conditional_page
+def export(kind, fmt):
+    '''streams a whole snapshot (timestamp=N, the current state by default) or the changed ports
+       history, both accept the Services/Diffs page filters. Rows are read from the cursor while
+       they are sent and never collected (not even by the page cache), memory use does not grow
+       with the number of ports.'''
+    db = DB()
+    if not db.error:
+        all_hosts = {host[0]: host for host in db.get_hosts()}
+    if db.error:
+        return error_page(db.error_msg)
+    filters = get_filters()
+    if kind == 'services':
+        rows = db.iter_services(updated=request.args.get('timestamp', default=0, type=int), filters=filters)
+    else:
+        rows = db.iter_diffports(filters)
+    # hosts of archived runs may be gone from the live DB
+    rows = ((id,) + all_hosts.get(id, (id, '', ''))[1:3] + (updated,) + tuple(row) for id, updated, *row in rows)
+    if db.error:
+        return error_page(db.error_msg)
+    return stream_response(export_chunks(fmt, EXPORT_COLUMNS[kind], rows), mimetype=EXPORT_MIMETYPES[fmt])
+
+
+def parse_upload(header):
+    '''upload metadata from the X-Nsnap-Run header, None when it is missing or invalid'''
+    try:
+        meta = json.loads(header)
+        valid = all(UPLOAD_NAME.fullmatch(meta[name]) for name in ('agent', 'upload', 'profile')) and \
+            isinstance(meta['timestamp'], int) and isinstance(meta['target'], str) and isinstance(meta['options'], str)
+    except (ValueError, KeyError, TypeError):
+        return None
+    return meta if valid else None
+
+
+@app.route('/api/ingest', methods=['POST'])
+def api_ingest():
+    '''accepts the gzip compressed nmap results of a scanner agent, nsnap.py stores them later'''
+    meta = parse_upload(request.headers.get('X-Nsnap-Run', ''))
+    if meta is None:
+        return jsonify({'error': 'missing or invalid X-Nsnap-Run header'}), 400
+    token = AGENT_TOKENS.get(meta['agent'])
+    if token is None or not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer {}'.format(token)):
+        return jsonify({'error': 'unknown agent or wrong token'}), 401
+    if request.content_length is None or request.content_length > INGEST_MAX_BYTES:
+        return jsonify({'error': 'missing Content-Length or upload bigger than {} bytes'.format(INGEST_MAX_BYTES)}), 413
+    if request.stream.read(2) != b'\x1f\x8b':
+        return jsonify({'error': 'not gzip compressed'}), 400
+    upload_file = os.path.join(INBOX_DIR, INBOX_SEPARATOR.join((meta['agent'], meta['upload'])))
+    try:
+        with open(upload_file + '.tmp', 'wb') as spooled:
+            spooled.write(b'\x1f\x8b')
+            shutil.copyfileobj(request.stream, spooled)
+        os.replace(upload_file + '.tmp', upload_file + '.xml.gz')
+        with open(upload_file + '.tmp', 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(upload_file + '.tmp', upload_file + '.json')
+    except OSError as ex:
+        return jsonify({'error': 'cannot save the upload: {}'.format(ex)}), 500
+    return jsonify({'agent': meta['agent'], 'upload': meta['upload'], 'status': 'queued'}), 202
+
+
+@app.route('/metrics')
+def metrics():
+    '''Prometheus metrics: run catalog, phase timings and counters of the last run
+       of every scan profile, request latencies'''
+    db = DB()
+    if not db.error:
+        run_counts = db.get_run_counts()
+    if not db.error:
+        last_runs = db.get_last_runs()
+    run_metrics = {}
+    for last_run in last_runs if not db.error else []:
+        run_metrics[last_run[0]] = db.get_run_metrics(last_run[1])
+        if db.error:
+            break
+    if db.error:
+        return Response('# error: {}\n'.format(db.error_msg), status=500, mimetype='text/plain')
+    db.dbclose()
+
+    lines = ['# TYPE nsnap_runs_total counter']
+    for profile, status, count, _ in run_counts:
+        lines.append('nsnap_runs_total{{profile="{}",status="{}"}} {}'.format(profile, status, count))
+    lines.append('# TYPE nsnap_last_success_timestamp_seconds gauge')
+    lines += ['nsnap_last_success_timestamp_seconds{{profile="{}"}} {}'.format(profile, updated)
+              for profile, status, _, updated in run_counts if status == 'ok']
+    gauges = {'nsnap_last_run_timestamp_seconds': [], 'nsnap_last_run_success': [],
+              'nsnap_last_run_duration_seconds': [], 'nsnap_last_run_phase_seconds': []}
+    counters = {}
+    for profile, _, updated, status, duration in last_runs:
+        gauges['nsnap_last_run_timestamp_seconds'].append(('profile="{}"'.format(profile), updated))
+        gauges['nsnap_last_run_success'].append(('profile="{}"'.format(profile), int(status == 'ok')))
+        gauges['nsnap_last_run_duration_seconds'].append(('profile="{}"'.format(profile), duration or 0))
+        for name, value in run_metrics[profile]:
+            if name.endswith('_seconds'):
+                gauges['nsnap_last_run_phase_seconds'].append(
+                    ('profile="{}",phase="{}"'.format(profile, name[:-len('_seconds')]), value))
+            else:
+                counters.setdefault('nsnap_last_run_{}'.format(name), []).append(('profile="{}"'.format(profile), value))
+    gauges.update(counters)
+    for name, samples in gauges.items():
+        if samples:
+            lines.append('# TYPE {} gauge'.format(name))
+            lines += ['{}{{{}}} {}'.format(name, labels, value) for labels, value in samples]
+    lines += request_latency.render('nsnap_http_request_duration_seconds')
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/trends')
+@cached_page
+def trends():
+    profile = request.args.get('profile', '').strip()
+    page_size = get_page_size()
+    db = DB()
+    if not db.error:
+        run_stats = db.get_run_stats(profile, get_cursor('before', (int,)), page_size + 1)
+    if db.error:
+        return error_page(db.error_msg)
+    db.dbclose()
+    next_url = ''
+    if len(run_stats) > page_size:
+        run_stats = run_stats[:page_size]
+        next_url = next_page_url('before', (run_stats[-1][0],))
+    max_ports = max([run[2] for run in run_stats] + [1])
+    return render_template('trends.j2', run_stats=run_stats, max_ports=max_ports, profile=profile,
+                           next_url=next_url)
+
+
 @app.route('/')
+@cached_page
 def overview():
     all_hosts = []
     db = DB()
     if not db.error:
         all_hosts = db.get_hosts()
+    if not db.error:
+        service_stats = db.get_service_stats()
+    if not db.error:
+        top_hosts = db.get_top_hosts(TOP_HOSTS)
+    if not db.error:
+        run_stats = db.get_run_stats(limit=TOP_HOSTS)
     if db.error:
-        return render_template('error.j2', error_msg=db.error_msg)
+        return error_page(db.error_msg)
     db.dbclose()
-    return render_template('overview.j2', all_hosts=all_hosts)
+    return render_template('overview.j2', all_hosts=all_hosts, service_stats=service_stats,
+                           top_hosts=top_hosts, run_stats=run_stats)
 
 
 if __name__ == "__main__":
@@ -323,5 +1639,7 @@ if __name__ == "__main__":
         raise SystemExit('DB file does not exist')
     # just in case:
     # app.run(host=HOST, port=PORT, debug=True)
+    if EVENTS_PORT is not None:
+        EventServer().start()
     from waitress import serve
     serve(app, host=HOST, port=PORT)
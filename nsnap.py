@@ -6,11 +6,31 @@
 #
 
 import os
+import re
+import math
+import time
+import json
+import gzip
+import lzma
+import shutil
+import socket
+import hashlib
+import fcntl
+import signal
+import asyncio
+import argparse
+import itertools
+import contextlib
 import logging
 import datetime
-import subprocess
-import xmltodict
+import functools
+import ipaddress
 import sqlite3
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
 
 # ---------------------------------------------------- check these
 DBDIR = '/var/lib/nsnap'
@@ -19,10 +39,61 @@ NMAP_DIR = '/var/lib/nsnap/scans'
 LOG_FILE = '/var/log/nsnap.log'
 NMAP_TARGET = '192.168.201.22-24'
 NMAP_OPTS = ['-sT']
+NMAP_SHARDS = 1
+NMAP_WORKERS = 4
+# named scan profiles: target, nmap options, number of shards and, for the daemon mode,
+# the interval between runs in seconds (profiles without an interval only run on demand)
+SCAN_PROFILES = {
+    'default': {'target': NMAP_TARGET, 'options': NMAP_OPTS, 'shards': NMAP_SHARDS, 'interval': 24 * 3600},
+    # 'dmz': {'target': '192.168.100.0/24', 'options': ['-sT', '-p', '22,80,443,3389'], 'interval': 3600},
+    # 'full': {'target': '192.168.0.0/16', 'options': ['-sT', '-p-'], 'shards': 16, 'interval': 7 * 24 * 3600},
+    # pipelined: the target is scanned in 256 chunks (up to "shards" at a time), finished chunks are
+    # stored while the next ones are scanning and an interrupted run resumes from the last stored chunk
+    # 'estate': {'target': '10.0.0.0/8', 'options': ['-sT'], 'shards': 4, 'chunks': 256, 'interval': 7 * 24 * 3600},
+    # adaptive: a host discovery sweep finds live hosts, only new, recently changed (diffs within stable_days),
+    # unresponsive and overdue hosts are scanned on every run, stable ones in a rotation that covers all of
+    # them at least every coverage_days. Adaptive profiles are not pipelined.
+    # 'servers': {'target': '10.1.0.0/16', 'options': ['-sT', '-p-'], 'shards': 4, 'interval': 24 * 3600,
+    #             'adaptive': {'stable_days': 14, 'coverage_days': 7, 'discovery': ['-sn']}},
+    # piped: nmap writes its XML to stdout (-oX -), it is compressed into scan_*.xml.gz and parsed while
+    # nmap is running, parsed hosts are stored every PIPE_BATCH hosts or PIPE_FLUSH seconds. Not for chunks.
+    # 'campus': {'target': '172.16.0.0/16', 'options': ['-sT'], 'shards': 4, 'pipe': True, 'interval': 24 * 3600},
+}
+PIPELINE_QUEUE = 2
+PIPE_BATCH = 1000
+PIPE_FLUSH = 60
+PIPE_READ = 64 * 1024
+ADAPTIVE_DEFAULTS = {'stable_days': 14, 'coverage_days': 7, 'discovery': ['-sn']}
+NMAP_TARGETS_MAX = 64
+# agent mode (--agent): profiles are scanned here and the compressed results are sent to the
+# central nsnap-web.py (AGENT_URL) instead of the local DB. Results wait in SPOOL_DIR until
+# they are accepted, a failed upload is retried AGENT_RETRIES times and then on the next run.
+AGENT_NAME = socket.gethostname().split('.')[0]
+AGENT_URL = 'http://nsnap.example.org:5000/api/ingest'
+AGENT_TOKEN = ''
+AGENT_RETRIES = 3
+AGENT_TIMEOUT = 60
+SPOOL_DIR = '/var/lib/nsnap/spool'
+# central node: uploads accepted by nsnap-web.py (its INBOX_DIR) are stored by nsnap.py,
+# as profile AGENT/PROFILE, every INBOX_POLL seconds in the daemon mode and after one-off runs
+INBOX_DIR = '/var/lib/nsnap/inbox'
+INBOX_POLL = 60
+# retention, applied after the runs: raw scan results (scan_*.xml) are kept for the last KEEP_XML runs of
+# every profile, older ones are compressed (XML_COMPRESSION: 'gz' or 'xz') and removed after
+# KEEP_COMPRESSED_DAYS (None: kept). Runs older than ARCHIVE_DAYS (None: never) are moved with their
+# history into one archive DB per ARCHIVE_PERIOD ('year' or 'month') next to the DB, keep it longer than
+# the stable_days of adaptive profiles. Up to VACUUM_PAGES free DB pages are returned to the file system.
+KEEP_XML = 10
+XML_COMPRESSION = 'gz'
+KEEP_COMPRESSED_DAYS = None
+ARCHIVE_DAYS = None
+ARCHIVE_PERIOD = 'year'
+VACUUM_PAGES = 1000
 
 NMAP_PATH = '/usr/bin/nmap'
-NDIFF_PATH = '/usr/bin/ndiff'
 DBPATH = '{}/{}'.format(DBDIR, DBFILE)
+DB_TIMEOUT = 300
+INGEST_BATCH = 5000
 
 # ---------------------------------------------------- db schema
 CREATE_TABLE_HOSTS = '''CREATE TABLE IF NOT EXISTS hosts (
@@ -31,18 +102,203 @@ CREATE_TABLE_HOSTS = '''CREATE TABLE IF NOT EXISTS hosts (
     name text,
     UNIQUE(ip)
 );'''
-CREATE_INDEX_HOSTS_IP = 'CREATE INDEX hosts_ip_idx ON hosts(ip);'
-CREATE_TABLE_FULLSCAN = '''CREATE TABLE IF NOT EXISTS fullscan (
+CREATE_INDEX_HOSTS_IP = 'CREATE INDEX IF NOT EXISTS hosts_ip_idx ON hosts(ip);'
+CREATE_INDEX_HOSTS_NAME = 'CREATE INDEX IF NOT EXISTS hosts_name_idx ON hosts(name);'
+# every (host, port, protocol) observation is kept as an interval: first_seen is the first
+# scan it was found in, last_seen the last one before it changed or disappeared (NULL while
+# it is still there), so unchanged services do not add rows on every scan
+CREATE_TABLE_OBSERVATIONS = '''CREATE TABLE IF NOT EXISTS observations (
     id INTEGER NOT NULL,
+    port INTEGER NOT NULL,
+    protocol TEXT NOT NULL,
+    state TEXT NOT NULL,
+    service TEXT,
+    first_seen INTEGER NOT NULL,
+    last_seen INTEGER,
+    profile TEXT NOT NULL DEFAULT 'default',
+    FOREIGN KEY(id) REFERENCES hosts(id)
+);'''
+CREATE_INDEX_OBSERVATIONS_LAST_SEEN = 'CREATE INDEX IF NOT EXISTS observations_last_seen_idx ON observations(last_seen, id);'
+CREATE_INDEX_OBSERVATIONS_ID_LAST_SEEN = 'CREATE INDEX IF NOT EXISTS observations_id_last_seen_idx ON observations(id, last_seen);'
+CREATE_INDEX_OBSERVATIONS_PORT = 'CREATE INDEX IF NOT EXISTS observations_port_idx ON observations(port, protocol);'
+CREATE_INDEX_OBSERVATIONS_PROFILE = '''CREATE INDEX IF NOT EXISTS observations_profile_idx
+    ON observations(profile, last_seen, id);'''
+
+# one row per nsnap.py run, updated is the timestamp its snapshot is stored under
+# (unique, also across profiles)
+CREATE_TABLE_RUNS = '''CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
     updated INTEGER NOT NULL,
+    target TEXT,
+    options TEXT,
+    hosts INTEGER,
+    ports INTEGER,
+    changed INTEGER,
+    duration REAL,
+    status TEXT NOT NULL,
+    profile TEXT NOT NULL DEFAULT 'default',
+    UNIQUE(updated)
+);'''
+CREATE_INDEX_RUNS_STATUS_UPDATED = 'CREATE INDEX IF NOT EXISTS runs_status_updated_idx ON runs(status, updated);'
+CREATE_INDEX_RUNS_PROFILE = 'CREATE INDEX IF NOT EXISTS runs_profile_idx ON runs(profile, status, updated);'
+
+# columns added to existing tables by later versions
+ADD_COLUMNS = [('observations', 'profile', "TEXT NOT NULL DEFAULT 'default'"),
+               ('runs', 'profile', "TEXT NOT NULL DEFAULT 'default'"),
+               ('hosts', 'ipkey', 'TEXT'),
+               ('runs', 'archive', 'TEXT'),
+               ('runs', 'generation', 'INTEGER')]
+
+INSERT_OBSERVATION_INTERVAL = '''INSERT INTO observations(id, port, protocol, state, service, first_seen, last_seen)
+    VALUES(?, ?, ?, ?, ?, ?, ?);'''
+
+# per-run phase timings (*_seconds) and counters
+CREATE_TABLE_RUN_METRICS = '''CREATE TABLE IF NOT EXISTS run_metrics (
+    run INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY(run, name),
+    FOREIGN KEY(run) REFERENCES runs(id)
+);'''
+
+# generation is bumped on every change visible in nsnap-web.py (new run, edited comment),
+# modified is the unix time of the last bump. Finished runs keep the generation they bumped
+# (runs.generation), so nsnap-web.py can tell which runs finished since the generation it saw.
+CREATE_TABLE_META = '''CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);'''
+CREATE_INDEX_RUNS_GENERATION = 'CREATE INDEX IF NOT EXISTS runs_generation_idx ON runs(generation);'
+INSERT_META_DEFAULTS = "INSERT OR IGNORE INTO meta VALUES('generation', 0), ('modified', strftime('%s', 'now'));"
+UPDATE_META_GENERATION = '''UPDATE meta SET value=CASE key WHEN 'generation' THEN value + 1
+    ELSE strftime('%s', 'now') END WHERE key IN ('generation', 'modified');'''
+
+CREATE_TEMP_TABLE_CURRENT_SCAN = '''CREATE TEMP TABLE IF NOT EXISTS current_scan (
+    id INTEGER NOT NULL,
+    port INTEGER NOT NULL,
+    protocol TEXT NOT NULL,
+    state TEXT NOT NULL,
+    service TEXT,
+    PRIMARY KEY(id, port, protocol)
+) WITHOUT ROWID;'''
+# fingerprints of all hosts of the current scan, hosts with the same fingerprint as in their
+# last scan (unchanged_hosts) are not written to current_scan and are left out of the diff
+CREATE_TEMP_TABLE_CURRENT_HOSTS = '''CREATE TEMP TABLE IF NOT EXISTS current_hosts (
+    id INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL
+);'''
+CREATE_TEMP_TABLE_UNCHANGED_HOSTS = 'CREATE TEMP TABLE IF NOT EXISTS unchanged_hosts (id INTEGER PRIMARY KEY);'
+
+# pipelined runs: every scanned chunk is committed to pending_scan and checkpointed in run_chunks,
+# pending rows are moved to current_scan and removed when the run is finished
+CREATE_TABLE_PENDING_SCAN = '''CREATE TABLE IF NOT EXISTS pending_scan (
+    run INTEGER NOT NULL,
+    id INTEGER NOT NULL,
     port INTEGER NOT NULL,
     protocol TEXT NOT NULL,
     state TEXT NOT NULL,
     service TEXT,
+    PRIMARY KEY(run, id, port, protocol)
+) WITHOUT ROWID;'''
+CREATE_TABLE_PENDING_HOSTS = '''CREATE TABLE IF NOT EXISTS pending_hosts (
+    run INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY(run, id)
+) WITHOUT ROWID;'''
+CREATE_TABLE_RUN_CHUNKS = '''CREATE TABLE IF NOT EXISTS run_chunks (
+    run INTEGER NOT NULL,
+    chunk INTEGER NOT NULL,
+    targets TEXT NOT NULL,
+    hosts INTEGER NOT NULL,
+    ports INTEGER NOT NULL,
+    PRIMARY KEY(run, chunk),
+    FOREIGN KEY(run) REFERENCES runs(id)
+);'''
+
+# time of the last port scan of every host per profile (adaptive runs schedule their rescans with it)
+# and the fingerprint of the services it was confirmed with, NULL when it had none
+CREATE_TABLE_HOST_SCANS = '''CREATE TABLE IF NOT EXISTS host_scans (
+    id INTEGER NOT NULL,
+    profile TEXT NOT NULL,
+    scanned INTEGER NOT NULL,
+    fingerprint TEXT,
+    PRIMARY KEY(id, profile),
     FOREIGN KEY(id) REFERENCES hosts(id)
-    );'''
-CREATE_INDEX_FULLSCAN_UPDATED = 'CREATE INDEX fullscan_updated_idx ON fullscan(updated);'
-CREATE_INDEX_FULLSCAN_ID_UPDATED = 'CREATE INDEX fullscan_id_updated_idx ON fullscan(id, updated);'
+) WITHOUT ROWID;'''
+# addresses scanned by a partial (adaptive) run, other hosts keep their observations
+CREATE_TEMP_TABLE_SCAN_SCOPE = 'CREATE TEMP TABLE IF NOT EXISTS scan_scope (ip TEXT PRIMARY KEY) WITHOUT ROWID;'
+
+# agent uploads already stored, a retried upload is not stored twice
+CREATE_TABLE_AGENT_UPLOADS = '''CREATE TABLE IF NOT EXISTS agent_uploads (
+    agent TEXT NOT NULL,
+    upload TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    PRIMARY KEY(agent, upload)
+) WITHOUT ROWID;'''
+
+# dashboard aggregates, updated with every run's changes by DB.update_stats() (constant work per
+# changed port), DB.rebuild_stats() recomputes them from the history. host_services counts the
+# open ports of every host and service, so service_stats knows when a host starts/stops counting.
+# Archived runs keep their run_stats, host_stats are rebuilt from the diffs left in the live DB.
+CREATE_TABLE_HOST_SERVICES = '''CREATE TABLE IF NOT EXISTS host_services (
+    profile TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    service TEXT NOT NULL,
+    ports INTEGER NOT NULL,
+    PRIMARY KEY(profile, id, service)
+) WITHOUT ROWID;'''
+CREATE_TABLE_SERVICE_STATS = '''CREATE TABLE IF NOT EXISTS service_stats (
+    profile TEXT NOT NULL,
+    service TEXT NOT NULL,
+    ports INTEGER NOT NULL,
+    hosts INTEGER NOT NULL,
+    PRIMARY KEY(profile, service)
+) WITHOUT ROWID;'''
+CREATE_TABLE_HOST_STATS = '''CREATE TABLE IF NOT EXISTS host_stats (
+    id INTEGER PRIMARY KEY,
+    diffs INTEGER NOT NULL,
+    ports INTEGER NOT NULL,
+    last_changed INTEGER NOT NULL
+);'''
+CREATE_INDEX_HOST_STATS_DIFFS = 'CREATE INDEX IF NOT EXISTS host_stats_diffs_idx ON host_stats(diffs, last_changed);'
+CREATE_TABLE_RUN_STATS = '''CREATE TABLE IF NOT EXISTS run_stats (
+    updated INTEGER PRIMARY KEY,
+    profile TEXT NOT NULL,
+    open_ports INTEGER NOT NULL,
+    opened INTEGER NOT NULL,
+    closed INTEGER NOT NULL,
+    changed INTEGER NOT NULL,
+    hosts_changed INTEGER NOT NULL
+);'''
+INSERT_META_STATS = "INSERT OR IGNORE INTO meta VALUES('stats', 0);"
+UPSERT_SERVICE_STATS = '''INSERT INTO service_stats VALUES(?, ?, ?, ?) ON CONFLICT(profile, service)
+    DO UPDATE SET ports=ports + excluded.ports, hosts=hosts + excluded.hosts;'''
+UPSERT_HOST_STATS = '''INSERT INTO host_stats VALUES(?, 1, ?, ?) ON CONFLICT(id)
+    DO UPDATE SET diffs=diffs + 1, ports=ports + excluded.ports, last_changed=excluded.last_changed;'''
+REBUILD_STATS = [
+    'DELETE FROM host_services;',
+    'DELETE FROM service_stats;',
+    'DELETE FROM host_stats;',
+    'DELETE FROM run_stats WHERE updated NOT IN (SELECT updated FROM runs WHERE archive IS NOT NULL);',
+    '''INSERT INTO host_services SELECT profile, id, COALESCE(service, 'unknown'), COUNT(*) FROM observations
+       WHERE last_seen IS NULL AND state='open' GROUP BY profile, id, COALESCE(service, 'unknown');''',
+    '''INSERT INTO service_stats SELECT profile, service, SUM(ports), COUNT(*) FROM host_services
+       GROUP BY profile, service;''',
+    '''INSERT INTO host_stats SELECT id, COUNT(*), (SELECT COUNT(*) FROM diffports WHERE diffports.id=diffscan.id),
+       MAX(updated) FROM diffscan GROUP BY id;''',
+    '''INSERT INTO run_stats SELECT updated, profile,
+       (SELECT COUNT(*) FROM observations WHERE observations.profile=runs.profile AND state='open'
+        AND first_seen<=runs.updated AND (last_seen IS NULL OR last_seen>=runs.updated)),
+       (SELECT COUNT(*) FROM diffports WHERE diffports.updated=runs.updated
+        AND new_state='open' AND old_state IS NOT 'open'),
+       (SELECT COUNT(*) FROM diffports WHERE diffports.updated=runs.updated
+        AND old_state='open' AND new_state IS NOT 'open'),
+       (SELECT COUNT(*) FROM diffports WHERE diffports.updated=runs.updated
+        AND (new_state IS 'open')=(old_state IS 'open')),
+       COALESCE(changed, 0) FROM runs WHERE status='ok' AND archive IS NULL;''',
+    "UPDATE meta SET value=1 WHERE key='stats';",
+]
 
 CREATE_TABLE_DIFFSCAN = '''CREATE TABLE IF NOT EXISTS diffscan (
     id INTEGER NOT NULL,
@@ -51,67 +307,678 @@ CREATE_TABLE_DIFFSCAN = '''CREATE TABLE IF NOT EXISTS diffscan (
     comment TEXT NULL,
     FOREIGN KEY(id) REFERENCES hosts(id)
 );'''
-CREATE_INDEX_DIFFSCAN_UPDATED = 'CREATE INDEX diffscan_updated_idx ON diffscan(updated);'
-CREATE_INDEX_DIFFSCAN_ID_UPDATED = 'CREATE INDEX diffscan_id_updated_idx ON diffscan(id, updated);'
+CREATE_INDEX_DIFFSCAN_UPDATED = 'CREATE INDEX IF NOT EXISTS diffscan_updated_id_idx ON diffscan(updated, id);'
+DROP_INDEX_DIFFSCAN_UPDATED_OLD = 'DROP INDEX IF EXISTS diffscan_updated_idx;'
+CREATE_INDEX_DIFFSCAN_ID_UPDATED = 'CREATE INDEX IF NOT EXISTS diffscan_id_updated_idx ON diffscan(id, updated);'
+
+CREATE_TABLE_DIFFPORTS = '''CREATE TABLE IF NOT EXISTS diffports (
+    id INTEGER NOT NULL,
+    updated INTEGER NOT NULL,
+    port INTEGER NOT NULL,
+    protocol TEXT NOT NULL,
+    old_state TEXT,
+    old_service TEXT,
+    new_state TEXT,
+    new_service TEXT,
+    FOREIGN KEY(id) REFERENCES hosts(id)
+);'''
+CREATE_INDEX_DIFFPORTS_UPDATED = 'CREATE INDEX IF NOT EXISTS diffports_updated_idx ON diffports(updated);'
+CREATE_INDEX_DIFFPORTS_ID_UPDATED = 'CREATE INDEX IF NOT EXISTS diffports_id_updated_idx ON diffports(id, updated);'
+CREATE_INDEX_DIFFPORTS_PORT = 'CREATE INDEX IF NOT EXISTS diffports_port_idx ON diffports(port, protocol);'
+
+# search: hosts.ipkey is a sortable form of the address (see ip_key()), network searches are ipkey
+# ranges. search_hosts indexes host addresses/names (external content, rows are hosts.id), search_diffs
+# diff texts and comments with their host id and timestamp, triggers keep both up to date.
+CREATE_INDEX_HOSTS_IPKEY = 'CREATE INDEX IF NOT EXISTS hosts_ipkey_idx ON hosts(ipkey);'
+CREATE_INDEX_OBSERVATIONS_SERVICE = 'CREATE INDEX IF NOT EXISTS observations_service_idx ON observations(service);'
+CREATE_INDEX_DIFFPORTS_OLD_SERVICE = 'CREATE INDEX IF NOT EXISTS diffports_old_service_idx ON diffports(old_service);'
+CREATE_INDEX_DIFFPORTS_NEW_SERVICE = 'CREATE INDEX IF NOT EXISTS diffports_new_service_idx ON diffports(new_service);'
+CREATE_SEARCH_TABLES = [
+    "CREATE VIRTUAL TABLE search_hosts USING fts5(ip, name, content='hosts', content_rowid='id');",
+    'CREATE VIRTUAL TABLE search_diffs USING fts5(diff, comment, id UNINDEXED, updated UNINDEXED);',
+]
+CREATE_SEARCH_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS search_hosts_insert AFTER INSERT ON hosts BEGIN
+        INSERT INTO search_hosts(rowid, ip, name) VALUES(new.id, new.ip, new.name);
+    END;''',
+    '''CREATE TRIGGER IF NOT EXISTS search_hosts_delete AFTER DELETE ON hosts BEGIN
+        INSERT INTO search_hosts(search_hosts, rowid, ip, name) VALUES('delete', old.id, old.ip, old.name);
+    END;''',
+    '''CREATE TRIGGER IF NOT EXISTS search_hosts_update AFTER UPDATE OF ip, name ON hosts BEGIN
+        INSERT INTO search_hosts(search_hosts, rowid, ip, name) VALUES('delete', old.id, old.ip, old.name);
+        INSERT INTO search_hosts(rowid, ip, name) VALUES(new.id, new.ip, new.name);
+    END;''',
+    '''CREATE TRIGGER IF NOT EXISTS search_diffs_insert AFTER INSERT ON diffscan BEGIN
+        INSERT INTO search_diffs(rowid, diff, comment, id, updated)
+        VALUES(new.rowid, new.diff, new.comment, new.id, new.updated);
+    END;''',
+    '''CREATE TRIGGER IF NOT EXISTS search_diffs_delete AFTER DELETE ON diffscan BEGIN
+        DELETE FROM search_diffs WHERE rowid=old.rowid;
+    END;''',
+    '''CREATE TRIGGER IF NOT EXISTS search_diffs_update AFTER UPDATE OF diff, comment ON diffscan BEGIN
+        UPDATE search_diffs SET diff=new.diff, comment=new.comment WHERE rowid=old.rowid;
+    END;''',
+]
+
+# archive DBs (one per ARCHIVE_PERIOD, see DB.archive_runs()): the history of the runs before the archive
+# horizon, closed observations are copied into every period they overlap, so a run's snapshot is its
+# period's archive plus the live DB. Primary keys make copying a period again harmless.
+CREATE_ARCHIVE_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS archive.observations (
+        id INTEGER NOT NULL,
+        port INTEGER NOT NULL,
+        protocol TEXT NOT NULL,
+        state TEXT NOT NULL,
+        service TEXT,
+        first_seen INTEGER NOT NULL,
+        last_seen INTEGER NOT NULL,
+        profile TEXT NOT NULL,
+        PRIMARY KEY(id, port, protocol, profile, first_seen)
+    ) WITHOUT ROWID;''',
+    'CREATE INDEX IF NOT EXISTS archive.observations_profile_idx ON observations(profile, last_seen, first_seen);',
+    '''CREATE TABLE IF NOT EXISTS archive.diffscan (
+        id INTEGER NOT NULL,
+        updated INTEGER NOT NULL,
+        diff TEXT NOT NULL,
+        comment TEXT NULL,
+        PRIMARY KEY(id, updated)
+    );''',
+    'CREATE INDEX IF NOT EXISTS archive.diffscan_updated_id_idx ON diffscan(updated, id);',
+    '''CREATE TABLE IF NOT EXISTS archive.diffports (
+        id INTEGER NOT NULL,
+        updated INTEGER NOT NULL,
+        port INTEGER NOT NULL,
+        protocol TEXT NOT NULL,
+        old_state TEXT,
+        old_service TEXT,
+        new_state TEXT,
+        new_service TEXT,
+        PRIMARY KEY(id, updated, port, protocol)
+    ) WITHOUT ROWID;''',
+    'CREATE INDEX IF NOT EXISTS archive.diffports_updated_idx ON diffports(updated);',
+    '''CREATE TABLE IF NOT EXISTS archive.run_metrics (
+        run INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY(run, name)
+    ) WITHOUT ROWID;''',
+]
+# :start/:end is the period, :horizon the archive horizon
+ARCHIVED_RUNS = "SELECT id FROM runs WHERE updated>=:start AND updated<:end AND updated<:horizon " \
+                "AND status NOT IN ('running', 'incomplete')"
+COPY_TO_ARCHIVE = [
+    '''INSERT OR IGNORE INTO archive.observations SELECT id, port, protocol, state, service, first_seen, last_seen,
+       profile FROM main.observations WHERE last_seen>=:start AND last_seen<:horizon AND first_seen<:end;''',
+    '''INSERT OR IGNORE INTO archive.diffscan SELECT id, updated, diff, comment FROM main.diffscan
+       WHERE updated>=:start AND updated<:end AND updated<:horizon;''',
+    '''INSERT OR IGNORE INTO archive.diffports SELECT id, updated, port, protocol, old_state, old_service,
+       new_state, new_service FROM main.diffports WHERE updated>=:start AND updated<:end AND updated<:horizon;''',
+    'INSERT OR IGNORE INTO archive.run_metrics SELECT * FROM main.run_metrics WHERE run IN (' + ARCHIVED_RUNS + ');',
+]
+# observations ending in the period have been copied into all the periods they overlap
+DELETE_ARCHIVED = [
+    'DELETE FROM main.observations WHERE last_seen<:end AND last_seen<:horizon;',
+    'DELETE FROM main.diffscan WHERE updated>=:start AND updated<:end AND updated<:horizon;',
+    'DELETE FROM main.diffports WHERE updated>=:start AND updated<:end AND updated<:horizon;',
+    'DELETE FROM main.run_metrics WHERE run IN (' + ARCHIVED_RUNS + ');',
+    'UPDATE main.runs SET archive=:archive WHERE id IN (' + ARCHIVED_RUNS + ');',
+]
 
 
 # ---------------------------------------------------- DB class
 class DB:
     def __init__(self):
-        self.dbconn = sqlite3.connect(DBPATH)
+        self.dbconn = sqlite3.connect(DBPATH, timeout=DB_TIMEOUT)
         self.dbcursor = self.dbconn.cursor()
+        # only takes effect in new DBs (before the first table is created) and with --vacuum
+        self.dbcursor.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+        self.dbcursor.execute('PRAGMA journal_mode=WAL;')
+        self.dbcursor.execute('PRAGMA synchronous=NORMAL;')
+        self.rows_written = 0
+        self.hosts_unchanged = 0
+        # {run id: (known hosts, fingerprints)}, see run_maps()
+        self.run_cache = {}
 
     def create_tables(self):
         self.dbcursor.execute(CREATE_TABLE_HOSTS)
         self.dbcursor.execute(CREATE_INDEX_HOSTS_IP)
-        self.dbcursor.execute(CREATE_TABLE_FULLSCAN)
-        self.dbcursor.execute(CREATE_INDEX_FULLSCAN_UPDATED)
-        self.dbcursor.execute(CREATE_INDEX_FULLSCAN_ID_UPDATED)
+        self.dbcursor.execute(CREATE_INDEX_HOSTS_NAME)
+        self.dbcursor.execute(CREATE_TABLE_OBSERVATIONS)
+        self.dbcursor.execute(CREATE_INDEX_OBSERVATIONS_LAST_SEEN)
+        self.dbcursor.execute(CREATE_INDEX_OBSERVATIONS_ID_LAST_SEEN)
+        self.dbcursor.execute(CREATE_INDEX_OBSERVATIONS_PORT)
+        self.dbcursor.execute(CREATE_TABLE_RUNS)
+        self.dbcursor.execute(CREATE_INDEX_RUNS_STATUS_UPDATED)
+        self.add_columns()
+        self.dbcursor.execute(CREATE_INDEX_OBSERVATIONS_PROFILE)
+        self.dbcursor.execute(CREATE_INDEX_RUNS_PROFILE)
+        self.dbcursor.execute(CREATE_TABLE_RUN_METRICS)
+        self.dbcursor.execute(CREATE_TABLE_PENDING_SCAN)
+        self.dbcursor.execute(CREATE_TABLE_PENDING_HOSTS)
+        self.dbcursor.execute(CREATE_TABLE_RUN_CHUNKS)
+        self.dbcursor.execute(CREATE_TABLE_HOST_SCANS)
+        self.dbcursor.execute(CREATE_TABLE_AGENT_UPLOADS)
+        self.dbcursor.execute(CREATE_INDEX_RUNS_GENERATION)
+        self.dbcursor.execute(CREATE_TABLE_META)
+        self.dbcursor.execute(INSERT_META_DEFAULTS)
+        self.dbcursor.execute(CREATE_TABLE_HOST_SERVICES)
+        self.dbcursor.execute(CREATE_TABLE_SERVICE_STATS)
+        self.dbcursor.execute(CREATE_TABLE_HOST_STATS)
+        self.dbcursor.execute(CREATE_INDEX_HOST_STATS_DIFFS)
+        self.dbcursor.execute(CREATE_TABLE_RUN_STATS)
+        self.dbcursor.execute(INSERT_META_STATS)
         self.dbcursor.execute(CREATE_TABLE_DIFFSCAN)
         self.dbcursor.execute(CREATE_INDEX_DIFFSCAN_UPDATED)
+        self.dbcursor.execute(DROP_INDEX_DIFFSCAN_UPDATED_OLD)
         self.dbcursor.execute(CREATE_INDEX_DIFFSCAN_ID_UPDATED)
+        self.dbcursor.execute(CREATE_TABLE_DIFFPORTS)
+        self.dbcursor.execute(CREATE_INDEX_DIFFPORTS_UPDATED)
+        self.dbcursor.execute(CREATE_INDEX_DIFFPORTS_ID_UPDATED)
+        self.dbcursor.execute(CREATE_INDEX_DIFFPORTS_PORT)
+        self.dbcursor.execute(CREATE_INDEX_HOSTS_IPKEY)
+        self.dbcursor.execute(CREATE_INDEX_OBSERVATIONS_SERVICE)
+        self.dbcursor.execute(CREATE_INDEX_DIFFPORTS_OLD_SERVICE)
+        self.dbcursor.execute(CREATE_INDEX_DIFFPORTS_NEW_SERVICE)
+        self.fill_ip_keys()
         self.dbconn.commit()
+        self.create_search_index()
 
-    def insert_hostip(self, hostip):
-        sql = 'INSERT OR IGNORE INTO hosts(ip) VALUES("{}");'.format(hostip)
-        try:
-            self.dbcursor.execute(sql)
-        except Exception as ex:
-            logging.warning('cannot add new host: {}: {}'.format(hostip, ex))
+    def add_columns(self):
+        for table, column, definition in ADD_COLUMNS:
+            self.dbcursor.execute('PRAGMA table_info({});'.format(table))
+            if column not in [row[1] for row in self.dbcursor.fetchall()]:
+                self.dbcursor.execute('ALTER TABLE {} ADD COLUMN {} {};'.format(table, column, definition))
 
-    def update_hostname(self, hostip, hostname):
-        sql = 'UPDATE hosts SET name="{}" WHERE ip="{}"'.format(hostname, hostip)
+    def fill_ip_keys(self):
+        self.dbcursor.execute('SELECT id, ip FROM hosts WHERE ipkey IS NULL;')
+        self.dbcursor.executemany('UPDATE hosts SET ipkey=? WHERE id=?;',
+                                  [(ip_key(ip), hostid) for hostid, ip in self.dbcursor.fetchall()])
+
+    def create_search_index(self):
+        '''creates the full text search tables (filled from the existing data) and their triggers,
+           without FTS5 support in SQLite nsnap-web.py falls back to slower LIKE searches'''
+        self.dbcursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' "
+                              "AND name IN ('search_hosts', 'search_diffs');")
+        if self.dbcursor.fetchone()[0] < len(CREATE_SEARCH_TABLES):
+            try:
+                self.dbcursor.execute('DROP TABLE IF EXISTS search_hosts;')
+                self.dbcursor.execute('DROP TABLE IF EXISTS search_diffs;')
+                for statement in CREATE_SEARCH_TABLES:
+                    self.dbcursor.execute(statement)
+            except sqlite3.OperationalError as ex:
+                self.dbconn.rollback()
+                logging.warning('*** Search index not available: {}'.format(ex))
+                return False
+            self.rebuild_search_index()
+        for statement in CREATE_SEARCH_TRIGGERS:
+            self.dbcursor.execute(statement)
+        self.dbconn.commit()
+        return True
+
+    def rebuild_search_index(self):
+        '''refills the search tables, search_diffs rows follow diffscan rowids (changed by VACUUM)'''
+        self.dbcursor.execute("INSERT INTO search_hosts(search_hosts) VALUES('rebuild');")
+        self.dbcursor.execute('DELETE FROM search_diffs;')
+        self.dbcursor.execute('INSERT INTO search_diffs(rowid, diff, comment, id, updated) '
+                              'SELECT rowid, diff, comment, id, updated FROM diffscan;')
+
+    def migrate_fullscan(self):
+        '''converts the old fullscan table (a full copy of every scan) into observation intervals'''
+        self.dbcursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='fullscan';")
+        if self.dbcursor.fetchone() is None:
+            return False
+        self.dbcursor.execute("INSERT OR IGNORE INTO runs(updated, hosts, ports, changed, status) "
+                              "SELECT updated, COUNT(DISTINCT id), COUNT(*), "
+                              "(SELECT COUNT(*) FROM diffscan WHERE diffscan.updated=fullscan.updated), 'ok' "
+                              "FROM fullscan GROUP BY updated;")
+        scans = [row[0] for row in self.dbconn.execute("SELECT updated FROM runs WHERE status='ok' ORDER BY updated;")]
+        next_scan = dict(zip(scans, scans[1:]))
+        latest_scan = scans[-1] if scans else None
+
+        def interval(observation):
+            return observation[:6] + [None if observation[6] == latest_scan else observation[6]]
+
+        rows = self.dbconn.execute('SELECT id, port, protocol, state, service, updated FROM fullscan '
+                                   'ORDER BY id, port, protocol, updated;')
+        intervals = []
+        observation = None
+        for row in rows:
+            if observation is not None and observation[:5] == list(row[:5]) \
+                    and row[5] in (observation[6], next_scan.get(observation[6])):
+                observation[6] = row[5]
+                continue
+            if observation is not None:
+                intervals.append(interval(observation))
+            observation = list(row) + [row[5]]
+            if len(intervals) >= INGEST_BATCH:
+                self.dbcursor.executemany(INSERT_OBSERVATION_INTERVAL, intervals)
+                intervals = []
+        if observation is not None:
+            intervals.append(interval(observation))
+        self.dbcursor.executemany(INSERT_OBSERVATION_INTERVAL, intervals)
+        self.dbcursor.execute('DROP TABLE fullscan;')
+        self.dbconn.commit()
+        return True
+
+    def run_maps(self, runid, timestamp, profile):
+        '''({ip: (host id, name)}, {host id: fingerprint}) of a run, loaded by its first ingest_hosts()
+           and reused by the next chunks until finish_run(). host_scans only changes when the run
+           is diffed, hosts added by other runs meanwhile are looked up when they are met.'''
+        if runid is not None and runid in self.run_cache:
+            return self.run_cache[runid]
+        self.dbcursor.execute('SELECT ip, id, name FROM hosts;')
+        known_hosts = {ip: (hostid, name) for ip, hostid, name in self.dbcursor.fetchall()}
+        fingerprints = {}
+        if self.select_previous_scan(timestamp, profile) is not None:
+            self.dbcursor.execute('SELECT id, fingerprint FROM host_scans WHERE profile=? AND fingerprint IS NOT NULL;',
+                                  (profile,))
+            fingerprints = dict(self.dbcursor.fetchall())
+        if runid is not None:
+            self.run_cache[runid] = known_hosts, fingerprints
+        return known_hosts, fingerprints
+
+    def ingest_hosts(self, hosts, timestamp, profile='default', runid=None):
+        '''writes all hosts with open services into the current_scan temporary table, except for
+           hosts whose fingerprint did not change since their last scan (only current_hosts is written).
+           Host ids and fingerprints are resolved from the run's in-memory maps (run_maps()).
+           Nothing is committed until update_observations() is done with the scan.'''
+        self.dbcursor.execute(CREATE_TEMP_TABLE_CURRENT_SCAN)
+        self.dbcursor.execute('DELETE FROM current_scan;')
+        self.dbcursor.execute(CREATE_TEMP_TABLE_CURRENT_HOSTS)
+        self.dbcursor.execute('DELETE FROM current_hosts;')
+        known_hosts, fingerprints = self.run_maps(runid, timestamp, profile)
+        renamed = []
+        services = []
+        current_hosts = []
+        total_hosts = 0
+        total_ports = 0
         try:
-            self.dbcursor.execute(sql)
-        except Exception as ex:
-            logging.warning('cannot update host {} with name {}: {}'.format(hostip, hostname, ex))
+            for host in hosts:
+                if len(host['services']) == 0:
+                    continue
+                logging.info('    {}:{}'.format(host['ip'], host['name']))
+                if host['ip'] not in known_hosts:
+                    # the host may have been added by another run since the map was loaded
+                    self.dbcursor.execute('INSERT OR IGNORE INTO hosts(ip, name, ipkey) VALUES(?, ?, ?);',
+                                          (host['ip'], host['name'], ip_key(host['ip'])))
+                    if self.dbcursor.rowcount == 1:
+                        known_hosts[host['ip']] = (self.dbcursor.lastrowid, host['name'])
+                        self.rows_written += 1
+                    else:
+                        self.dbcursor.execute('SELECT id, name FROM hosts WHERE ip=?;', (host['ip'],))
+                        known_hosts[host['ip']] = self.dbcursor.fetchone()
+                if known_hosts[host['ip']][1] != host['name']:
+                    renamed.append((host['name'], known_hosts[host['ip']][0]))
+                    known_hosts[host['ip']] = (known_hosts[host['ip']][0], host['name'])
+                hostid = known_hosts[host['ip']][0]
+                fingerprint = services_fingerprint(host['services'])
+                current_hosts.append((hostid, fingerprint))
+                if fingerprints.get(hostid) == fingerprint:
+                    self.hosts_unchanged += 1
+                else:
+                    services += [(hostid, service['port'], service['proto'], service['state'], service['service'])
+                                 for service in host['services']]
+                if len(services) >= INGEST_BATCH or len(current_hosts) >= INGEST_BATCH:
+                    self.dbcursor.executemany('INSERT OR REPLACE INTO current_scan VALUES(?, ?, ?, ?, ?);', services)
+                    self.dbcursor.executemany('INSERT OR REPLACE INTO current_hosts VALUES(?, ?);', current_hosts)
+                    services = []
+                    current_hosts = []
+                total_hosts += 1
+                total_ports += len(host['services'])
+            self.dbcursor.executemany('INSERT OR REPLACE INTO current_scan VALUES(?, ?, ?, ?, ?);', services)
+            self.dbcursor.executemany('INSERT OR REPLACE INTO current_hosts VALUES(?, ?);', current_hosts)
+            self.dbcursor.executemany('UPDATE hosts SET name=? WHERE id=?;', renamed)
+            self.rows_written += len(renamed)
+        except Exception:
+            self.dbconn.rollback()
+            # the maps may hold hosts that were rolled back
+            self.run_cache.pop(runid, None)
+            raise
+        return total_hosts, total_ports
 
-    def select_id_by_ip(self, hostip):
-        hostid = 0
-        sql = 'SELECT id FROM hosts WHERE ip="{}";'.format(hostip)
+    def start_run(self, timestamp, target, options, profile='default'):
+        '''returns (run id, timestamp), the timestamp is moved forward when another
+           profile has already registered a run in the same second'''
+        while True:
+            try:
+                self.dbcursor.execute("INSERT INTO runs(updated, target, options, status, profile) "
+                                      "VALUES(?, ?, ?, 'running', ?);", (timestamp, target, options, profile))
+            except sqlite3.IntegrityError:
+                timestamp += 1
+            else:
+                break
+        self.dbconn.commit()
+        return self.dbcursor.lastrowid, timestamp
+
+    def finish_run(self, runid, status, duration, hosts=None, ports=None, changed=None, metrics=None, upload=None):
+        '''also commits the scan results, a run is only visible as "ok" together with its data
+           (and, for agent uploads, the (agent, upload) record that keeps it from being stored twice)'''
+        self.run_cache.pop(runid, None)
+        self.dbcursor.execute('UPDATE runs SET status=?, duration=?, hosts=?, ports=?, changed=? WHERE id=?;',
+                              (status, duration, hosts, ports, changed, runid))
+        if metrics is not None:
+            metrics.add_counters(self.take_counters())
+            self.save_metrics(runid, metrics.values)
+        if status == 'ok':
+            if upload is not None:
+                self.dbcursor.execute('INSERT INTO agent_uploads VALUES(?, ?, ?);', upload + (runid,))
+            self.dbcursor.execute(UPDATE_META_GENERATION)
+            self.dbcursor.execute("UPDATE runs SET generation=(SELECT value FROM meta WHERE key='generation') "
+                                  "WHERE id=?;", (runid,))
+        commit_start = time.monotonic()
+        self.dbconn.commit()
+        if metrics is not None:
+            self.save_metrics(runid, {'commit_seconds': time.monotonic() - commit_start})
+            self.dbconn.commit()
+
+    def abandon_runs(self, profile, keep=None):
+        '''marks unfinished runs of a profile as interrupted (the profile lock is held, nothing else
+           is writing them), their pending results are dropped'''
+        self.dbcursor.execute("UPDATE runs SET status='interrupted' WHERE profile=? "
+                              "AND status IN ('running', 'incomplete') AND id IS NOT ?;", (profile, keep))
+        self.dbcursor.execute("DELETE FROM pending_scan WHERE run IN (SELECT id FROM runs WHERE status='interrupted');")
+        self.dbcursor.execute("DELETE FROM pending_hosts WHERE run IN (SELECT id FROM runs WHERE status='interrupted');")
+        self.dbconn.commit()
+
+    def select_resumable_run(self, profile, target, options):
+        '''(run id, timestamp, {chunk: targets}) of the last unfinished pipelined run with the same settings'''
+        self.dbcursor.execute("SELECT id, updated FROM runs WHERE profile=? AND target=? AND options=? "
+                              "AND status IN ('running', 'incomplete') ORDER BY updated DESC LIMIT 1;",
+                              (profile, target, options))
+        run = self.dbcursor.fetchone()
+        if run is None:
+            return None
+        self.dbcursor.execute('SELECT chunk, targets FROM run_chunks WHERE run=?;', (run[0],))
+        return run[0], run[1], dict(self.dbcursor.fetchall())
+
+    def resume_run(self, runid):
+        self.dbcursor.execute("UPDATE runs SET status='running' WHERE id=?;", (runid,))
+        self.dbconn.commit()
+
+    def save_chunk(self, runid, chunk, targets, hosts, ports):
+        '''moves the chunk from current_scan/current_hosts to pending_scan/pending_hosts,
+           the commit is the checkpoint'''
+        self.dbcursor.execute('INSERT OR REPLACE INTO pending_scan SELECT ?, id, port, protocol, state, service '
+                              'FROM current_scan;', (runid,))
+        self.rows_written += self.dbcursor.rowcount
+        self.dbcursor.execute('INSERT OR REPLACE INTO pending_hosts SELECT ?, id, fingerprint FROM current_hosts;',
+                              (runid,))
+        self.rows_written += self.dbcursor.rowcount
+        self.dbcursor.execute('INSERT OR REPLACE INTO run_chunks VALUES(?, ?, ?, ?, ?);',
+                              (runid, chunk, targets, hosts, ports))
+        self.dbconn.commit()
+
+    def load_pending(self, runid):
+        '''fills current_scan/current_hosts with all chunks of a pipelined run, returns (total hosts, total ports)'''
         try:
-            self.dbcursor.execute(sql)
-        except Exception as ex:
-            logging.warning('error getting id by ip: {}'.format(ex))
+            self.dbcursor.execute(CREATE_TEMP_TABLE_CURRENT_SCAN)
+            self.dbcursor.execute('DELETE FROM current_scan;')
+            self.dbcursor.execute('INSERT INTO current_scan SELECT id, port, protocol, state, service '
+                                  'FROM pending_scan WHERE run=?;', (runid,))
+            self.dbcursor.execute('DELETE FROM pending_scan WHERE run=?;', (runid,))
+            self.dbcursor.execute(CREATE_TEMP_TABLE_CURRENT_HOSTS)
+            self.dbcursor.execute('DELETE FROM current_hosts;')
+            self.dbcursor.execute('INSERT INTO current_hosts SELECT id, fingerprint FROM pending_hosts WHERE run=?;',
+                                  (runid,))
+            self.dbcursor.execute('DELETE FROM pending_hosts WHERE run=?;', (runid,))
+            self.dbcursor.execute('SELECT COALESCE(SUM(hosts), 0), COALESCE(SUM(ports), 0) FROM run_chunks '
+                                  'WHERE run=?;', (runid,))
+        except Exception:
+            self.dbconn.rollback()
+            raise
+        return self.dbcursor.fetchone()
+
+    def drop_pending(self, runid):
+        '''removes the stored chunks of a failed piped run'''
+        self.run_cache.pop(runid, None)
+        self.dbcursor.execute('DELETE FROM pending_scan WHERE run=?;', (runid,))
+        self.dbcursor.execute('DELETE FROM pending_hosts WHERE run=?;', (runid,))
+        self.dbconn.commit()
+
+    def take_counters(self):
+        '''row counters since the last call. Runs of several profiles share the DB object, every
+           writer step of a run collects them into the run's metrics before it returns.'''
+        counters = {'rows_written': self.rows_written, 'hosts_unchanged': self.hosts_unchanged}
+        self.rows_written = 0
+        self.hosts_unchanged = 0
+        return counters
+
+    def save_metrics(self, runid, values):
+        self.dbcursor.executemany('INSERT OR REPLACE INTO run_metrics VALUES(?, ?, ?);',
+                                  [(runid, name, value) for name, value in values.items()])
+
+    def select_previous_scan(self, timestamp, profile='default'):
+        self.dbcursor.execute("SELECT MAX(updated) FROM runs WHERE profile=? AND status='ok' AND updated<?;",
+                              (profile, timestamp))
+        return self.dbcursor.fetchone()[0]
+
+    def select_last_scan(self, profile):
+        self.dbcursor.execute("SELECT MAX(updated) FROM runs WHERE profile=? AND status='ok';", (profile,))
+        return self.dbcursor.fetchone()[0]
+
+    def select_upload(self, agent, upload):
+        self.dbcursor.execute('SELECT run FROM agent_uploads WHERE agent=? AND upload=?;', (agent, upload))
+        row = self.dbcursor.fetchone()
+        return row[0] if row is not None else None
+
+    def select_adaptive_hosts(self, profile, since):
+        '''({ip: last scan or None} of the hosts known to the profile, ips with open services,
+           ips changed since the given time)'''
+        self.dbcursor.execute('SELECT ip, scanned FROM hosts LEFT JOIN host_scans ON host_scans.id=hosts.id '
+                              'AND host_scans.profile=:profile WHERE scanned IS NOT NULL OR hosts.id IN '
+                              '(SELECT id FROM observations WHERE profile=:profile AND last_seen IS NULL);',
+                              {'profile': profile})
+        known = dict(self.dbcursor.fetchall())
+        self.dbcursor.execute('SELECT DISTINCT ip FROM hosts JOIN observations ON observations.id=hosts.id '
+                              'WHERE profile=? AND last_seen IS NULL;', (profile,))
+        with_services = {row[0] for row in self.dbcursor.fetchall()}
+        self.dbcursor.execute('SELECT DISTINCT ip FROM hosts JOIN diffscan ON diffscan.id=hosts.id WHERE updated>=? '
+                              'AND updated IN (SELECT updated FROM runs WHERE profile=?);', (since, profile))
+        changed = {row[0] for row in self.dbcursor.fetchall()}
+        return known, with_services, changed
+
+    def mark_scanned(self, timestamp, profile, scoped):
+        '''records the scan time and the new fingerprint of every host in current_hosts and every
+           host the profile still has open observations for or, for partial runs, of every host in scan_scope'''
+        if scoped:
+            self.dbcursor.execute('INSERT OR REPLACE INTO host_scans SELECT hosts.id, ?, ?, fingerprint FROM hosts '
+                                  'JOIN scan_scope USING(ip) LEFT JOIN current_hosts ON current_hosts.id=hosts.id;',
+                                  (profile, timestamp))
         else:
-            rows = self.dbcursor.fetchone()
-            if rows is not None:
-                hostid = rows[0]
-        return hostid
+            self.dbcursor.execute('INSERT OR REPLACE INTO host_scans SELECT id, ?, ?, fingerprint FROM '
+                                  '(SELECT id FROM current_hosts UNION SELECT id FROM observations '
+                                  'WHERE profile=? AND last_seen IS NULL) LEFT JOIN current_hosts USING(id);',
+                                  (profile, timestamp, profile))
+        self.rows_written += self.dbcursor.rowcount
 
-    def update_service(self, hostid, timestamp, service):
-        sql = 'INSERT INTO fullscan VALUES({}, {}, {}, "{}", "{}", "{}");'.format(hostid, timestamp, service['port'], service['proto'], service['state'], service['service'])
+    def update_observations(self, timestamp, profile='default', scope=None):
+        '''compares current_scan with the open observations of the same profile, closes the ones that
+           changed or disappeared, opens new ones and records the differences. With a scope (addresses
+           of a partial scan) hosts outside of it are left as they are. Returns the number of
+           changed hosts, the changes are committed by finish_run().'''
+        previous_scan = self.select_previous_scan(timestamp, profile)
+        scope_sql = ' AND id NOT IN (SELECT id FROM unchanged_hosts)'
         try:
-            self.dbcursor.execute(sql)
-        except Exception as ex:
-            logging.error('error inserting fullscan result: {}: {}'.format(ex, sql))
+            if scope is not None:
+                self.dbcursor.execute(CREATE_TEMP_TABLE_SCAN_SCOPE)
+                self.dbcursor.execute('DELETE FROM scan_scope;')
+                self.dbcursor.executemany('INSERT OR IGNORE INTO scan_scope VALUES(?);', [(ip,) for ip in scope])
+                scope_sql += ' AND id IN (SELECT hosts.id FROM hosts JOIN scan_scope USING(ip))'
+            self.dbcursor.execute(CREATE_TEMP_TABLE_UNCHANGED_HOSTS)
+            self.dbcursor.execute('DELETE FROM unchanged_hosts;')
+            self.dbcursor.execute('INSERT INTO unchanged_hosts SELECT current_hosts.id FROM current_hosts '
+                                  'JOIN host_scans ON host_scans.id=current_hosts.id AND profile=? '
+                                  'AND host_scans.fingerprint=current_hosts.fingerprint;', (profile,))
+            self.mark_scanned(timestamp, profile, scope is not None)
+            if previous_scan is None:
+                logging.warning('Previous {} scan results do not exist (is this your first scan?)'.format(profile))
+                self.dbcursor.execute('INSERT INTO observations SELECT id, port, protocol, state, service, ?, NULL, ? '
+                                      'FROM current_scan;', (timestamp, profile))
+                self.rows_written += self.dbcursor.rowcount
+                self.init_stats(timestamp, profile)
+                return 0
+
+            open_observations = self.dbconn.execute('SELECT id, port, protocol, state, service FROM observations '
+                                                    'WHERE profile=? AND last_seen IS NULL' + scope_sql +
+                                                    ' ORDER BY id;', (profile,))
+            current_scan = self.dbconn.execute('SELECT id, port, protocol, state, service FROM current_scan ORDER BY id;')
+            all_changes = list(diff_snapshots(open_observations, current_scan))
+            for hostid, changes in all_changes:
+                logging.info('   updating diffscan for host id {}...'.format(hostid))
+                self.dbcursor.executemany('UPDATE observations SET last_seen=? '
+                                          'WHERE id=? AND port=? AND protocol=? AND profile=? AND last_seen IS NULL;',
+                                          [(previous_scan, hostid, port, proto, profile)
+                                           for port, proto, old, _ in changes if old is not None])
+                self.rows_written += self.dbcursor.rowcount
+                self.dbcursor.executemany('INSERT INTO observations VALUES(?, ?, ?, ?, ?, ?, NULL, ?);',
+                                          [(hostid, port, proto) + new + (timestamp, profile)
+                                           for port, proto, _, new in changes if new is not None])
+                self.rows_written += self.dbcursor.rowcount
+                self.update_diff(hostid, timestamp, changes)
+            self.update_stats(timestamp, profile, all_changes)
+        except Exception:
+            self.dbconn.rollback()
+            raise
+        return len(all_changes)
 
-    def update_diff(self, hostid, timestamp, scan_diff):
-        sql = 'INSERT INTO diffscan VALUES({}, {}, "{}", "");'.format(hostid, timestamp, scan_diff)
+    def update_diff(self, hostid, timestamp, changes):
+        self.dbcursor.execute("INSERT INTO diffscan VALUES(?, ?, ?, '');", (hostid, timestamp, render_diff(changes)))
+        self.dbcursor.executemany('INSERT INTO diffports VALUES(?, ?, ?, ?, ?, ?, ?, ?);',
+                                  [(hostid, timestamp, port, proto) + (old or (None, None)) + (new or (None, None))
+                                   for port, proto, old, new in changes])
+        self.rows_written += 1 + len(changes)
+
+    def init_stats(self, timestamp, profile):
+        '''dashboard aggregates of a profile's first scan, straight from current_scan'''
+        self.dbcursor.execute('DELETE FROM host_services WHERE profile=?;', (profile,))
+        self.dbcursor.execute("INSERT INTO host_services SELECT ?, id, COALESCE(service, 'unknown'), COUNT(*) "
+                              "FROM current_scan WHERE state='open' GROUP BY id, COALESCE(service, 'unknown');",
+                              (profile,))
+        self.dbcursor.execute('DELETE FROM service_stats WHERE profile=?;', (profile,))
+        self.dbcursor.execute('INSERT INTO service_stats SELECT profile, service, SUM(ports), COUNT(*) '
+                              'FROM host_services WHERE profile=? GROUP BY service;', (profile,))
+        # like the diffs, the counts of new/closed ports start with the second scan
+        self.dbcursor.execute("SELECT COUNT(*) FROM current_scan WHERE state='open';")
+        self.dbcursor.execute('INSERT OR REPLACE INTO run_stats VALUES(?, ?, ?, 0, 0, 0, 0);',
+                              (timestamp, profile, self.dbcursor.fetchone()[0]))
+
+    def update_stats(self, timestamp, profile, all_changes):
+        '''applies the changes of a run to the dashboard aggregates: only the changed hosts
+           and services are touched, however long the history is'''
+        counts = {'opened': 0, 'closed': 0, 'changed': 0}
+        service_deltas = {}
+        for hostid, changes in all_changes:
+            port_deltas = {}
+            for _, _, old, new in changes:
+                was_open = old is not None and old[0] == 'open'
+                is_open = new is not None and new[0] == 'open'
+                if was_open:
+                    port_deltas[old[1] or 'unknown'] = port_deltas.get(old[1] or 'unknown', 0) - 1
+                if is_open:
+                    port_deltas[new[1] or 'unknown'] = port_deltas.get(new[1] or 'unknown', 0) + 1
+                counts['opened' if is_open and not was_open else 'closed' if was_open and not is_open
+                       else 'changed'] += 1
+            for service, delta in port_deltas.items():
+                if delta == 0:
+                    continue
+                self.dbcursor.execute('SELECT ports FROM host_services WHERE profile=? AND id=? AND service=?;',
+                                      (profile, hostid, service))
+                row = self.dbcursor.fetchone()
+                before = row[0] if row is not None else 0
+                if before + delta > 0:
+                    self.dbcursor.execute('INSERT OR REPLACE INTO host_services VALUES(?, ?, ?, ?);',
+                                          (profile, hostid, service, before + delta))
+                else:
+                    self.dbcursor.execute('DELETE FROM host_services WHERE profile=? AND id=? AND service=?;',
+                                          (profile, hostid, service))
+                ports, hosts = service_deltas.get(service, (0, 0))
+                service_deltas[service] = (ports + delta, hosts + (before + delta > 0) - (before > 0))
+            self.dbcursor.execute(UPSERT_HOST_STATS, (hostid, len(changes), timestamp))
+        self.dbcursor.executemany(UPSERT_SERVICE_STATS, [(profile, service) + deltas
+                                                         for service, deltas in service_deltas.items()])
+        self.dbcursor.execute('DELETE FROM service_stats WHERE profile=? AND ports<=0;', (profile,))
+        self.dbcursor.execute('SELECT COALESCE(SUM(ports), 0) FROM service_stats WHERE profile=?;', (profile,))
+        open_ports = self.dbcursor.fetchone()[0]
+        self.dbcursor.execute('INSERT OR REPLACE INTO run_stats VALUES(?, ?, ?, ?, ?, ?, ?);',
+                              (timestamp, profile, open_ports, counts['opened'], counts['closed'], counts['changed'],
+                               len(all_changes)))
+
+    def stats_built(self):
+        self.dbcursor.execute("SELECT value FROM meta WHERE key='stats';")
+        return bool(self.dbcursor.fetchone()[0])
+
+    def rebuild_stats(self):
+        '''recomputes all dashboard aggregates from the observations, diffs and runs'''
         try:
-            self.dbcursor.execute(sql)
-        except Exception as ex:
-            logging.error('error inserting diffscan result: {}: {}'.format(ex, sql))
+            for sql in REBUILD_STATS:
+                self.dbcursor.execute(sql)
+            self.dbcursor.execute(UPDATE_META_GENERATION)
+        except Exception:
+            self.dbconn.rollback()
+            raise
+        self.dbconn.commit()
+
+    def archive_runs(self, horizon):
+        '''moves the history of the finished runs before horizon into the archive DBs, one period at a
+           time: the period is copied and committed to its archive, then removed from the live DB in
+           a second transaction (an interrupted archiving is repeated by the next one). Returns the
+           number of archived runs.'''
+        self.dbcursor.execute("SELECT MIN(updated) FROM runs WHERE archive IS NULL AND updated<? "
+                              "AND status NOT IN ('running', 'incomplete');", (horizon,))
+        first = self.dbcursor.fetchone()[0]
+        self.dbcursor.execute('SELECT MIN(first_seen) FROM observations WHERE last_seen<?;', (horizon,))
+        first = min(value for value in (first, self.dbcursor.fetchone()[0], horizon) if value is not None)
+        archived = 0
+        while first < horizon:
+            archive, start, end = archive_period(first)
+            params = {'start': start, 'end': end, 'horizon': horizon, 'archive': archive}
+            first = end
+            self.dbcursor.execute('SELECT EXISTS (' + ARCHIVED_RUNS + ') OR EXISTS (SELECT 1 FROM observations '
+                                  'WHERE last_seen>=:start AND last_seen<:horizon AND first_seen<:end);', params)
+            if not self.dbcursor.fetchone()[0]:
+                continue
+            self.dbcursor.execute('ATTACH DATABASE ? AS archive;', (os.path.join(os.path.dirname(DBPATH), archive),))
+            try:
+                self.dbcursor.execute('PRAGMA archive.journal_mode=WAL;')
+                for sql in CREATE_ARCHIVE_TABLES + COPY_TO_ARCHIVE:
+                    self.dbcursor.execute(sql, params if sql in COPY_TO_ARCHIVE else ())
+                self.dbconn.commit()
+                for sql in DELETE_ARCHIVED:
+                    self.dbcursor.execute(sql, params)
+                archived += self.dbcursor.rowcount
+                self.dbcursor.execute(UPDATE_META_GENERATION)
+                self.dbconn.commit()
+            except Exception:
+                self.dbconn.rollback()
+                raise
+            finally:
+                self.dbcursor.execute('DETACH DATABASE archive;')
+        return archived
+
+    def incremental_vacuum(self, pages):
+        '''returns up to "pages" free pages to the file system, each call only holds the write lock
+           for a moment (unlike VACUUM). Returns the number of freed pages, 0 for DBs without
+           auto_vacuum=INCREMENTAL (created by older versions, see vacuum()).'''
+        self.dbcursor.execute('PRAGMA auto_vacuum;')
+        if self.dbcursor.fetchone()[0] != 2:
+            return 0
+        self.dbcursor.execute('PRAGMA freelist_count;')
+        free_pages = self.dbcursor.fetchone()[0]
+        self.dbcursor.execute('PRAGMA incremental_vacuum({:d});'.format(pages)).fetchall()
+        self.dbconn.commit()
+        self.dbcursor.execute('PRAGMA freelist_count;')
+        return free_pages - self.dbcursor.fetchone()[0]
+
+    def vacuum(self):
+        '''full VACUUM, the DB is locked until it is done. Switches DBs created by older versions
+           to auto_vacuum=INCREMENTAL and refills the search index (diffscan rowids change).'''
+        self.dbconn.commit()
+        self.dbcursor.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+        self.dbcursor.execute('VACUUM;')
+        self.dbcursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='search_diffs';")
+        if self.dbcursor.fetchone() is not None:
+            self.rebuild_search_index()
+        self.dbconn.commit()
 
     def dbcommit(self):
         self.dbconn.commit()
@@ -120,175 +987,987 @@ class DB:
         self.dbconn.close()
 
 
-# ----------------------------------------------------- main
-# ---------------------------------------------------- logging
-logging.basicConfig(filename=LOG_FILE, filemode='a', level=logging.INFO)
-logging.getLogger().addHandler(logging.StreamHandler())
-logging.info('\n*** Log file: {}\n'.format(LOG_FILE))
+# ---------------------------------------------------- run metrics
+class RunMetrics:
+    '''phase timings and counters of a single run, saved in run_metrics by DB.finish_run()'''
+    def __init__(self):
+        self.values = {}
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def add(self, name, value):
+        self.values[name] = self.values.get(name, 0) + value
+
+    def add_counters(self, counters):
+        for name, value in counters.items():
+            self.add(name, value)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add('{}_seconds'.format(name), time.monotonic() - start)
+
+    def timed_iter(self, name, iterable):
+        '''counts the time spent producing items as a separate phase'''
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+
+# ---------------------------------------------------- nmap xml
+def parse_host(host):
+    status = host.find('status')
+    target_status = status.get('state', 'unknown') if status is not None else 'unknown'
+
+    target_ip = 'n/a'
+    for address in host.iterfind('address'):
+        if address.get('addrtype') in ('ipv4', 'ipv6'):
+            target_ip = address.get('addr', 'n/a')
+            break
+
+    target_name = '-'
+    hostname = host.find('hostnames/hostname')
+    if hostname is not None:
+        target_name = hostname.get('name', '-')
+
+    target_services = []
+    for port in host.iterfind('ports/port'):
+        state = port.find('state')
+        service = port.find('service')
+        target_services.append({'proto': port.get('protocol'),
+                                'port': int(port.get('portid')),
+                                'state': state.get('state') if state is not None else 'unknown',
+                                'service': service.get('name') if service is not None else 'unknown'})
+    return {'ip': target_ip, 'name': target_name, 'status': target_status, 'services': target_services}
+
+
+def parse_nmap_hosts(xml_source):
+    '''yields hosts one at a time, every parsed <host> element is dropped
+       right away so memory use does not grow with the size of the scan'''
+    context = ElementTree.iterparse(xml_source, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag == 'host':
+            yield parse_host(elem)
+            root.clear()
+
+
+class NmapPipeParser:
+    '''parses nmap XML fed in arbitrary pieces (nmap -oX -), like parse_nmap_hosts()
+       every parsed <host> element is dropped right away'''
+    def __init__(self):
+        self.parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        self.root = None
+
+    def feed(self, data):
+        '''returns the hosts completed by this piece of XML'''
+        self.parser.feed(data)
+        hosts = []
+        for event, elem in self.parser.read_events():
+            if self.root is None:
+                self.root = elem
+            elif event == 'end' and elem.tag == 'host':
+                hosts.append(parse_host(elem))
+                self.root.clear()
+        return hosts
+
+    def close(self):
+        '''raises ElementTree.ParseError when the document is incomplete'''
+        self.parser.close()
+
+
+def merge_nmap_files(xml_files, merged_file):
+    '''copies the <host> elements of all shard results into one nmaprun document'''
+    with open(merged_file, 'wb') as merged:
+        for idx, xml_file in enumerate(xml_files):
+            context = ElementTree.iterparse(xml_file, events=('start', 'end'))
+            _, root = next(context)
+            if idx == 0:
+                attributes = ''.join(' {}={}'.format(key, quoteattr(value)) for key, value in root.attrib.items())
+                merged.write('<?xml version="1.0" encoding="UTF-8"?>\n<nmaprun{}>\n'.format(attributes).encode())
+            for event, elem in context:
+                if event == 'end' and elem.tag == 'host':
+                    merged.write(ElementTree.tostring(elem))
+                    root.clear()
+        merged.write(b'</nmaprun>\n')
+
+
+# ---------------------------------------------------- diff
+def group_by_host(rows):
+    for hostid, services in itertools.groupby(rows, key=lambda row: row[0]):
+        yield hostid, {(row[1], row[2]): (row[3], row[4]) for row in services}
+
+
+def services_fingerprint(services):
+    '''hash of a host's normalized service list, equal as long as its services do not change'''
+    normalized = sorted((service['port'], service['proto'], service['state'], service['service'])
+                        for service in services)
+    return hashlib.blake2b(repr(normalized).encode(), digest_size=16).hexdigest()
+
 
-if not os.path.exists(NMAP_PATH):
-    raise SystemExit('Cannot find nmap: {} does not exist'.format(NMAP_PATH))
-if not os.path.exists(NMAP_DIR):
-    raise SystemExit('Result directory: {} does not exist'.format(NMAP_DIR))
-try:
-    os.chdir(NMAP_DIR)
-except Exception as ex:
-    raise SystemExit('Cannot change directory to {}: {}'.format(NMAP_DIR, ex))
+def diff_services(old, new):
+    '''(port, protocol, (old state, old service), (new state, new service)) for every
+       changed port, the old or new part is None for ports that appeared or disappeared'''
+    changes = [(port, proto, old[(port, proto)], None) for port, proto in old.keys() - new.keys()]
+    changes += [(port, proto, None, new[(port, proto)]) for port, proto in new.keys() - old.keys()]
+    changes += [(port, proto, old[(port, proto)], new[(port, proto)]) for port, proto in old.keys() & new.keys()
+                if old[(port, proto)] != new[(port, proto)]]
+    return sorted(changes, key=lambda change: (change[0], change[1]))
+
+
+def diff_snapshots(previous, current):
+    '''walks two snapshots ordered by host id side by side, yields (host id, changes)
+       for every host whose services differ, only one host per snapshot is kept in memory'''
+    previous = group_by_host(previous)
+    current = group_by_host(current)
+    old = next(previous, None)
+    new = next(current, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            hostid, changes = old[0], diff_services(old[1], {})
+            old = next(previous, None)
+        elif old is None or new[0] < old[0]:
+            hostid, changes = new[0], diff_services({}, new[1])
+            new = next(current, None)
+        else:
+            hostid, changes = new[0], diff_services(old[1], new[1])
+            old = next(previous, None)
+            new = next(current, None)
+        if changes:
+            yield hostid, changes
+
+
+def render_diff(changes):
+    lines = []
+    for port, proto, old, new in changes:
+        if old is not None:
+            lines.append('-{}/{} {} {}'.format(port, proto, *old))
+        if new is not None:
+            lines.append('+{}/{} {} {}'.format(port, proto, *new))
+    return '\n'.join(lines) + '\n'
+
+
+# ---------------------------------------------------- nmap targets
+def ip_key(ip):
+    '''sortable text form of an address ("4:c0a80001"), None for anything else'''
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    return '{}:{}'.format(address.version, address.packed.hex())
+
+
+OCTET_RANGE = re.compile(r'^[0-9,*-]+(\.[0-9,*-]+){3}$')
+
+
+def expand_octet(octet):
+    values = []
+    for part in octet.split(','):
+        if part == '*':
+            part = '0-255'
+        if '-' in part:
+            start, end = part.split('-')
+            values += range(int(start or 0), int(end or 255) + 1)
+        else:
+            values.append(int(part))
+    return values
+
+
+def compact_octet(values):
+    ranges = []
+    start = prev = values[0]
+    for value in values[1:]:
+        if value != prev + 1:
+            ranges.append((start, prev))
+            start = value
+        prev = value
+    ranges.append((start, prev))
+    return ','.join(str(first) if first == last else '{}-{}'.format(first, last) for first, last in ranges)
+
+
+def split_target_unit(unit):
+    '''splits a single nmap target spec (CIDR or octet range) in two halves,
+       anything else (host names, single addresses) is returned as it is'''
+    if '/' in unit:
+        try:
+            network = ipaddress.ip_network(unit, strict=False)
+        except ValueError:
+            return [unit]
+        if network.num_addresses > 1:
+            return [str(subnet) for subnet in network.subnets()]
+    elif OCTET_RANGE.match(unit):
+        octets = unit.split('.')
+        for idx, octet in enumerate(octets):
+            values = expand_octet(octet)
+            if len(values) > 1:
+                half = len(values) // 2
+                return ['.'.join(octets[:idx] + [compact_octet(part)] + octets[idx + 1:])
+                        for part in (values[:half], values[half:])]
+    return [unit]
+
+
+def split_target(target, shards):
+    '''splits space separated nmap targets into (at most) the given number of shards'''
+    units = target.split()
+    while len(units) < shards:
+        split_units = [part for unit in units for part in split_target_unit(unit)]
+        if len(split_units) == len(units):
+            break
+        units = split_units
+    shards = min(shards, len(units))
+    return [units[len(units) * idx // shards:len(units) * (idx + 1) // shards] for idx in range(shards)]
 
 
 # ---------------------------------------------------- nmap
-logging.info('*** Starting nmap scan: {}\n'.format(datetime.datetime.now()))
-scan_time = datetime.datetime.now()
-NMAP_FILE = 'scan_{}.xml'.format(scan_time.strftime('%Y%m%d-%H%M%S'))
-LAST_FILE = 'last'
-logging.info('    {} saving results to {}'.format(scan_time, NMAP_FILE))
+async def run_nmap(xml_file, targets, options, nmap_slots, skip_ping=True, pipe=None):
+    '''nmap_slots is the semaphore shared by all profiles, it caps the number of nmap processes.
+       Long target lists are passed in a file (-iL). With a pipe nmap writes its XML to stdout
+       instead of xml_file and pipe(xml_file, stdout) reads it while nmap is running.'''
+    nmap_exec = [NMAP_PATH, '-v0', '-oX', '-' if pipe else xml_file] + (['-Pn'] if skip_ping else []) + options
+    targets_file = None
+    if len(targets) > NMAP_TARGETS_MAX:
+        targets_file = '{}.targets'.format(xml_file)
+        with open(targets_file, 'w') as target_list:
+            target_list.write('\n'.join(targets) + '\n')
+        nmap_exec += ['-iL', targets_file]
+    else:
+        nmap_exec += targets
+    try:
+        async with nmap_slots:
+            process = await asyncio.create_subprocess_exec(
+                *nmap_exec, stdout=asyncio.subprocess.PIPE if pipe else None)
+            try:
+                if pipe is not None:
+                    await pipe(xml_file, process.stdout)
+                return await process.wait()
+            except BaseException:
+                if process.returncode is None:
+                    process.kill()
+                raise
+    finally:
+        if targets_file is not None:
+            os.remove(targets_file)
 
-NMAP_EXEC = [NMAP_PATH, '-Pn', '-v0', '-oX']
-NMAP_EXEC.append(NMAP_FILE)
-NMAP_EXEC += NMAP_OPTS
-NMAP_EXEC.append(NMAP_TARGET)
 
-result = subprocess.call(NMAP_EXEC)
-if result != 0:
-    raise SystemExit('nmap scan failed')
-logging.info('\n*** Nmap scan finished: {}\n'.format(datetime.datetime.now()))
+async def nmap_scan(xml_file, profile, nmap_slots, skip_ping=True, pipe=None):
+    '''runs nmap over the profile's target, with more than one shard the target is split and
+       scanned by parallel nmap processes, results are merged into xml_file (piped shards are
+       read by the pipe one by one, see run_nmap)'''
+    shards = split_target(profile['target'], profile.get('shards', 1))
+    if len(shards) == 1:
+        return await run_nmap(xml_file, shards[0], profile.get('options', []), nmap_slots, skip_ping, pipe)
+
+    shard_files = ['{}.{}'.format(xml_file, idx) for idx in range(len(shards))]
+    for shard_file, targets in zip(shard_files, shards):
+        logging.info('    shard {}: {}'.format(shard_file, ' '.join(targets)))
+    tasks = [asyncio.ensure_future(run_nmap(shard_file, targets, profile.get('options', []), nmap_slots,
+                                            skip_ping, pipe))
+             for shard_file, targets in zip(shard_files, shards)]
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    result = next((result for result in results if result != 0), 0)
+    if result == 0 and pipe is None:
+        await asyncio.get_running_loop().run_in_executor(None, merge_nmap_files, shard_files, xml_file)
+    for shard_file in shard_files:
+        if os.path.exists(shard_file):
+            os.remove(shard_file)
+    return result
 
 
 # ---------------------------------------------------- db check & create
-if not os.path.exists(DBDIR):
-    raise SystemExit('Snapshotter directory: {} does not exist'.format(DBDIR))
-if not os.path.exists(DBPATH):
-    logging.warning('*** DB does not exist, creating...')
+def open_db():
+    if not os.path.exists(DBDIR):
+        raise SystemExit('Snapshotter directory: {} does not exist'.format(DBDIR))
+    if not os.path.exists(DBPATH):
+        logging.warning('*** DB does not exist, creating...')
+        try:
+            db = DB()
+            db.create_tables()
+        except Exception as ex:
+            if os.path.exists(DBPATH):
+                os.remove(DBPATH)
+            raise SystemExit('Cannot create db (check directory rights): {}'.format(ex))
+        else:
+            db.dbclose()
+
     try:
         db = DB()
         db.create_tables()
+        if db.migrate_fullscan():
+            logging.warning('*** Old fullscan table converted to observation intervals')
+        if not db.stats_built():
+            logging.warning('*** Building dashboard statistics...')
+            db.rebuild_stats()
     except Exception as ex:
-        if os.path.exists(DBPATH):
-            os.remove(DBPATH)
-        raise SystemExit('Cannot create db (check directory rights): {}'.format(ex))
-    else:
-        db.dbclose()
+        raise SystemExit('Cannot connect to DB: {}'.format(ex))
+    return db
 
 
-# ---------------------------------------------------- db connect
-try:
-    db = DB()
-except Exception as ex:
-    raise SystemExit('Cannot connect to DB: {}'.format(ex))
-now = int(datetime.datetime.timestamp(datetime.datetime.now()))
+# ---------------------------------------------------- scan run
+class ScanError(Exception):
+    pass
 
 
-# ---------------------------------------------------- full scan
-with open(NMAP_FILE) as xml_file:
-    nmap_result = xmltodict.parse(xml_file.read())
-xml_file.close()
+@contextlib.contextmanager
+def profile_lock(name):
+    '''only one run of a profile at a time, also across separate nsnap.py processes'''
+    with open('.nsnap_{}.lock'.format(name), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise ScanError('Another {} scan is still running'.format(name))
+        yield
 
-for entry in nmap_result['nmaprun']['host']:
-    target_ip = entry['address'].get('@addr', 'n/a')
 
-    if isinstance(entry['hostnames'], dict):
-        target_name = entry['hostnames']['hostname']['@name']
-    else:
-        target_name = '-'
+def ingest_scan(db, run_id, now, name, nmap_file, metrics, scan_start, scope=None, upload=None):
+    '''parses the nmap results, stores them and closes the run, called in the DB writer thread.
+       scope: addresses of a partial scan, nmap_file is None when it is empty, upload: (agent, upload)'''
+    # full scan, parsing is interleaved with the ingest and timed separately
+    hosts = parse_nmap_hosts(nmap_file) if nmap_file is not None else []
+    try:
+        with metrics.phase('ingest'):
+            total_hosts, total_ports = db.ingest_hosts(metrics.timed_iter('parse', hosts), now, name, run_id)
+        metrics.add('ingest_seconds', -metrics.values.get('parse_seconds', 0))
+    except Exception as ex:
+        db.finish_run(run_id, 'failed', time.monotonic() - scan_start, metrics=metrics)
+        raise ScanError('Cannot save scan results: {}'.format(ex))
+    return diff_scan(db, run_id, now, name, total_hosts, total_ports, metrics, scan_start, scope, upload)
 
-    target_services = []
 
-    if 'port' in entry['ports'].keys():
-        if isinstance(entry['ports']['port'], dict):
-            target_proto = entry['ports']['port']['@protocol']
-            target_port = entry['ports']['port']['@portid']
-            target_state = entry['ports']['port']['state']['@state']
-            target_service = entry['ports']['port']['service']['@name']
-            target_services.append({'proto': target_proto, 'port': target_port, 'state': target_state, 'service': target_service})
-        elif isinstance(entry['ports']['port'], list):
-            for entry_ports in entry['ports']['port']:
-                target_proto = entry_ports['@protocol']
-                target_port = entry_ports['@portid']
-                target_state = entry_ports['state']['@state']
-                target_service = entry_ports['service']['@name']
-                target_services.append({'proto': target_proto, 'port': target_port, 'state': target_state, 'service': target_service})
-
-    if len(target_services) == 0:
-        continue
-
-    logging.info('    {}:{}'.format(target_ip, target_name))
-    db.insert_hostip(target_ip)
-    db.update_hostname(target_ip, target_name)
-    ip_id = db.select_id_by_ip(target_ip)
-    if ip_id != 0 and len(target_services) > 0:
-        for service in target_services:
-            db.update_service(ip_id, now, service)
-db.dbcommit()
-
-if not os.path.exists(LAST_FILE):
-    logging.warning('Previous scan results file does not exist (is this your first scan?)')
+def ingest_chunk(db, run_id, now, name, chunk, targets, chunk_hosts, metrics):
+    '''stores one chunk of a pipelined run or a batch of hosts of a piped run, called in the DB writer thread'''
     try:
-        os.symlink(NMAP_FILE, LAST_FILE)
+        with metrics.phase('ingest'):
+            hosts, ports = db.ingest_hosts(metrics.timed_iter('parse', chunk_hosts), now, name, run_id)
+            db.save_chunk(run_id, chunk, targets, hosts, ports)
     except Exception as ex:
-        logging.warning('Cannot create link to the last(current) scan results file: {}'.format(ex))
-else:
-    # ---------------------------------------------------- diff scan
-    DIFFSCAN_FILE = 'diff_{}.out'.format(scan_time.strftime('%Y%m%d-%H%M%S'))
+        db.dbconn.rollback()
+        db.run_cache.pop(run_id, None)
+        db.take_counters()
+        raise ScanError('Cannot save chunk {} results: {}'.format(chunk, ex))
+    metrics.add_counters(db.take_counters())
+    metrics.add('chunks', 1)
+    logging.info('    chunk {} stored: {} hosts, {} ports'.format(chunk, hosts, ports))
+
+
+def ingest_pending(db, run_id, now, name, metrics, scan_start, scope=None):
+    '''diffs all stored chunks of a pipelined or piped run and closes the run, called in the DB writer thread'''
     try:
-        DIFFSCAN_OPEN = open(DIFFSCAN_FILE, 'w')
+        with metrics.phase('ingest'):
+            total_hosts, total_ports = db.load_pending(run_id)
+        metrics.add('ingest_seconds', -metrics.values.get('parse_seconds', 0))
     except Exception as ex:
-        raise SystemExit('Cannot create diffscan file: {}'.format(ex))
-    result = subprocess.call([NDIFF_PATH, LAST_FILE, NMAP_FILE], stdout=DIFFSCAN_OPEN)
-    DIFFSCAN_OPEN.close()
+        db.finish_run(run_id, 'failed', time.monotonic() - scan_start, metrics=metrics)
+        raise ScanError('Cannot load stored chunks: {}'.format(ex))
+    return diff_scan(db, run_id, now, name, total_hosts, total_ports, metrics, scan_start, scope)
+
 
+def diff_scan(db, run_id, now, name, total_hosts, total_ports, metrics, scan_start, scope=None, upload=None):
+    metrics.set('hosts', total_hosts)
+    metrics.set('ports', total_ports)
+    logging.info('\n*** Hosts scanned ({}): {}'.format(name, total_hosts))
     try:
-        os.remove(LAST_FILE)
+        with metrics.phase('diff'):
+            total_updated = db.update_observations(now, name, scope)
     except Exception as ex:
-        logging.warning('Cannot remove last symlink: {}'.format(ex))
+        db.finish_run(run_id, 'failed', time.monotonic() - scan_start, metrics=metrics)
+        raise ScanError('Cannot save diffscan results: {}'.format(ex))
+    metrics.set('diff_hosts', total_updated)
+    db.finish_run(run_id, 'ok', time.monotonic() - scan_start, total_hosts, total_ports, total_updated, metrics,
+                  upload)
+    return total_updated
+
+
+async def pipelined_scan(db, run_id, now, name, nmap_file, nmap_slots, writer, metrics, done_chunks):
+    '''scans the profile's target in chunks, up to "shards" chunks at a time. Finished chunks go
+       through a bounded queue to the writer thread while the next ones are scanning; when the
+       queue is full no new chunk is started. Returns the number of failed chunks.'''
+    loop = asyncio.get_running_loop()
+    profile = SCAN_PROFILES[name]
+    chunks = [(chunk, targets) for chunk, targets in enumerate(split_target(profile['target'], profile['chunks']))
+              if chunk not in done_chunks]
+    if done_chunks:
+        logging.info('    {}: resuming, {} chunks already stored'.format(name, len(done_chunks)))
+    queue = asyncio.Queue(maxsize=PIPELINE_QUEUE)
+    chunk_slots = asyncio.Semaphore(profile.get('shards', 1))
+
+    async def scan_chunk(chunk, targets):
+        chunk_file = '{}.{}'.format(nmap_file, chunk)
+        async with chunk_slots:
+            with metrics.phase('nmap'):
+                result = await run_nmap(chunk_file, targets, profile.get('options', []), nmap_slots)
+            await queue.put((chunk, targets, chunk_file, result))
+
+    async def store_chunks():
+        failed = 0
+        for _ in chunks:
+            chunk, targets, chunk_file, result = await queue.get()
+            if result == 0:
+                await loop.run_in_executor(writer, ingest_chunk, db, run_id, now, name, chunk, ' '.join(targets),
+                                           parse_nmap_hosts(chunk_file), metrics)
+                metrics.add('xml_bytes', os.path.getsize(chunk_file))
+            else:
+                logging.error('*** nmap failed on chunk {} of {}: {}'.format(chunk, name, ' '.join(targets)))
+                failed += 1
+            if os.path.exists(chunk_file):
+                os.remove(chunk_file)
+        return failed
+
+    tasks = [asyncio.ensure_future(store_chunks())]
+    tasks += [asyncio.ensure_future(scan_chunk(chunk, targets)) for chunk, targets in chunks]
     try:
-        os.symlink(NMAP_FILE, LAST_FILE)
+        return (await asyncio.gather(*tasks))[0]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def read_nmap_pipe(db, run_id, now, name, writer, metrics, batches, xml_file, stdout):
+    '''reads the XML of a piped nmap run as it is produced: it is compressed into XML_FILE.gz/.xz
+       (no uncompressed copy is written) and parsed in the same pass, every PIPE_BATCH hosts or
+       PIPE_FLUSH seconds the parsed hosts are stored as the next chunk (batches) of the run.
+       One batch at a time waits for the writer thread, nmap's output is read meanwhile.
+       Compression and parsing run in the default executor, the event loop keeps serving the other profiles.
+       The parsing time is the run's parse phase, added once the last batch is stored (the writer
+       thread updates the same metrics).'''
+    loop = asyncio.get_running_loop()
+    parser = NmapPipeParser()
+    hosts = []
+    store = None
+    stored = time.monotonic()
+    parse_seconds = 0
+    try:
+        with XML_COMPRESSORS[XML_COMPRESSION]('{}.{}'.format(xml_file, XML_COMPRESSION), 'wb') as archive:
+
+            def feed(data):
+                archive.write(data)
+                start = time.monotonic()
+                parsed = parser.feed(data)
+                return parsed, time.monotonic() - start
+
+            while True:
+                data = await stdout.read(PIPE_READ)
+                if data:
+                    metrics.add('xml_bytes', len(data))
+                    parsed, seconds = await loop.run_in_executor(None, feed, data)
+                    hosts += parsed
+                    parse_seconds += seconds
+                else:
+                    start = time.monotonic()
+                    parser.close()
+                    parse_seconds += time.monotonic() - start
+                if hosts and (not data or len(hosts) >= PIPE_BATCH or time.monotonic() - stored >= PIPE_FLUSH):
+                    if store is not None:
+                        await store
+                    store = loop.run_in_executor(writer, ingest_chunk, db, run_id, now, name, next(batches), '',
+                                                 hosts, metrics)
+                    hosts = []
+                    stored = time.monotonic()
+                if not data:
+                    break
+    finally:
+        if store is not None:
+            await store
+        metrics.add('parse_seconds', parse_seconds)
+
+
+def plan_adaptive_scan(live, known, with_services, changed, now, interval, coverage_days):
+    '''{reason: addresses} of an adaptive run: new, recently changed, unresponsive (services known,
+       missing from the discovery sweep) and overdue hosts are always scanned, the remaining stable
+       hosts in a rotation, least recently scanned first, sized to cover all of them every coverage_days'''
+    coverage = coverage_days * 86400
+    plan = {'new': live - known.keys(), 'changed': changed & known.keys(), 'missing': with_services - live}
+    selected = set().union(*plan.values())
+    plan['overdue'] = {ip for ip, scanned in known.items()
+                       if ip not in selected and (scanned is None or scanned <= now - coverage)}
+    selected |= plan['overdue']
+    stable = sorted((scanned, ip) for ip, scanned in known.items() if ip not in selected)
+    plan['rotation'] = {ip for _, ip in stable[:math.ceil(len(known) * interval / coverage)]}
+    return plan
+
+
+async def adaptive_targets(db, name, now, nmap_file, nmap_slots, writer, metrics):
+    '''host discovery over the profile's target, then picks the addresses to scan (see plan_adaptive_scan)'''
+    loop = asyncio.get_running_loop()
+    profile = SCAN_PROFILES[name]
+    settings = dict(ADAPTIVE_DEFAULTS, **profile['adaptive'])
+    discovery_file = '{}.discovery'.format(nmap_file)
+    with metrics.phase('discovery'):
+        result = await nmap_scan(discovery_file, dict(profile, options=settings['discovery']), nmap_slots,
+                                 skip_ping=False)
+    if result != 0:
+        raise ScanError('nmap host discovery {} failed'.format(name))
+    live = {host['ip'] for host in parse_nmap_hosts(discovery_file) if host['status'] == 'up'}
+    os.remove(discovery_file)
+    known, with_services, changed = await loop.run_in_executor(writer, db.select_adaptive_hosts, name,
+                                                               now - settings['stable_days'] * 86400)
+    plan = plan_adaptive_scan(live, known, with_services, changed, now,
+                              profile.get('interval', 24 * 3600), settings['coverage_days'])
+    targets = sorted(set().union(*plan.values()), key=ipaddress.ip_address)
+    for reason, addresses in plan.items():
+        metrics.set('adaptive_{}'.format(reason), len(addresses))
+    metrics.set('adaptive_live', len(live))
+    metrics.set('adaptive_skipped', len(live | known.keys()) - len(targets))
+    logging.info('    {}: {} live hosts, scanning {} ({})'.format(
+        name, len(live), len(targets), ', '.join('{} {}'.format(reason, len(addresses))
+                                                 for reason, addresses in plan.items())))
+    return targets
+
+
+async def start_run(db, name, writer):
+    '''(run id, timestamp, {chunk: targets} stored so far): registers a new run or, for pipelined
+       profiles, resumes an interrupted run with the same target, options and chunks'''
+    loop = asyncio.get_running_loop()
+    profile = SCAN_PROFILES[name]
+    options = ' '.join(profile.get('options', []))
+    resumable = None
+    if profile.get('chunks'):
+        resumable = await loop.run_in_executor(writer, db.select_resumable_run, name, profile['target'], options)
+    if resumable is not None:
+        chunks = split_target(profile['target'], profile['chunks'])
+        if any(chunk >= len(chunks) or ' '.join(chunks[chunk]) != targets
+               for chunk, targets in resumable[2].items()):
+            resumable = None
+    await loop.run_in_executor(writer, db.abandon_runs, name, resumable[0] if resumable else None)
+    if resumable is not None:
+        await loop.run_in_executor(writer, db.resume_run, resumable[0])
+        return resumable
+    run_id, now = await loop.run_in_executor(writer, db.start_run, int(time.time()), profile['target'], options, name)
+    return run_id, now, {}
+
+
+async def run_scan(db, name, nmap_slots, writer):
+    '''one run of a scan profile: nmap runs in the event loop, every DB access
+       (including the ingest) is done by the single writer thread'''
+    loop = asyncio.get_running_loop()
+    profile = SCAN_PROFILES[name]
+    scan_time = datetime.datetime.now()
+    scan_start = time.monotonic()
+    try:
+        run_id, now, done_chunks = await start_run(db, name, writer)
     except Exception as ex:
-        logging.warning('Cannot create last scan results file symlink: {}'.format(ex))
+        raise ScanError('Cannot register the scan run: {}'.format(ex))
+    nmap_file = 'scan_{}_{}.xml'.format(name, datetime.datetime.fromtimestamp(now).strftime('%Y%m%d-%H%M%S'))
+    logging.info('*** Starting nmap scan {}: {}, saving results to {}'.format(name, scan_time, nmap_file))
+    metrics = RunMetrics()
 
-    if result == 0:
-        logging.info('\n    No differences detected. Done.')
-    elif result != 1:
-        raise SystemExit('Cannot create ndiff file, skipping {}.'.format(result))
+    if profile.get('chunks') and not profile.get('adaptive'):
+        failed = await pipelined_scan(db, run_id, now, name, nmap_file, nmap_slots, writer, metrics, done_chunks)
+        metrics.set('failed_chunks', failed)
+        if failed:
+            await loop.run_in_executor(writer, functools.partial(db.finish_run, run_id, 'incomplete',
+                                                                 time.monotonic() - scan_start, metrics=metrics))
+            raise ScanError('nmap failed on {} chunks of {}, the next run will resume them'.format(failed, name))
+        total_updated = await loop.run_in_executor(writer, ingest_pending, db, run_id, now, name,
+                                                   metrics, scan_start)
     else:
-        target_ip = ''
-        scan_diff = ''
-
-        with open(DIFFSCAN_FILE) as diff_file:
-            total_updated = 0
-            for line in diff_file:
-                if line.startswith('+Nmap') or line.startswith('-Nmap')\
-                    or line.startswith('+Not shown') or line.startswith('-Not shown')\
-                        or line.startswith(' PORT'):
-                    continue
-                if not line.strip():
-                    if target_ip and scan_diff:
-                        ip_id = db.select_id_by_ip(target_ip)
-                        if ip_id != 0:
-                            logging.info('   updating diffscan for {}...'.format(target_ip))
-                            db.update_diff(ip_id, now, scan_diff)
-                            total_updated += 1
-                        else:
-                            logging.warning(' ! host {} not found, cannot send diff !'.format(target_ip))
-                    target_ip = ''
-                    scan_diff = ''
-                elif line.startswith('+') or line.startswith('-'):
-                    scan_diff += line
-                else:
-                    if len(line.split()) == 1:
-                        target_ip = line.strip().strip(':')
-                    else:
-                        target_ip = line.split()[1].strip('():')
-        # last entry:
-        if target_ip and scan_diff:
-            ip_id = db.select_id_by_ip(target_ip)
-            if ip_id != 0:
-                logging.info('   updating diffscan for {}...'.format(target_ip))
-                db.update_diff(ip_id, now, scan_diff)
-                total_updated += 1
+        scope = None
+        pipe = None
+        if profile.get('pipe'):
+            pipe = functools.partial(read_nmap_pipe, db, run_id, now, name, writer, metrics, itertools.count())
+        try:
+            if profile.get('adaptive'):
+                scope = await adaptive_targets(db, name, now, nmap_file, nmap_slots, writer, metrics)
+                profile = dict(profile, target=' '.join(scope))
+            result = 0
+            if scope != []:
+                with metrics.phase('nmap'):
+                    result = await nmap_scan(nmap_file, profile, nmap_slots, pipe=pipe)
+        except (ScanError, ElementTree.ParseError) as ex:
+            logging.error('*** {}: {}'.format(name, ex))
+            result = -1
+        metrics.set('nmap_exit_status', result)
+        if result != 0:
+            if pipe is not None:
+                await loop.run_in_executor(writer, db.drop_pending, run_id)
+            await loop.run_in_executor(writer, functools.partial(db.finish_run, run_id, 'nmap failed',
+                                                                 time.monotonic() - scan_start, metrics=metrics))
+            raise ScanError('nmap scan {} failed'.format(name))
+        logging.info('*** Nmap scan {} finished: {}'.format(name, datetime.datetime.now()))
+        if pipe is not None:
+            # the hosts are already stored as chunks of the run
+            total_updated = await loop.run_in_executor(writer, ingest_pending, db, run_id, now, name,
+                                                       metrics, scan_start, scope)
+        else:
+            if scope == []:
+                nmap_file = None
+            else:
+                metrics.set('xml_bytes', os.path.getsize(nmap_file))
+            total_updated = await loop.run_in_executor(writer, ingest_scan, db, run_id, now, name,
+                                                       nmap_file, metrics, scan_start, scope)
+
+    logging.info('    {} phases: {}'.format(name, ', '.join('{} {:.2f}s'.format(phase[:-8], value)
+                                                            for phase, value in metrics.values.items()
+                                                            if phase.endswith('_seconds'))))
+    if total_updated == 0:
+        logging.info('    {}: no differences detected. Done.'.format(name))
+    else:
+        logging.info('*** Hosts changed ({}): {}'.format(name, total_updated))
+
+
+async def run_profile(db, name, nmap_slots, writer):
+    '''db is None in the agent mode'''
+    with profile_lock(name):
+        if db is None:
+            await agent_scan(name, nmap_slots, writer)
+        else:
+            await run_scan(db, name, nmap_slots, writer)
+
+
+async def schedule_profile(db, name, nmap_slots, writer):
+    '''runs a profile every "interval" seconds, counted from the last successful run in the DB'''
+    loop = asyncio.get_running_loop()
+    interval = SCAN_PROFILES[name]['interval']
+    last_scan = None
+    if db is not None:
+        last_scan = await loop.run_in_executor(writer, db.select_last_scan, name)
+    next_run = last_scan + interval if last_scan is not None else time.time()
+    while True:
+        if next_run > time.time():
+            logging.info('    next {} scan: {}'.format(name, datetime.datetime.fromtimestamp(next_run)))
+            await asyncio.sleep(next_run - time.time())
+        next_run = time.time() + interval
+        try:
+            await run_profile(db, name, nmap_slots, writer)
+        except ScanError as ex:
+            logging.error('*** {}'.format(ex))
+        await apply_retention(db, writer)
+
+
+# ---------------------------------------------------- agent mode
+async def agent_scan(name, nmap_slots, writer):
+    '''agent mode run: the profile is scanned and its compressed results are spooled and sent to
+       the central node. There is no local history, so adaptive profiles scan their whole target
+       and chunked profiles are not checkpointed.'''
+    loop = asyncio.get_running_loop()
+    profile = SCAN_PROFILES[name]
+    now = int(time.time())
+    nmap_file = 'scan_{}_{}.xml'.format(name, datetime.datetime.fromtimestamp(now).strftime('%Y%m%d-%H%M%S'))
+    logging.info('*** Starting nmap scan {}: {}, saving results to {}'.format(name, datetime.datetime.now(), nmap_file))
+    scan_start = time.monotonic()
+    if await nmap_scan(nmap_file, profile, nmap_slots) != 0:
+        raise ScanError('nmap scan {} failed'.format(name))
+    logging.info('*** Nmap scan {} finished: {}'.format(name, datetime.datetime.now()))
+    await loop.run_in_executor(writer, spool_scan, name, now, nmap_file, time.monotonic() - scan_start)
+    left = await loop.run_in_executor(writer, flush_spool)
+    if left:
+        logging.error('*** {} uploads left in {}, they will be sent on the next run'.format(left, SPOOL_DIR))
+
+
+def spool_scan(name, now, nmap_file, nmap_seconds):
+    '''SPOOL_DIR/UPLOAD.xml.gz and UPLOAD.json (metadata, written last: the upload is complete)'''
+    profile = SCAN_PROFILES[name]
+    upload = '{}_{}'.format(now, name)
+    spool_file = os.path.join(SPOOL_DIR, upload)
+    with open(nmap_file, 'rb') as source, gzip.open(spool_file + '.xml.gz', 'wb') as spooled:
+        shutil.copyfileobj(source, spooled)
+    meta = {'agent': AGENT_NAME, 'upload': upload, 'profile': name, 'timestamp': now, 'target': profile['target'],
+            'options': ' '.join(profile.get('options', [])), 'nmap_seconds': round(nmap_seconds, 3)}
+    with open(spool_file + '.tmp', 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(spool_file + '.tmp', spool_file + '.json')
+
+
+def send_upload(meta, xml_file):
+    with open(xml_file, 'rb') as body:
+        request = urllib.request.Request(AGENT_URL, data=body, method='POST', headers={
+            'Authorization': 'Bearer {}'.format(AGENT_TOKEN), 'Content-Type': 'application/gzip',
+            'Content-Length': str(os.path.getsize(xml_file)), 'X-Nsnap-Run': json.dumps(meta)})
+        with urllib.request.urlopen(request, timeout=AGENT_TIMEOUT):
+            pass
+
+
+def deliver_upload(meta, xml_file):
+    '''"sent", "rejected" (the central node will never accept it) or "failed" after AGENT_RETRIES attempts'''
+    for attempt in range(AGENT_RETRIES):
+        if attempt:
+            time.sleep(2 ** attempt)
+        try:
+            send_upload(meta, xml_file)
+        except urllib.error.HTTPError as ex:
+            logging.warning('    upload {} to {}: HTTP {}'.format(meta['upload'], AGENT_URL, ex.code))
+            if ex.code in (400, 413):
+                return 'rejected'
+        except OSError as ex:
+            logging.warning('    upload {} to {} failed: {}'.format(meta['upload'], AGENT_URL, ex))
+        else:
+            return 'sent'
+    return 'failed'
+
+
+def flush_spool():
+    '''sends the spooled uploads, oldest first, and returns the number left in the spool. Stops at
+       the first one that cannot be delivered, so the runs of a profile always arrive in order.'''
+    uploads = sorted(name[:-5] for name in os.listdir(SPOOL_DIR) if name.endswith('.json'))
+    for idx, upload in enumerate(uploads):
+        spool_file = os.path.join(SPOOL_DIR, upload)
+        with open(spool_file + '.json') as meta_file:
+            meta = json.load(meta_file)
+        status = deliver_upload(meta, spool_file + '.xml.gz')
+        if status == 'failed':
+            return len(uploads) - idx
+        if status == 'rejected':
+            logging.error('*** upload {} rejected, kept as {}.rejected'.format(upload, spool_file))
+            os.replace(spool_file + '.json', spool_file + '.rejected')
+            continue
+        os.remove(spool_file + '.xml.gz')
+        os.remove(spool_file + '.json')
+        logging.info('    upload {} sent to {}'.format(upload, AGENT_URL))
+    return 0
+
+
+# ---------------------------------------------------- agent uploads (central node)
+def ingest_upload(db, upload_file):
+    '''stores one agent upload (UPLOAD.json and UPLOAD.xml.gz) as a run of profile AGENT/PROFILE,
+       called in the DB writer thread'''
+    with open(upload_file + '.json') as meta_file:
+        meta = json.load(meta_file)
+    name = '{}/{}'.format(meta['agent'], meta['profile'])
+    if db.select_upload(meta['agent'], meta['upload']) is not None:
+        logging.info('    {}: upload {} was already stored'.format(name, meta['upload']))
+        return
+    # uploads arrive in order, a run only lands in the past when its timestamp was taken by another run
+    timestamp = max(meta['timestamp'], (db.select_last_scan(name) or 0) + 1)
+    scan_start = time.monotonic()
+    run_id, now = db.start_run(timestamp, meta['target'], meta['options'], name)
+    metrics = RunMetrics()
+    metrics.set('nmap_seconds', meta.get('nmap_seconds', 0))
+    metrics.set('xml_bytes', os.path.getsize(upload_file + '.xml.gz'))
+    with gzip.open(upload_file + '.xml.gz') as nmap_file:
+        total_updated = ingest_scan(db, run_id, now, name, nmap_file, metrics, scan_start,
+                                    upload=(meta['agent'], meta['upload']))
+    logging.info('*** Upload {} stored as {} run {}, hosts changed: {}'.format(meta['upload'], name, run_id,
+                                                                             total_updated))
+
+
+def ingest_inbox(db):
+    '''stores the complete uploads in INBOX_DIR (runs of every agent profile in order), called in
+       the DB writer thread. Stored uploads are removed, failed ones kept as UPLOAD.failed.'''
+    if not os.path.isdir(INBOX_DIR):
+        return
+    with profile_lock('inbox'):
+        for upload in sorted(name[:-5] for name in os.listdir(INBOX_DIR) if name.endswith('.json')):
+            upload_file = os.path.join(INBOX_DIR, upload)
+            try:
+                ingest_upload(db, upload_file)
+            except (ScanError, OSError, EOFError, ValueError, KeyError) as ex:
+                logging.error('*** Cannot store upload {}: {}'.format(upload, ex))
+                os.replace(upload_file + '.json', upload_file + '.failed')
+                continue
+            os.remove(upload_file + '.xml.gz')
+            os.remove(upload_file + '.json')
+
+
+async def watch_inbox(db, writer):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(writer, ingest_inbox, db)
+        except ScanError as ex:
+            logging.error('*** {}'.format(ex))
+        await asyncio.sleep(INBOX_POLL)
+
+
+# ---------------------------------------------------- retention
+SCAN_FILE = re.compile(r'^scan_(.+)_(\d{8}-\d{6})\.xml$')
+COMPRESSED_SCAN_FILE = re.compile(r'^scan_.+\.xml(\.\d+)?\.(gz|xz)$')
+XML_COMPRESSORS = {'gz': gzip.open, 'xz': lzma.open}
+
+
+def archive_period(timestamp):
+    '''(archive DB file name, start, end) of the ARCHIVE_PERIOD a timestamp belongs to, eg. nsnap-2020.sqlite3'''
+    start = datetime.datetime.fromtimestamp(timestamp).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if ARCHIVE_PERIOD == 'month':
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        period = start.strftime('%Y-%m')
+    else:
+        start = start.replace(month=1)
+        end = start.replace(year=start.year + 1)
+        period = start.strftime('%Y')
+    archive = '{}-{}.sqlite3'.format(os.path.splitext(os.path.basename(DBPATH))[0], period)
+    return archive, int(start.timestamp()), int(end.timestamp())
+
+
+def compress_file(name):
+    '''streams a file into NAME.gz/NAME.xz (keeping its modification time), the original
+       is removed once the compressed copy is complete'''
+    compressed_name = '{}.{}'.format(name, XML_COMPRESSION)
+    with open(name, 'rb') as source, XML_COMPRESSORS[XML_COMPRESSION](compressed_name + '.tmp', 'wb') as compressed:
+        shutil.copyfileobj(source, compressed)
+    shutil.copystat(name, compressed_name + '.tmp')
+    os.replace(compressed_name + '.tmp', compressed_name)
+    os.remove(name)
+
+
+def compress_scans():
+    '''compresses all but the last KEEP_XML scan files of every profile in NMAP_DIR (the working
+       directory) and removes the compressed ones older than KEEP_COMPRESSED_DAYS.
+       Returns (compressed, removed) file counts.'''
+    scans = {}
+    for name in os.listdir('.'):
+        match = SCAN_FILE.match(name)
+        if match:
+            scans.setdefault(match.group(1), []).append((match.group(2), name))
+    compressed = 0
+    for files in scans.values():
+        # the newest file of a profile may still be written by nmap
+        for _, name in sorted(files)[:-max(KEEP_XML, 1)]:
+            compress_file(name)
+            compressed += 1
+    removed = 0
+    if KEEP_COMPRESSED_DAYS is not None:
+        oldest = time.time() - KEEP_COMPRESSED_DAYS * 86400
+        for name in os.listdir('.'):
+            if COMPRESSED_SCAN_FILE.match(name) and os.path.getmtime(name) < oldest:
+                os.remove(name)
+                removed += 1
+    return compressed, removed
+
+
+def maintain_db(db):
+    '''archives the runs older than ARCHIVE_DAYS and returns up to VACUUM_PAGES free pages
+       to the file system, called in the DB writer thread'''
+    try:
+        if ARCHIVE_DAYS is not None:
+            archived = db.archive_runs(int(time.time()) - ARCHIVE_DAYS * 86400)
+            if archived:
+                logging.info('    {} runs archived'.format(archived))
+        if VACUUM_PAGES:
+            freed = db.incremental_vacuum(VACUUM_PAGES)
+            if freed:
+                logging.info('    {} free DB pages released'.format(freed))
+    except sqlite3.Error as ex:
+        logging.error('*** DB retention failed: {}'.format(ex))
+
+
+async def apply_retention(db, writer):
+    '''compresses old scan files (outside of the writer thread) and, with a DB, archives and vacuums,
+       skipped while another run of this or another nsnap.py process is doing it'''
+    loop = asyncio.get_running_loop()
+    try:
+        with profile_lock('retention'):
+            try:
+                compressed, removed = await loop.run_in_executor(None, compress_scans)
+            except OSError as ex:
+                logging.error('*** Cannot compress scan files: {}'.format(ex))
             else:
-                logging.warning(' ! host {} not found, cannot send diff !'.format(target_ip))
-        db.dbcommit()
-        logging.info('\n*** Hosts changed: {}'.format(total_updated))
+                if compressed or removed:
+                    logging.info('    scan files compressed: {}, removed: {}'.format(compressed, removed))
+            if db is not None:
+                await loop.run_in_executor(writer, maintain_db, db)
+    except ScanError:
+        logging.info('    retention is already running')
+
+
+async def run_profiles(names, daemon=False, agent=False):
+    nmap_slots = asyncio.Semaphore(NMAP_WORKERS)
+    loop = asyncio.get_running_loop()
+    # stop cleanly on SIGTERM (systemctl stop): nmap processes are killed, stored chunks are kept
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        # in the agent mode the writer thread only spools and sends uploads
+        db = None if agent else await loop.run_in_executor(writer, open_db)
+        try:
+            if daemon:
+                tasks = [schedule_profile(db, name, nmap_slots, writer) for name in names]
+                if db is not None:
+                    tasks.append(watch_inbox(db, writer))
+                await asyncio.gather(*tasks)
+            else:
+                results = await asyncio.gather(*(run_profile(db, name, nmap_slots, writer) for name in names),
+                                               return_exceptions=True)
+                errors = [result for result in results if isinstance(result, Exception)]
+                if db is not None:
+                    try:
+                        await loop.run_in_executor(writer, ingest_inbox, db)
+                    except ScanError as ex:
+                        errors.append(ex)
+                await apply_retention(db, writer)
+                for error in errors[:-1]:
+                    logging.error('*** {}'.format(error))
+                if errors:
+                    raise errors[-1]
+        finally:
+            if db is not None:
+                await loop.run_in_executor(writer, db.dbclose)
+
+
+# ----------------------------------------------------- main
+def main():
+    parser = argparse.ArgumentParser(description='nmap snapshots')
+    parser.add_argument('--profile', action='append', choices=sorted(SCAN_PROFILES),
+                        help='scan profile, can be repeated (default: all profiles, scanned in parallel)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and scan every profile with an interval on schedule')
+    parser.add_argument('--agent', action='store_true',
+                        help='send the scan results to the central nsnap-web.py (AGENT_URL) instead of the DB')
+    parser.add_argument('--inbox', action='store_true',
+                        help='do not scan, only store the agent uploads waiting in INBOX_DIR')
+    parser.add_argument('--rebuild-stats', action='store_true',
+                        help='do not scan, recompute the dashboard statistics from the whole history')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='do not scan, run a full VACUUM (locks the DB, switches older DBs to incremental vacuum)')
+    args = parser.parse_args()
+    if args.agent and args.inbox:
+        parser.error('--agent and --inbox cannot be used together')
+    names = args.profile or sorted(SCAN_PROFILES)
+    if args.inbox:
+        names = []
+    if args.daemon:
+        names = [name for name in names if SCAN_PROFILES[name].get('interval')]
+
+    logging.basicConfig(filename=LOG_FILE, filemode='a', level=logging.INFO)
+    logging.getLogger().addHandler(logging.StreamHandler())
+    logging.info('\n*** Log file: {}\n'.format(LOG_FILE))
+
+    if args.rebuild_stats:
+        db = open_db()
+        try:
+            db.rebuild_stats()
+        except sqlite3.Error as ex:
+            raise SystemExit('Cannot rebuild the statistics: {}'.format(ex))
+        db.dbclose()
+        logging.info('\n*** Statistics rebuilt: {}\n'.format(datetime.datetime.now()))
+        return
+    if args.vacuum:
+        db = open_db()
+        try:
+            db.vacuum()
+        except sqlite3.Error as ex:
+            raise SystemExit('Cannot vacuum the DB: {}'.format(ex))
+        db.dbclose()
+        logging.info('\n*** DB vacuumed: {}\n'.format(datetime.datetime.now()))
+        return
+    if not os.path.exists(NMAP_PATH):
+        raise SystemExit('Cannot find nmap: {} does not exist'.format(NMAP_PATH))
+    if not os.path.exists(NMAP_DIR):
+        raise SystemExit('Result directory: {} does not exist'.format(NMAP_DIR))
+    if args.agent and not os.path.isdir(SPOOL_DIR):
+        raise SystemExit('Spool directory: {} does not exist'.format(SPOOL_DIR))
+    try:
+        os.chdir(NMAP_DIR)
+    except Exception as ex:
+        raise SystemExit('Cannot change directory to {}: {}'.format(NMAP_DIR, ex))
+
+    try:
+        asyncio.run(run_profiles(names, args.daemon, args.agent))
+    except ScanError as ex:
+        raise SystemExit(ex)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        raise SystemExit('Interrupted')
+    logging.info('\n*** Finished: {}\n'.format(datetime.datetime.now()))
+
 
-db.dbclose()
-logging.info('\n*** Finished: {}\n'.format(datetime.datetime.now()))
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import os
+import threading
+import importlib.util
+
+import pytest
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_module(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(BASEDIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def nsnap_module():
+    return load_module('nsnap', 'nsnap.py')
+
+
+@pytest.fixture(scope='session')
+def web_module():
+    pytest.importorskip('flask')
+    pytest.importorskip('flask_bootstrap')
+    return load_module('nsnap_web', 'nsnap-web.py')
+
+
+@pytest.fixture
+def nsnap(nsnap_module, tmp_path, monkeypatch):
+    '''nsnap.py with its DB and scan files in a scratch directory'''
+    monkeypatch.setattr(nsnap_module, 'DBDIR', str(tmp_path))
+    monkeypatch.setattr(nsnap_module, 'DBPATH', str(tmp_path / 'nsnap.sqlite3'))
+    monkeypatch.setattr(nsnap_module, 'NMAP_DIR', str(tmp_path))
+    monkeypatch.setattr(nsnap_module, 'ARCHIVE_PERIOD', 'month')
+    return nsnap_module
+
+
+@pytest.fixture
+def web(web_module, nsnap, monkeypatch):
+    '''nsnap-web.py reading the DB of the nsnap fixture (in a request context), with fresh
+       per-thread connections'''
+    monkeypatch.setattr(web_module, 'DBPATH', nsnap.DBPATH)
+    monkeypatch.setattr(web_module, 'connections', threading.local())
+    with web_module.app.test_request_context():
+        yield web_module
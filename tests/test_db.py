@@ -0,0 +1,249 @@
+import time
+import sqlite3
+import datetime
+
+import pytest
+
+# three scans of the same network: a port closes and reopens, a host comes and goes
+SCANS = [
+    {'10.0.0.1': [(22, 'tcp', 'open', 'ssh'), (80, 'tcp', 'open', 'http')],
+     '10.0.0.2': [(443, 'tcp', 'open', 'https')]},
+    {'10.0.0.1': [(22, 'tcp', 'open', 'ssh'), (80, 'tcp', 'closed', 'http')],
+     '10.0.0.2': [(443, 'tcp', 'open', 'https')],
+     '10.0.0.3': [(25, 'tcp', 'open', 'smtp')]},
+    {'10.0.0.1': [(22, 'tcp', 'open', 'ssh'), (80, 'tcp', 'open', 'http')],
+     '10.0.0.2': [(443, 'tcp', 'open', 'https'), (8080, 'tcp', 'open', 'http-proxy')]},
+]
+# one scan per month, so monthly archives split them
+TIMESTAMPS = [int(datetime.datetime(2020, month, 15, 1, 0).timestamp()) for month in (4, 5, 6)]
+CHANGED_HOSTS = [0, 2, 3]
+STATS_TABLES = ['host_services', 'service_stats', 'host_stats', 'run_stats']
+
+
+def write_scan(xml_file, scan):
+    with open(xml_file, 'w') as xml:
+        xml.write('<?xml version="1.0"?><nmaprun scanner="nmap">')
+        for ip, ports in sorted(scan.items()):
+            xml.write('<host><status state="up"/><address addr="{}" addrtype="ipv4"/><hostnames/><ports>'.format(ip))
+            for port, protocol, state, service in ports:
+                xml.write('<port protocol="{}" portid="{}"><state state="{}"/><service name="{}"/></port>'.format(
+                    protocol, port, state, service))
+            xml.write('</ports></host>')
+        xml.write('</nmaprun>')
+
+
+def store_scans(nsnap, tmp_path):
+    '''stores SCANS as runs of the default profile like nsnap.py does, returns the changed hosts of every run'''
+    db = nsnap.open_db()
+    changed = []
+    for timestamp, scan in zip(TIMESTAMPS, SCANS):
+        xml_file = str(tmp_path / 'scan_default_{}.xml'.format(timestamp))
+        write_scan(xml_file, scan)
+        run_id, now = db.start_run(timestamp, '10.0.0.0/24', '-sT')
+        assert now == timestamp
+        changed.append(nsnap.ingest_scan(db, run_id, now, 'default', xml_file, nsnap.RunMetrics(), time.monotonic()))
+    return db, changed
+
+
+def expected_snapshot(scan):
+    return {(ip,) + port for ip, ports in scan.items() for port in ports}
+
+
+def snapshot(web, updated):
+    '''the scan stored under "updated" (0: the current state) as nsnap-web.py rebuilds it'''
+    db = web.DB()
+    hosts = {host[0]: host[1] for host in db.get_hosts()}
+    rows = db.get_services(updated=updated)
+    assert not db.error, db.error_msg
+    db.dbclose()
+    return {(hosts[row[0]],) + tuple(row[2:]) for row in rows}
+
+
+def diffs(web, updated):
+    db = web.DB()
+    hosts = {host[0]: host[1] for host in db.get_hosts()}
+    rows = db.get_diffs(updated=updated)
+    assert not db.error, db.error_msg
+    db.dbclose()
+    return sorted((hosts[row[0]], row[2]) for row in rows)
+
+
+def table(dbconn, name):
+    return sorted(dbconn.execute('SELECT * FROM {};'.format(name)).fetchall())
+
+
+def test_observation_intervals(nsnap, tmp_path):
+    db, changed = store_scans(nsnap, tmp_path)
+    assert changed == CHANGED_HOSTS
+    rows = db.dbconn.execute('SELECT ip, port, state, first_seen, last_seen FROM observations '
+                             'JOIN hosts USING(id) ORDER BY ip, port, first_seen;').fetchall()
+    first, second, third = TIMESTAMPS
+    # a row is only written when a port changes, an interval still open has no last_seen
+    assert rows == [('10.0.0.1', 22, 'open', first, None),
+                    ('10.0.0.1', 80, 'open', first, first),
+                    ('10.0.0.1', 80, 'closed', second, second),
+                    ('10.0.0.1', 80, 'open', third, None),
+                    ('10.0.0.2', 443, 'open', first, None),
+                    ('10.0.0.2', 8080, 'open', third, None),
+                    ('10.0.0.3', 25, 'open', second, second)]
+    assert db.dbconn.execute("SELECT updated, status, hosts, ports, changed FROM runs ORDER BY updated;").fetchall() \
+        == [(first, 'ok', 2, 3, 0), (second, 'ok', 3, 4, 2), (third, 'ok', 2, 4, 3)]
+    ports = db.dbconn.execute('SELECT ip, updated, port, old_state, new_state FROM diffports JOIN hosts USING(id) '
+                              'ORDER BY updated, ip, port;').fetchall()
+    assert ports == [('10.0.0.1', second, 80, 'open', 'closed'),
+                     ('10.0.0.3', second, 25, None, 'open'),
+                     ('10.0.0.1', third, 80, 'closed', 'open'),
+                     ('10.0.0.2', third, 8080, None, 'open'),
+                     ('10.0.0.3', third, 25, 'open', None)]
+    db.dbclose()
+
+
+def test_snapshots(nsnap, web, tmp_path):
+    store_scans(nsnap, tmp_path)[0].dbclose()
+    for timestamp, scan in zip(TIMESTAMPS, SCANS):
+        assert snapshot(web, timestamp) == expected_snapshot(scan)
+    assert snapshot(web, 0) == expected_snapshot(SCANS[-1])
+    assert [host for host, _ in diffs(web, TIMESTAMPS[1])] == ['10.0.0.1', '10.0.0.3']
+
+
+def test_migrate_fullscan(nsnap, web, tmp_path):
+    '''a v1.0 DB (a full copy of every scan in fullscan) is converted into the same intervals'''
+    dbconn = sqlite3.connect(nsnap.DBPATH)
+    dbconn.execute('CREATE TABLE hosts (id INTEGER PRIMARY KEY, ip text NOT NULL, name text, UNIQUE(ip));')
+    dbconn.execute('CREATE TABLE fullscan (id INTEGER NOT NULL, updated INTEGER NOT NULL, port INTEGER NOT NULL, '
+                   'protocol TEXT NOT NULL, state TEXT NOT NULL, service TEXT, FOREIGN KEY(id) REFERENCES hosts(id));')
+    dbconn.execute('CREATE TABLE diffscan (id INTEGER NOT NULL, updated INTEGER NOT NULL, diff TEXT NOT NULL, '
+                   'comment TEXT NULL, FOREIGN KEY(id) REFERENCES hosts(id));')
+    hostids = {}
+    for timestamp, scan in zip(TIMESTAMPS, SCANS):
+        for ip, ports in scan.items():
+            if ip not in hostids:
+                hostids[ip] = dbconn.execute("INSERT INTO hosts(ip, name) VALUES(?, '-');", (ip,)).lastrowid
+            dbconn.executemany('INSERT INTO fullscan VALUES(?, ?, ?, ?, ?, ?);',
+                               [(hostids[ip], timestamp) + port for port in ports])
+    dbconn.execute("INSERT INTO diffscan VALUES(?, ?, 'changed', 'checked');", (hostids['10.0.0.3'], TIMESTAMPS[1]))
+    dbconn.commit()
+    dbconn.close()
+
+    nsnap.open_db().dbclose()
+    dbconn = sqlite3.connect(nsnap.DBPATH)
+    assert dbconn.execute("SELECT name FROM sqlite_master WHERE name='fullscan';").fetchone() is None
+    assert dbconn.execute("SELECT updated, status, hosts, ports, changed FROM runs ORDER BY updated;").fetchall() \
+        == [(TIMESTAMPS[0], 'ok', 2, 3, 0), (TIMESTAMPS[1], 'ok', 3, 4, 1), (TIMESTAMPS[2], 'ok', 2, 4, 0)]
+    assert dbconn.execute('SELECT COUNT(*) FROM observations;').fetchone()[0] == 7
+    dbconn.close()
+    for timestamp, scan in zip(TIMESTAMPS, SCANS):
+        assert snapshot(web, timestamp) == expected_snapshot(scan)
+    assert snapshot(web, 0) == expected_snapshot(SCANS[-1])
+    assert diffs(web, TIMESTAMPS[1]) == [('10.0.0.3', 'changed')]
+
+
+def test_incremental_stats_match_rebuild(nsnap, tmp_path):
+    db, _ = store_scans(nsnap, tmp_path)
+    incremental = {name: table(db.dbconn, name) for name in STATS_TABLES}
+    assert dict(db.dbconn.execute('SELECT service, ports FROM service_stats;').fetchall()) == \
+        {'ssh': 1, 'http': 1, 'https': 1, 'http-proxy': 1}
+    db.rebuild_stats()
+    assert {name: table(db.dbconn, name) for name in STATS_TABLES} == incremental
+    db.dbclose()
+
+
+def test_archive_round_trip(nsnap, web, tmp_path):
+    db, _ = store_scans(nsnap, tmp_path)
+    before = {timestamp: (snapshot(web, timestamp), diffs(web, timestamp)) for timestamp in TIMESTAMPS}
+    archived = db.archive_runs(TIMESTAMPS[2])
+    assert archived == 2
+    assert sorted(path.name for path in tmp_path.glob('nsnap-*.sqlite3')) == \
+        ['nsnap-2020-04.sqlite3', 'nsnap-2020-05.sqlite3']
+    assert db.dbconn.execute('SELECT updated, archive FROM runs ORDER BY updated;').fetchall() == \
+        [(TIMESTAMPS[0], 'nsnap-2020-04.sqlite3'), (TIMESTAMPS[1], 'nsnap-2020-05.sqlite3'), (TIMESTAMPS[2], None)]
+    # closed intervals and diffs of the archived runs are gone from the live DB
+    assert db.dbconn.execute('SELECT COUNT(*) FROM observations WHERE last_seen<?;',
+                             (TIMESTAMPS[2],)).fetchone()[0] == 0
+    assert db.dbconn.execute('SELECT COUNT(*) FROM diffscan WHERE updated<?;', (TIMESTAMPS[2],)).fetchone()[0] == 0
+    # archiving again changes nothing
+    assert db.archive_runs(TIMESTAMPS[2]) == 0
+    db.dbclose()
+    after = {timestamp: (snapshot(web, timestamp), diffs(web, timestamp)) for timestamp in TIMESTAMPS}
+    assert after == before
+
+
+@pytest.mark.parametrize('timestamp, expected', [
+    (datetime.datetime(2020, 12, 31, 23, 59), ('nsnap-2020-12.sqlite3', (2020, 12, 1), (2021, 1, 1))),
+    (datetime.datetime(2020, 2, 29, 12, 0), ('nsnap-2020-02.sqlite3', (2020, 2, 1), (2020, 3, 1))),
+])
+def test_archive_period(nsnap, timestamp, expected):
+    archive, start, end = nsnap.archive_period(int(timestamp.timestamp()))
+    assert (archive, datetime.datetime.fromtimestamp(start), datetime.datetime.fromtimestamp(end)) == \
+        (expected[0], datetime.datetime(*expected[1]), datetime.datetime(*expected[2]))
+
+
+def test_chunks_reuse_the_run_maps(nsnap, tmp_path):
+    '''the host map is loaded by the first chunk of a run, hosts added by another run meanwhile are found'''
+    db = nsnap.open_db()
+    run_id, now = db.start_run(TIMESTAMPS[0], '10.0.0.0/24', '-sT')
+    metrics = nsnap.RunMetrics()
+    first, second = [[{'ip': ip, 'name': '-', 'status': 'up',
+                       'services': [{'port': port, 'proto': protocol, 'state': state, 'service': service}
+                                    for port, protocol, state, service in SCANS[1][ip]]} for ip in ips]
+                     for ips in (['10.0.0.1'], ['10.0.0.2', '10.0.0.3'])]
+    nsnap.ingest_chunk(db, run_id, now, 'default', 0, '10.0.0.1', first, metrics)
+    assert run_id in db.run_cache
+    other = sqlite3.connect(nsnap.DBPATH)
+    other_id = other.execute("INSERT INTO hosts(ip, name) VALUES('10.0.0.3', '-');").lastrowid
+    other.commit()
+    other.close()
+    nsnap.ingest_chunk(db, run_id, now, 'default', 1, '10.0.0.2-3', second, metrics)
+    assert db.run_cache[run_id][0]['10.0.0.3'][0] == other_id
+    nsnap.ingest_pending(db, run_id, now, 'default', metrics, time.monotonic())
+    assert run_id not in db.run_cache
+    assert db.dbconn.execute('SELECT COUNT(*) FROM hosts;').fetchone()[0] == 3
+    assert db.dbconn.execute("SELECT COUNT(*) FROM observations WHERE last_seen IS NULL;").fetchone()[0] == 4
+    db.dbclose()
+
+
+def test_export(nsnap, web, tmp_path):
+    '''exports are streamed past the page cache, a client that has the current one gets a 304'''
+    store_scans(nsnap, tmp_path)[0].dbclose()
+    client = web.app.test_client()
+    response = client.get('/export/services.csv?timestamp={}'.format(TIMESTAMPS[1]))
+    rows = response.get_data(as_text=True).splitlines()
+    assert response.status_code == 200 and response.headers['ETag']
+    assert rows[0] == ','.join(web.EXPORT_COLUMNS['services'])
+    assert {(row.split(',')[1],) + tuple(row.split(',')[4:]) for row in rows[1:]} == \
+        {(ip, str(port), protocol, state, service) for ip, port, protocol, state, service in expected_snapshot(SCANS[1])}
+    assert not any(path.startswith('/export/') for path, _ in web.page_cache.entries)
+    response = client.get('/export/services.csv?timestamp={}'.format(TIMESTAMPS[1]),
+                          headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+
+def test_export_error_row(web):
+    '''a DB error while the rows are sent ends the export with an error line instead of an exception'''
+    def rows():
+        yield (1, '10.0.0.1', '-', 0, 22, 'tcp', 'open', 'ssh')
+        raise sqlite3.OperationalError('disk I/O error')
+    columns = web.EXPORT_COLUMNS['services']
+    assert ''.join(web.export_chunks('csv', columns, rows())).splitlines()[-1] == 'error,disk I/O error'
+    assert ''.join(web.export_chunks('ndjson', columns, rows())).splitlines()[-1] == '{"error": "disk I/O error"}'
+
+
+def test_host_history_includes_archives(nsnap, web, tmp_path):
+    '''the port timeline and the diff history of a host are the same before and after archiving'''
+    db, _ = store_scans(nsnap, tmp_path)
+
+    def history(ip):
+        webdb = web.DB()
+        hostid = next(host[0] for host in webdb.get_hosts() if host[1] == ip)
+        result = (webdb.get_host_timeline(hostid), webdb.get_diff_history(hostid))
+        assert not webdb.error, webdb.error_msg
+        webdb.dbclose()
+        return result
+
+    before = {ip: history(ip) for ip in ('10.0.0.1', '10.0.0.3')}
+    assert [row[5:7] for row in before['10.0.0.1'][0] if row[0] == 80] == \
+        [(TIMESTAMPS[0], TIMESTAMPS[0]), (TIMESTAMPS[1], TIMESTAMPS[1]), (TIMESTAMPS[2], TIMESTAMPS[2])]
+    assert [row[1] for row in before['10.0.0.3'][1]] == [TIMESTAMPS[2], TIMESTAMPS[1]]
+    assert db.archive_runs(TIMESTAMPS[2]) == 2
+    db.dbclose()
+    assert {ip: history(ip) for ip in before} == before
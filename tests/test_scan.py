@@ -0,0 +1,134 @@
+import math
+import time
+import gzip
+import asyncio
+import itertools
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+import pytest
+
+NMAP_XML = b'''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE nmaprun>
+<?xml-stylesheet href="file:///usr/bin/../share/nmap/nmap.xsl" type="text/xsl"?>
+<nmaprun scanner="nmap" args="nmap -oX - 10.0.0.1-3" start="1591000000" version="7.80">
+<host><status state="up" reason="syn-ack"/>
+<address addr="10.0.0.1" addrtype="ipv4"/><address addr="00:11:22:33:44:55" addrtype="mac"/>
+<hostnames><hostname name="gw.example.org" type="PTR"/></hostnames>
+<ports><extraports state="closed" count="997"/>
+<port protocol="tcp" portid="22"><state state="open" reason="syn-ack"/><service name="ssh" method="probed"/></port>
+<port protocol="tcp" portid="80"><state state="filtered" reason="no-response"/></port>
+<port protocol="udp" portid="53"><state state="open" reason="udp-response"/><service name="domain"/></port>
+</ports></host>
+<host><status state="up" reason="syn-ack"/><address addr="10.0.0.2" addrtype="ipv4"/><hostnames/>
+<ports><extraports state="closed" count="1000"/></ports></host>
+<host><status state="up" reason="syn-ack"/><address addr="fd00::3" addrtype="ipv6"/><hostnames/>
+<ports><port protocol="tcp" portid="443"><state state="open" reason="syn-ack"/><service name="https"/></port></ports>
+</host>
+<runstats><finished time="1591000100"/><hosts up="3" down="0" total="3"/></runstats>
+</nmaprun>
+'''
+
+
+def addresses(units):
+    '''all addresses of nmap target units (CIDRs, last octet ranges, single names)'''
+    result = []
+    for unit in units:
+        if '/' in unit:
+            result += [str(address) for address in ipaddress.ip_network(unit)]
+        elif '-' in unit:
+            base, _, last = unit.rpartition('.')
+            low, _, high = last.partition('-')
+            result += ['{}.{}'.format(base, octet) for octet in range(int(low), int(high) + 1)]
+        else:
+            result.append(unit)
+    return result
+
+
+@pytest.mark.parametrize('target, shards, expected', [
+    ('10.0.0.0/24', 4, [['10.0.0.0/26'], ['10.0.0.64/26'], ['10.0.0.128/26'], ['10.0.0.192/26']]),
+    ('10.0.0.1-10', 3, [['10.0.0.1-2'], ['10.0.0.3-5'], ['10.0.0.6-7', '10.0.0.8-10']]),
+    ('10.0.0.1 10.0.0.2 host.example.org', 2, [['10.0.0.1'], ['10.0.0.2', 'host.example.org']]),
+    ('10.0.0.5', 3, [['10.0.0.5']]),
+])
+def test_split_target(nsnap, target, shards, expected):
+    assert nsnap.split_target(target, shards) == expected
+
+
+@pytest.mark.parametrize('target, shards', [('10.0.0.0/22 10.1.0.1-200', 7), ('192.168.0.0/30', 10)])
+def test_split_target_covers_every_address_once(nsnap, target, shards):
+    parts = nsnap.split_target(target, shards)
+    assert len(parts) <= shards
+    assert sorted(addresses(unit for part in parts for unit in part)) == sorted(addresses(target.split()))
+
+
+def test_parse_nmap_hosts(nsnap, tmp_path):
+    xml_file = tmp_path / 'scan.xml'
+    xml_file.write_bytes(NMAP_XML)
+    hosts = list(nsnap.parse_nmap_hosts(str(xml_file)))
+    assert [(host['ip'], host['name']) for host in hosts] == \
+        [('10.0.0.1', 'gw.example.org'), ('10.0.0.2', '-'), ('fd00::3', '-')]
+    assert [(service['port'], service['proto'], service['state'], service['service'])
+            for service in hosts[0]['services']] == \
+        [(22, 'tcp', 'open', 'ssh'), (80, 'tcp', 'filtered', 'unknown'), (53, 'udp', 'open', 'domain')]
+    assert hosts[1]['services'] == []
+
+
+@pytest.mark.parametrize('piece', [1, 7, 100, len(NMAP_XML)])
+def test_pipe_parser_matches_file_parser(nsnap, tmp_path, piece):
+    xml_file = tmp_path / 'scan.xml'
+    xml_file.write_bytes(NMAP_XML)
+    parser = nsnap.NmapPipeParser()
+    hosts = []
+    for start in range(0, len(NMAP_XML), piece):
+        hosts += parser.feed(NMAP_XML[start:start + piece])
+    parser.close()
+    assert hosts == list(nsnap.parse_nmap_hosts(str(xml_file)))
+
+
+def test_pipe_parser_returns_hosts_as_they_end(nsnap):
+    parser = nsnap.NmapPipeParser()
+    first_host_end = NMAP_XML.index(b'</host>') + len(b'</host>')
+    assert [host['ip'] for host in parser.feed(NMAP_XML[:first_host_end])] == ['10.0.0.1']
+    assert [host['ip'] for host in parser.feed(NMAP_XML[first_host_end:])] == ['10.0.0.2', 'fd00::3']
+
+
+def test_pipe_parser_incomplete_output(nsnap):
+    parser = nsnap.NmapPipeParser()
+    parser.feed(NMAP_XML[:NMAP_XML.index(b'<runstats>')])
+    with pytest.raises(ElementTree.ParseError):
+        parser.close()
+
+
+def test_read_nmap_pipe(nsnap, tmp_path, monkeypatch):
+    '''piped output is compressed, stored in batches and its parsing time counted as the parse phase'''
+    monkeypatch.setattr(nsnap, 'PIPE_READ', 100)
+    monkeypatch.setattr(nsnap, 'PIPE_BATCH', 1)
+    monkeypatch.setattr(nsnap, 'XML_COMPRESSION', 'gz')
+
+    class SlowParser(nsnap.NmapPipeParser):
+        def feed(self, data):
+            time.sleep(0.01)
+            return super().feed(data)
+    monkeypatch.setattr(nsnap, 'NmapPipeParser', SlowParser)
+    metrics = nsnap.RunMetrics()
+    xml_file = str(tmp_path / 'scan_default.xml')
+
+    async def read(writer, db, run_id, now):
+        stdout = asyncio.StreamReader()
+        stdout.feed_data(NMAP_XML)
+        stdout.feed_eof()
+        await nsnap.read_nmap_pipe(db, run_id, now, 'default', writer, metrics, itertools.count(), xml_file, stdout)
+
+    # the DB is only used by the writer thread, like in nsnap.py
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        db = writer.submit(nsnap.open_db).result()
+        run_id, now = writer.submit(db.start_run, 1591000000, '10.0.0.1-3', '-sT').result()
+        asyncio.run(read(writer, db, run_id, now))
+        assert writer.submit(lambda: db.dbconn.execute('SELECT COUNT(*) FROM hosts;').fetchone()[0]).result() == 2
+        writer.submit(db.dbclose).result()
+    with gzip.open(xml_file + '.gz') as archive:
+        assert archive.read() == NMAP_XML
+    assert metrics.values['xml_bytes'] == len(NMAP_XML)
+    assert metrics.values['parse_seconds'] >= 0.01 * math.ceil(len(NMAP_XML) / 100)
@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+
+from test_db import TIMESTAMPS, store_scans
+
+
+@pytest.mark.parametrize('origin, host, allowed', [
+    ('http://nsnap.example.org:5000', 'nsnap.example.org:5001', True),
+    ('http://NSNAP.example.org:5000', 'nsnap.example.org:5001', True),
+    ('http://[fd00::1]:5000', '[fd00::1]:5001', True),
+    ('https://nsnap.example.org', 'proxy.example.org', True),
+    ('http://nsnap.example.org:8080', 'nsnap.example.org:5001', False),
+    ('http://evil.example.org:5000', 'nsnap.example.org:5001', False),
+    ('http://nsnap.example.org', 'nsnap.example.org:5001', False),
+    ('null', 'nsnap.example.org:5001', False),
+    ('', 'nsnap.example.org:5001', False),
+])
+def test_events_origin(web, monkeypatch, origin, host, allowed):
+    '''the events are only readable by the web app on PORT and by the origin of EVENTS_URL'''
+    monkeypatch.setattr(web, 'PORT', 5000)
+    monkeypatch.setattr(web, 'EVENTS_URL', 'https://nsnap.example.org/events')
+    assert web.events_origin(origin, host) == (origin if allowed else None)
+
+
+def test_events_after_generation_zero(nsnap, web, tmp_path):
+    '''a poller that has seen generation 0 publishes every run finished after it'''
+    store_scans(nsnap, tmp_path)[0].dbclose()
+
+    class Published(Exception):
+        pass
+
+    async def publish(generation, modified, runs):
+        raise Published(runs)
+
+    server = web.EventServer()
+    server.generation = 0
+    server.publish = publish
+    with pytest.raises(Published) as published:
+        asyncio.run(server.poll())
+    assert [run[1] for run in published.value.args[0]] == TIMESTAMPS